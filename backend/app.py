@@ -34,8 +34,20 @@ LOCALDIR = Path(__file__).parent.parent
 
 
 class SubscriptionManager:
+    """
+    Hands each scraped bundle to the realtime subscriber. TRANSPORT selects Redis pub/sub (the default),
+    Redis Streams, or both while switching over. Stream entries stay until trimmed, so a subscriber that
+    was down resumes from its consumer group position instead of losing messages.
+    """
+    # approximate number of bundles kept per stream; at one bundle a minute per command this is about a week
+    STREAM_MAXLEN = 10000
+
     def __init__(self):
         self.redis_client = redis.Redis(host='memstore')
+        transport = os.getenv('TRANSPORT', 'pubsub')
+        self.publish = transport in {'pubsub', 'both'}
+        self.stream = transport in {'streams', 'both'}
+        self.stream_maxlen = int(os.getenv('STREAM_MAXLEN', self.STREAM_MAXLEN))
         task = asyncio.create_task(self.redis_client.ping())
         print(f'create task {task}')
         task.add_done_callback(lambda x: print(f'ping status: {x}'))
@@ -43,9 +55,16 @@ class SubscriptionManager:
     def common_callback(self, command, bundles):
         channel_name = f'channel:{command}'
         objlist = bundles[command]
-        asyncio.create_task(self.redis_client.publish(
-            channel_name, json.dumps([objlist[-1]])
-        ))
+        payload = json.dumps([objlist[-1]])
+        if self.publish:
+            asyncio.create_task(self.redis_client.publish(
+                channel_name, payload
+            ))
+        if self.stream:
+            asyncio.create_task(self.redis_client.xadd(
+                f'stream:{command}', {'data': payload},
+                maxlen=self.stream_maxlen, approximate=True
+            ))
 
 
 class Settings(BaseSettings):
@@ -1,5 +1,6 @@
 import datetime
 import json
+import os
 import pytz
 from pathlib import Path
 
@@ -24,6 +25,13 @@ class Util:
             return obj
         return datetime.datetime.fromisoformat(obj)
 
+    @staticmethod
+    def env_flag(name, default=False):
+        value = os.getenv(name)
+        if value is None:
+            return default
+        return value.strip().lower() in {'1', 'true', 'yes', 'on'}
+
 
 class Config:
     def __init__(self, current_environment):
@@ -6,10 +6,35 @@ from pydantic import BaseModel
 from pydantic_pint import PydanticPintQuantity
 from pint import Quantity
 
-from . import ureg
+from . import ureg, Q_
 
 Meters = Annotated[Quantity, PydanticPintQuantity('m', ureg=ureg)]
 
+# Estimates work in plain float meters internally; pint quantities are only built or taken apart here, at the
+# API models.
+METERS_PER_FOOT = 0.3048
+METERS_PER_MILE = 1609.344
+
+
+def to_meters(x) -> float:
+    if isinstance(x, Quantity):
+        return x.m_as(ureg.meter)
+    return float(x)
+
+
+def meters(x: float) -> Quantity:
+    return Q_(x, 'm')
+
+
+def miles(x: float) -> Quantity:
+    return Q_(x / METERS_PER_MILE, 'mi')
+
+
+def format_miles(x) -> Optional[str]:
+    if x is None:
+        return None
+    return f'{to_meters(x) / METERS_PER_MILE:0.2f} mi'
+
 
 class Mode(StrEnum):
     BUS = 'bus'
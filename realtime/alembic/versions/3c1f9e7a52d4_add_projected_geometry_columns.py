@@ -0,0 +1,37 @@
+"""Add projected geometry columns
+
+Revision ID: 3c1f9e7a52d4
+Revises: 8a0c55f3f3d9
+Create Date: 2025-03-10 14:22:09.318240
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from geoalchemy2 import Geometry
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3c1f9e7a52d4'
+down_revision: Union[str, None] = '8a0c55f3f3d9'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+TABLES = ['stop', 'current_vehicle_state', 'current_train_state']
+
+
+def upgrade() -> None:
+    for table in TABLES:
+        op.add_column(table, sa.Column('geom_chicago',
+                                       Geometry(geometry_type='POINT', srid=26916, spatial_index=False),
+                                       sa.Computed('ST_Transform(geom, 26916)', persisted=True),
+                                       nullable=True))
+        op.create_index(f'idx_{table}_geom_chicago', table, ['geom_chicago'], postgresql_using='gist')
+
+
+def downgrade() -> None:
+    for table in TABLES:
+        op.drop_index(f'idx_{table}_geom_chicago', table_name=table)
+        op.drop_column(table, 'geom_chicago')
@@ -0,0 +1,67 @@
+"""Partition position tables by hour
+
+Revision ID: 8a0c55f3f3d9
+Revises: 5e971bda30ab
+Create Date: 2025-03-04 10:12:41.502117
+
+"""
+import datetime
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from realtime.partitions import PartitionManager
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8a0c55f3f3d9'
+down_revision: Union[str, None] = '5e971bda30ab'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+KEYS = {
+    'bus_position': 'vid, timestamp',
+    'train_position': 'run, timestamp',
+}
+
+
+def rebuild(table, partitioned: bool):
+    """
+    Recreates table with the same columns, partitioned or not, and copies the retained rows across.
+    """
+    old = f'{table}_old'
+    op.execute(f'ALTER TABLE {table} RENAME TO {old}')
+    op.execute(f'ALTER TABLE {old} RENAME CONSTRAINT {table}_pkey TO {old}_pkey')
+    op.execute(f'ALTER TABLE {old} RENAME CONSTRAINT {table}_rt_fkey TO {old}_rt_fkey')
+    op.execute(f'DROP INDEX IF EXISTS idx_{table}_geom')
+    partition_clause = ' PARTITION BY RANGE (timestamp)' if partitioned else ''
+    op.execute(f'CREATE TABLE {table} (LIKE {old} INCLUDING DEFAULTS){partition_clause}')
+    op.execute(f'ALTER TABLE {table} ADD CONSTRAINT {table}_pkey PRIMARY KEY ({KEYS[table]})')
+    op.execute(f'ALTER TABLE {table} ADD CONSTRAINT {table}_rt_fkey FOREIGN KEY (rt) REFERENCES route (id)')
+    op.execute(f'CREATE INDEX idx_{table}_geom ON {table} USING gist (geom)')
+
+    bind = op.get_bind()
+    latest = bind.execute(sa.text(f'SELECT max(timestamp) FROM {old}')).scalar()
+    if partitioned:
+        op.execute(PartitionManager.default_statement(table))
+        now = datetime.datetime.now()
+        start = (latest or now) - PartitionManager.RETENTION
+        end = max(latest or now, now) + datetime.timedelta(hours=PartitionManager.HOURS_AHEAD)
+        for hour in PartitionManager.hours(start, end):
+            op.execute(PartitionManager.create_statement(table, hour))
+    if latest is not None:
+        bind.execute(sa.text(f'INSERT INTO {table} SELECT * FROM {old} WHERE timestamp >= :cutoff'),
+                     {'cutoff': latest - PartitionManager.RETENTION})
+    op.execute(f'DROP TABLE {old}')
+
+
+def upgrade() -> None:
+    for table in KEYS:
+        rebuild(table, partitioned=True)
+
+
+def downgrade() -> None:
+    for table in KEYS:
+        rebuild(table, partitioned=False)
@@ -0,0 +1,176 @@
+import datetime
+import threading
+
+from geoalchemy2.shape import to_shape
+from prometheus_client import Counter
+from sqlalchemy import event, select, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from backend.util import Util
+from realtime.rtmodel import Route, Pattern, Stop, PatternStop
+
+
+class DimensionCache:
+    """
+    In-process copy of the route, pattern, stop and pattern_stop tables, shared by all updaters. These tables
+    almost never change, so the ingest callbacks read them from here instead of issuing a session.get per
+    message. The cache is reloaded on a timer and after a previously unknown pattern id shows up.
+    """
+    REFRESH_INTERVAL = datetime.timedelta(minutes=30)
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.lock = threading.Lock()
+        # route id -> route name
+        self.routes = {}
+        # pattern id -> route id
+        self.patterns = {}
+        # stop id -> (stop name, lat/lon shapely point)
+        self.stops = {}
+        # pattern id -> {stop id -> (sequence, distance, direction_change, stop_headsign)}
+        self.pattern_stops = {}
+        # pattern id -> route id for known patterns whose stored route is still null
+        self.pending_routes = {}
+        self.last_refresh = None
+        self.refresh_requested = False
+        self.hit_counter = Counter('transit_dimension_cache_hit', 'Dimension cache hits', ['table'])
+        self.miss_counter = Counter('transit_dimension_cache_miss', 'Dimension cache misses', ['table'])
+        self.refresh_counter = Counter('transit_dimension_cache_refresh', 'Dimension cache reloads')
+        self.new_pattern_counter = Counter('transit_dimension_cache_new_pattern',
+                                           'Pattern rows created by the dimension cache')
+
+    def refresh(self):
+        start = datetime.datetime.now()
+        with Session(self.engine) as session:
+            routes = dict(session.execute(select(Route.id, Route.name)).tuples())
+            patterns = dict(session.execute(select(Pattern.id, Pattern.rt)).tuples())
+            stops = {}
+            for stop_id, stop_name, geom in session.execute(select(Stop.id, Stop.stop_name, Stop.geom)):
+                stops[stop_id] = (stop_name, to_shape(geom))
+            pattern_stops = self.load_pattern_stops(session)
+        with self.lock:
+            self.routes = routes
+            self.patterns = patterns
+            self.stops = stops
+            self.pattern_stops = pattern_stops
+            self.refresh_requested = False
+        self.last_refresh = Util.utcnow()
+        self.refresh_counter.inc()
+        print(f'Loaded {len(routes)} routes, {len(patterns)} patterns and {len(stops)} stops into the dimension '
+              f'cache in {datetime.datetime.now() - start}')
+
+    @staticmethod
+    def load_pattern_stops(session, pattern_ids=None):
+        stmt = select(PatternStop.pattern_id, PatternStop.stop_id, PatternStop.sequence, PatternStop.distance,
+                      PatternStop.direction_change, PatternStop.stop_headsign)
+        if pattern_ids is not None:
+            stmt = stmt.where(PatternStop.pattern_id.in_(pattern_ids))
+        pattern_stops = {}
+        for pattern_id, stop_id, sequence, distance, direction_change, stop_headsign in session.execute(stmt):
+            pattern_stops.setdefault(pattern_id, {})[stop_id] = (sequence, distance, direction_change,
+                                                                 stop_headsign)
+        return pattern_stops
+
+    def maybe_refresh(self):
+        if self.last_refresh is None or self.refresh_requested:
+            self.refresh()
+        elif Util.utcnow() - self.last_refresh > self.REFRESH_INTERVAL:
+            self.refresh()
+
+    def lookup(self, table, mapping, key):
+        value = mapping.get(key)
+        if value is None:
+            self.miss_counter.labels(table=table).inc()
+        else:
+            self.hit_counter.labels(table=table).inc()
+        return value
+
+    def has_route(self, rt):
+        return self.lookup('route', self.routes, rt) is not None
+
+    def get_stop(self, stop_id):
+        """
+        :return: (stop name, lat/lon point) or None
+        """
+        return self.lookup('stop', self.stops, stop_id)
+
+    def get_pattern_stops(self, pattern_id):
+        """
+        :return: dict of stop id to (sequence, distance, direction_change, stop_headsign), or None
+        """
+        return self.lookup('pattern_stop', self.pattern_stops, pattern_id)
+
+    def ensure_patterns(self, session, patterns: dict):
+        """
+        Inserts placeholder Pattern rows for any pattern ids not yet known, in a single statement. Runs in the
+        caller's session so the rows are visible to foreign keys in the same transaction. New ids are only added
+        to the cache once that transaction commits; until then they are tracked in the session.
+        :param session:
+        :param patterns: dict of pattern id to route id
+        :return: set of pattern ids that were new
+        """
+        pending = self.pending_patterns(session)
+        missing = {}
+        for pid, rt in patterns.items():
+            if pid in pending:
+                self.hit_counter.labels(table='pattern').inc()
+                continue
+            if pid in self.patterns:
+                self.hit_counter.labels(table='pattern').inc()
+                if self.patterns[pid] is None and rt is not None:
+                    with self.lock:
+                        self.pending_routes[pid] = rt
+                continue
+            self.miss_counter.labels(table='pattern').inc()
+            missing[pid] = rt
+        if not missing:
+            return set([])
+        rows = [{'id': pid,
+                 'updated': datetime.datetime.fromtimestamp(0),
+                 'rt': rt,
+                 'length': 0} for pid, rt in missing.items()]
+        session.execute(insert(Pattern).values(rows).on_conflict_do_nothing(index_elements=[Pattern.id]))
+        pending.update(missing)
+        self.new_pattern_counter.inc(len(missing))
+        return set(missing.keys())
+
+    def pending_patterns(self, session):
+        """
+        :return: dict of pattern id to route id inserted in the session's current transaction
+        """
+        if 'new_patterns' not in session.info:
+            session.info['new_patterns'] = {}
+            event.listen(session, 'after_commit', self.patterns_committed)
+            event.listen(session, 'after_rollback', self.patterns_rolled_back)
+        return session.info['new_patterns']
+
+    def patterns_committed(self, session):
+        committed = session.info['new_patterns']
+        session.info['new_patterns'] = {}
+        if not committed:
+            return
+        with self.lock:
+            self.patterns.update(committed)
+            # pattern stops for a new pattern may have been loaded since the last refresh
+            self.refresh_requested = True
+
+    def patterns_rolled_back(self, session):
+        session.info['new_patterns'] = {}
+
+    def flush_pattern_routes(self, connection):
+        """
+        Stores the routes learned for patterns that were loaded without one. Only patterns seen since the
+        previous flush are touched.
+        :return: number of patterns updated
+        """
+        with self.lock:
+            pending = self.pending_routes
+            self.pending_routes = {}
+        if not pending:
+            return 0
+        connection.execute(text('UPDATE pattern SET rt = :rt WHERE id = :id AND rt IS NULL'),
+                           [{'id': pid, 'rt': rt} for pid, rt in pending.items()])
+        with self.lock:
+            self.patterns.update(pending)
+        return len(pending)
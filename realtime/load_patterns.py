@@ -2,6 +2,7 @@
 
 from pathlib import Path
 import json
+import os
 
 
 from sqlalchemy import select, func, delete
@@ -30,11 +31,12 @@ TRAIN_ROUTES = [
 
 
 class S3Getter:
-    def __init__(self):
+    def __init__(self, endpoint_url=None):
         self.cachedir = Path('/tmp/s3cache')
         self.cachedir.mkdir(exist_ok=True)
+        # endpoint_url allows replaying from an S3 stand-in such as a moto server
         self.client = boto3.client(
-            's3', region_name='us-east-2',
+            's3', region_name='us-east-2', endpoint_url=endpoint_url or os.getenv('S3_ENDPOINT_URL'),
             config=botocore.config.Config(signature_version=UNSIGNED)
         )
         self.bucket = 'transitquality2024'
@@ -44,23 +46,31 @@ class S3Getter:
     def stats(self):
         print(f'In this session, retrieved {self.fetched} directly and {self.cached} from cache.')
 
+    def iter_keys(self, prefix):
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for item in page.get('Contents', []):
+                yield item['Key']
+
     def list_with_prefix(self, prefix):
-        return self.client.list_objects(Bucket=self.bucket, Prefix=prefix)
+        return {'Contents': [{'Key': key} for key in self.iter_keys(prefix)]}
 
-    def get_json_contents(self, key):
+    def get_raw_contents(self, key):
         cache_key = key.replace('/', '_')
         cached_path = self.cachedir / cache_key
         if cached_path.exists():
-            with cached_path.open() as fh:
-                self.cached += 1
-                return json.load(fh)
+            self.cached += 1
+            return cached_path.read_text()
         obj = self.client.get_object(Bucket=self.bucket, Key=key)
         data = obj['Body'].read()
         raw_str = data.decode('utf-8')
         with cached_path.open('w') as wfh:
             wfh.write(raw_str)
         self.fetched += 1
-        return json.loads(raw_str)
+        return raw_str
+
+    def get_json_contents(self, key):
+        return json.loads(self.get_raw_contents(key))
 
 
 def load_routes():
@@ -0,0 +1,140 @@
+import contextlib
+import datetime
+import threading
+import time
+
+from prometheus_client import Counter, Histogram
+from sqlalchemy import create_engine, text
+
+from realtime.redisclean import Cleaner
+
+
+class LastSeen:
+    """
+    Latest update time per vehicle, fed by the ingest workers. Staleness is judged against the newest
+    update seen, like the max(last_update) subselect it replaces, so a feed outage doesn't expire everything.
+    """
+    def __init__(self, max_age: datetime.timedelta):
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.last_update = {}
+        self.latest = None
+
+    def seen(self, key, timestamp: datetime.datetime):
+        with self.lock:
+            previous = self.last_update.get(key)
+            if previous is None or timestamp > previous:
+                self.last_update[key] = timestamp
+            if self.latest is None or timestamp > self.latest:
+                self.latest = timestamp
+
+    def pop_stale(self):
+        """
+        :return: (keys, threshold) for vehicles not updated since threshold; keys are forgotten
+        """
+        with self.lock:
+            if self.latest is None:
+                return [], None
+            threshold = self.latest - self.max_age
+            stale = [k for k, ts in self.last_update.items() if ts < threshold]
+            for k in stale:
+                del self.last_update[k]
+        return stale, threshold
+
+
+class Maintenance:
+    """
+    Periodic cleanup for the subscriber, run on its own thread and connection pool with a statement timeout so
+    it can't stall ingest. Each run only touches what changed since the previous one: vehicles that went stale
+    and patterns whose route was newly learned.
+    """
+    INTERVAL = 60
+    STATEMENT_TIMEOUT_MSECS = 30 * 1000
+    PARTITION_EVERY = 10
+
+    def __init__(self, subscriber):
+        self.subscriber = subscriber
+        self.engine = create_engine(subscriber.engine.url, pool_size=1, max_overflow=0,
+                                    connect_args={'options': f'-c statement_timeout={self.STATEMENT_TIMEOUT_MSECS}'})
+        self.vehicles = LastSeen(datetime.timedelta(minutes=5))
+        self.trains = LastSeen(datetime.timedelta(minutes=10))
+        self.iteration = 0
+        # history Redis cleanup advances a SCAN cursor a bounded amount each run
+        self.cleaner = Cleaner(host=None)
+        self.thread = threading.Thread(target=self.run, name='maintenance', daemon=True)
+        self.cleanup_counter = Counter('transit_bus_cleanup_base', 'Standard cleanup run')
+        self.cleanup_position_counter = Counter('transit_bus_cleanup_position', 'Clean up positions')
+        self.cleanup_redis_counter = Counter('transit_bus_cleanup_redis', 'Clean up old redis entries')
+        self.redis_visited_counter = Counter('transit_redis_clean_visited', 'History Redis keys visited by cleanup')
+        self.redis_removed_counter = Counter('transit_redis_clean_removed', 'Expired history Redis keys removed')
+        self.cleanup_error_counter = Counter('transit_cleanup_error', 'Cleanup runs that failed')
+        self.expired_counter = Counter('transit_cleanup_expired_vehicle', 'Stale vehicles removed from current state',
+                                       ['mode'])
+        self.step_histogram = Histogram('transit_cleanup_step_seconds', 'Time taken by each cleanup step', ['step'],
+                                        buckets=(0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60))
+        self.seed()
+
+    def seed(self):
+        """
+        Loads vehicles already in the current state tables so ones that never report again still expire.
+        """
+        with self.engine.connect() as connection:
+            for vid, last_update in connection.execute(text('SELECT id, last_update FROM current_vehicle_state')):
+                self.vehicles.seen(vid, last_update)
+            for run, last_update in connection.execute(text('SELECT id, last_update FROM current_train_state')):
+                self.trains.seen(run, last_update)
+
+    def start(self):
+        self.thread.start()
+
+    @contextlib.contextmanager
+    def step(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.step_histogram.labels(step=name).observe(time.monotonic() - start)
+
+    def expire(self, connection, table, mode, last_seen: LastSeen):
+        stale, threshold = last_seen.pop_stale()
+        if not stale:
+            return
+        # a vehicle may have reported again since it was marked stale
+        connection.execute(text(f'DELETE FROM {table} WHERE id = ANY(:ids) AND last_update < :threshold'),
+                           {'ids': stale, 'threshold': threshold})
+        self.expired_counter.labels(mode=mode).inc(len(stale))
+
+    def run_once(self):
+        start = datetime.datetime.now()
+        self.cleanup_counter.inc()
+        with self.engine.connect() as connection:
+            with self.step('vehicle_state'):
+                self.expire(connection, 'current_vehicle_state', 'bus', self.vehicles)
+            with self.step('train_state'):
+                self.expire(connection, 'current_train_state', 'train', self.trains)
+            with self.step('pattern_routes'):
+                self.subscriber.dimensions.flush_pattern_routes(connection)
+            connection.commit()
+        with self.step('run_tracker'):
+            self.subscriber.train_updater.expire_runs()
+        self.iteration += 1
+        if self.iteration % self.PARTITION_EVERY == 0:
+            # position retention drops whole hourly partitions
+            self.cleanup_position_counter.inc()
+            with self.step('partitions'):
+                self.subscriber.partitions.maintain()
+        self.cleanup_redis_counter.inc()
+        with self.step('redis'):
+            visited, removed = self.cleaner.clean_step()
+        self.redis_visited_counter.inc(visited)
+        self.redis_removed_counter.inc(removed)
+        print(f'Cleanup run {self.iteration} took {datetime.datetime.now() - start}')
+
+    def run(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f'Cleanup run failed: {e}')
+                self.cleanup_error_counter.inc()
+            time.sleep(self.INTERVAL)
@@ -0,0 +1,104 @@
+import datetime
+
+from prometheus_client import Counter
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+from backend.util import Util
+
+
+class PartitionManager:
+    """
+    Maintains the hourly range partitions of bus_position and train_position. Partitions are created
+    HOURS_AHEAD ahead of the current Chicago hour and whole partitions are dropped once all their rows are past
+    RETENTION, so enforcing retention never deletes individual rows. A default partition catches rows outside
+    every hourly range (e.g. a clock far off) so inserts never fail; it is pruned by row.
+    """
+    TABLES = ['bus_position', 'train_position']
+    HOURS_AHEAD = 6
+    RETENTION = datetime.timedelta(hours=24)
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.created_counter = Counter('transit_partition_created', 'Hourly partitions created', ['table'])
+        self.dropped_counter = Counter('transit_partition_dropped', 'Expired hourly partitions dropped', ['table'])
+
+    @staticmethod
+    def partition_name(table, hour: datetime.datetime):
+        return f'{table}_p{hour.strftime("%Y%m%d%H")}'
+
+    @staticmethod
+    def create_statement(table, hour: datetime.datetime):
+        end = hour + datetime.timedelta(hours=1)
+        return (f'CREATE TABLE IF NOT EXISTS {PartitionManager.partition_name(table, hour)} '
+                f'PARTITION OF {table} FOR VALUES FROM (\'{hour.isoformat()}\') TO (\'{end.isoformat()}\')')
+
+    @staticmethod
+    def default_statement(table):
+        return f'CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT'
+
+    @staticmethod
+    def hours(start: datetime.datetime, end: datetime.datetime):
+        hour = start.replace(minute=0, second=0, microsecond=0)
+        while hour <= end:
+            yield hour
+            hour += datetime.timedelta(hours=1)
+
+    @staticmethod
+    def existing_partitions(connection, table):
+        """
+        :return: dict of partition start hour to partition name, excluding the default partition
+        """
+        rows = connection.execute(text('SELECT c.relname FROM pg_inherits i '
+                                       'JOIN pg_class c ON c.oid = i.inhrelid '
+                                       'JOIN pg_class p ON p.oid = i.inhparent '
+                                       'WHERE p.relname = :table'), {'table': table})
+        partitions = {}
+        prefix = f'{table}_p'
+        for name, in rows:
+            if not name.startswith(prefix):
+                continue
+            try:
+                hour = datetime.datetime.strptime(name[len(prefix):], '%Y%m%d%H')
+            except ValueError:
+                continue
+            partitions[hour] = name
+        return partitions
+
+    def maintain(self, now: datetime.datetime = None):
+        """
+        Creates upcoming partitions and drops expired ones for both tables.
+        :param now: naive Chicago time; defaults to the current time
+        """
+        if now is None:
+            now = Util.ctanow().replace(tzinfo=None)
+        for table in self.TABLES:
+            self.maintain_table(table, now)
+
+    def maintain_table(self, table, now: datetime.datetime):
+        cutoff = now - self.RETENTION
+        with self.engine.connect() as connection:
+            connection.execute(text(self.default_statement(table)))
+            existing = self.existing_partitions(connection, table)
+            connection.commit()
+            for hour in self.hours(now, now + datetime.timedelta(hours=self.HOURS_AHEAD)):
+                if hour in existing:
+                    continue
+                try:
+                    connection.execute(text(self.create_statement(table, hour)))
+                    connection.commit()
+                    self.created_counter.labels(table=table).inc()
+                except DBAPIError as e:
+                    # rows for this hour already landed in the default partition
+                    print(f'Could not create partition {self.partition_name(table, hour)}: {e}')
+                    connection.rollback()
+            for hour, name in sorted(existing.items()):
+                if hour + datetime.timedelta(hours=1) > cutoff:
+                    break
+                connection.execute(text(f'ALTER TABLE {table} DETACH PARTITION {name}'))
+                connection.execute(text(f'DROP TABLE {name}'))
+                connection.commit()
+                self.dropped_counter.labels(table=table).inc()
+                print(f'Dropped expired partition {name}')
+            connection.execute(text(f'DELETE FROM {table}_default WHERE timestamp < :cutoff'), {'cutoff': cutoff})
+            connection.commit()
@@ -0,0 +1,198 @@
+import asyncio
+import json
+import queue
+import threading
+import time
+
+from prometheus_client import Counter, Gauge, Histogram
+
+
+class TopicQueue:
+    """
+    Bounded queue of raw bundles for one topic, drained by its own worker thread so that slow database and
+    Redis work never blocks reading from pubsub or the other topics.
+
+    When the queue is full the reader waits for room (backpressure). A topic may give a coalesce_key function;
+    a new bundle then replaces a still queued bundle with the same key, since it is a newer snapshot of the
+    same thing. For getvehicles the key is the set of routes requested, as each bundle only covers a few
+    routes and bundles for other routes must not be lost.
+
+    An optional on_done callback runs once a bundle has been handled, with whether the handler succeeded, e.g.
+    to acknowledge a stream entry only if it was processed. Bundles with one are never coalesced, so after a
+    restart the stream backlog is replayed in full.
+    """
+    def __init__(self, pipeline, topic, handler, maxsize, coalesce_key=None):
+        self.pipeline = pipeline
+        self.topic = topic
+        self.handler = handler
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.coalesce_key = coalesce_key
+        self.thread = threading.Thread(target=self.run, name=f'worker-{topic}', daemon=True)
+        pipeline.depth_gauge.labels(topic=topic).set_function(self.queue.qsize)
+        pipeline.lag_gauge.labels(topic=topic).set_function(self.oldest_age)
+
+    def oldest_age(self):
+        with self.queue.mutex:
+            if not self.queue.queue:
+                return 0
+            received = self.queue.queue[0][0]
+        return time.monotonic() - received
+
+    def start(self):
+        self.thread.start()
+
+    @staticmethod
+    def done(on_done, success=True):
+        if on_done is None:
+            return
+        try:
+            on_done(success)
+        except Exception as e:
+            print(f'Error completing bundle: {e}')
+
+    def make_item(self, channel, data, on_done):
+        key = None
+        if self.coalesce_key is not None and on_done is None:
+            if isinstance(data, (str, bytes)):
+                data = json.loads(data)
+            key = self.coalesce_key(data)
+        return time.monotonic(), channel, data, on_done, key
+
+    def replace(self, item):
+        """
+        Swaps item in for a queued bundle with the same coalesce key, keeping that bundle's place in line.
+        :return: True if a bundle was replaced
+        """
+        key = item[4]
+        if key is None:
+            return False
+        with self.queue.mutex:
+            for index, queued in enumerate(self.queue.queue):
+                if queued[4] == key:
+                    self.queue.queue[index] = item
+                    break
+            else:
+                return False
+        self.pipeline.drop_counter.labels(topic=self.topic, reason='replaced').inc()
+        return True
+
+    def offer_item(self, item):
+        if self.replace(item):
+            return True
+        try:
+            self.queue.put_nowait(item)
+            return True
+        except queue.Full:
+            return False
+
+    def offer(self, channel, data, on_done=None):
+        """
+        :return: True if the bundle was queued, False if the caller should wait and retry
+        """
+        return self.offer_item(self.make_item(channel, data, on_done))
+
+    def put(self, channel, data, on_done=None):
+        """
+        Blocking put for callers outside the event loop.
+        """
+        item = self.make_item(channel, data, on_done)
+        if self.offer_item(item):
+            return
+        self.pipeline.backpressure_counter.labels(topic=self.topic).inc()
+        while not self.offer_item(item):
+            time.sleep(self.pipeline.BACKPRESSURE_POLL)
+
+    def run(self):
+        while True:
+            received, channel, data, on_done, _ = self.queue.get()
+            success = False
+            try:
+                success = self.process(received, channel, data)
+            finally:
+                self.queue.task_done()
+                self.done(on_done, success)
+
+    def process(self, received, channel, data):
+        """
+        :return: True if the handler processed the bundle without raising
+        """
+        waited = time.monotonic() - received
+        self.pipeline.wait_histogram.labels(topic=self.topic).observe(waited)
+        start = time.monotonic()
+        try:
+            if isinstance(data, (str, bytes)):
+                data = json.loads(data)
+            self.handler(data, channel)
+            return True
+        except Exception as e:
+            print(f'Error handling {channel} bundle: {e}')
+            self.pipeline.error_counter.labels(topic=self.topic).inc()
+            return False
+        finally:
+            self.pipeline.processing_histogram.labels(topic=self.topic).observe(time.monotonic() - start)
+
+
+class Pipeline:
+    """
+    Routes incoming bundles to per-topic queues. Channels are matched to topics by substring so that pubsub
+    channels (channel:getvehicles), catchup bundles (catchup-getvehicles) and S3 refreshes share a queue.
+    """
+    BACKPRESSURE_POLL = 0.05
+
+    def __init__(self):
+        self.topics = {}
+        self.depth_gauge = Gauge('transit_subscriber_queue_depth', 'Bundles waiting per topic', ['topic'])
+        self.lag_gauge = Gauge('transit_subscriber_queue_lag_seconds',
+                               'Age of the oldest waiting bundle per topic', ['topic'])
+        self.wait_histogram = Histogram('transit_subscriber_queue_wait_seconds',
+                                        'Time bundles spend queued before processing', ['topic'],
+                                        buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600))
+        self.processing_histogram = Histogram('transit_subscriber_processing_seconds',
+                                              'Time to process one bundle', ['topic'],
+                                              buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+        self.drop_counter = Counter('transit_subscriber_dropped',
+                                    'Bundles dropped before processing, e.g. replaced by a newer one',
+                                    ['topic', 'reason'])
+        self.backpressure_counter = Counter('transit_subscriber_backpressure',
+                                            'Times the reader waited for room in a full queue', ['topic'])
+        self.error_counter = Counter('transit_subscriber_handler_error', 'Bundles that raised while processing',
+                                     ['topic'])
+
+    def add_topic(self, topic, handler, maxsize, coalesce_key=None):
+        self.topics[topic] = TopicQueue(self, topic, handler, maxsize, coalesce_key=coalesce_key)
+
+    def start(self):
+        for topic_queue in self.topics.values():
+            topic_queue.start()
+
+    def get_queue(self, channel):
+        for topic, topic_queue in self.topics.items():
+            if topic in channel:
+                return topic_queue
+        return None
+
+    async def dispatch(self, channel, data, on_done=None):
+        """
+        Queues a bundle from the event loop, yielding while the topic's queue is full.
+        """
+        topic_queue = self.get_queue(channel)
+        if topic_queue is None:
+            print(f'Warning! Unexpected topic {channel}')
+            TopicQueue.done(on_done)
+            return
+        item = topic_queue.make_item(channel, data, on_done)
+        if topic_queue.offer_item(item):
+            return
+        self.backpressure_counter.labels(topic=topic_queue.topic).inc()
+        while not topic_queue.offer_item(item):
+            await asyncio.sleep(self.BACKPRESSURE_POLL)
+
+    def submit(self, channel, data):
+        """
+        Queues a bundle from a thread, blocking while the topic's queue is full.
+        """
+        topic_queue = self.get_queue(channel)
+        if topic_queue is None:
+            print(f'Warning! Unexpected topic {channel}')
+            return
+        topic_queue.put(channel, data)
@@ -11,34 +11,93 @@ logger = logging.getLogger(__file__)
 
 
 class Cleaner:
-    def __init__(self, host):
+    """
+    Removes trajectory series from the history Redis once their newest sample is older than MAX_AGE. Samples
+    inside live series are trimmed by the series' own retention (see TrajectoryBatch), so only whole expired
+    series need deleting here.
+
+    Keys are walked with SCAN rather than KEYS so the server is never blocked. clean_step does a bounded
+    amount of work and remembers its cursor, so it can be called on every maintenance tick; clean does a
+    full pass.
+    """
+    KEY_PATTERNS = ['trainposition:*', 'busposition:*']
+    MAX_AGE = datetime.timedelta(hours=24)
+    SCAN_COUNT = 500
+
+    def __init__(self, host, budget=2000):
         self.redis = redis.Redis(host=host)
+        self.budget = budget
+        self.pattern_index = 0
+        self.cursor = 0
+        self.visited = 0
+        self.removed = 0
+        self.passes = 0
+
+    def threshold(self):
+        # trajectory samples are stored with timestamps in seconds
+        return int((datetime.datetime.now() - self.MAX_AGE).timestamp())
+
+    def clean_keys(self, keys, threshold):
+        if not keys:
+            return 0
+        p = self.redis.pipeline(transaction=False)
+        for k in keys:
+            p.ts().get(k)
+        results = p.execute(raise_on_error=False)
+        expired = []
+        for k, rv in zip(keys, results):
+            if isinstance(rv, Exception):
+                # not a time series
+                continue
+            if not rv or rv[0] < threshold:
+                expired.append(k)
+        if expired:
+            self.redis.unlink(*expired)
+        return len(expired)
+
+    def clean_step(self):
+        """
+        Scans roughly budget key slots, continuing from where the previous call stopped.
+        :return: (keys visited, keys removed) by this call
+        """
+        threshold = self.threshold()
+        scanned = 0
+        visited = 0
+        removed = 0
+        while scanned < self.budget:
+            scanned += self.SCAN_COUNT
+            pattern = self.KEY_PATTERNS[self.pattern_index]
+            self.cursor, keys = self.redis.scan(self.cursor, match=pattern, count=self.SCAN_COUNT)
+            visited += len(keys)
+            removed += self.clean_keys(keys, threshold)
+            if self.cursor == 0:
+                logger.debug(f'Finished pass over {pattern}')
+                self.pattern_index = (self.pattern_index + 1) % len(self.KEY_PATTERNS)
+                if self.pattern_index == 0:
+                    self.passes += 1
+                    break
+        self.visited += visited
+        self.removed += removed
+        return visited, removed
 
     def clean(self):
-        r = self.redis
-        thresh = datetime.datetime.now() - datetime.timedelta(hours=24)
-        ts = int(thresh.timestamp())
-        logger.debug(f'Removing entries older than {ts}')
-        for keytype in ['train', 'bus']:
-            logger.debug(f'Cleaning {keytype}')
-            empty = 0
-            del_keys = r.keys(f'{keytype}position:*')
-            logger.debug(len(del_keys), type(del_keys))
-            p = r.pipeline()
-            for k in del_keys:
-                p.ts().delete(k, 0, ts)
-            p.execute()
-            for k in del_keys:
-                p.ts().get(k)
-            results = p.execute()
-            for k, rv in zip(del_keys, results):
-                if rv is None:
-                    p.delete(k)
-                    empty += 1
-            p.execute()
-            logger.debug(f'Removed {empty} empty keys')
+        """
+        Full pass over all trajectory keys.
+        """
+        self.pattern_index = 0
+        self.cursor = 0
+        passes = self.passes
+        visited = 0
+        removed = 0
+        while self.passes == passes:
+            v, r = self.clean_step()
+            visited += v
+            removed += r
+        logger.debug(f'Visited {visited} keys, removed {removed}')
+        return visited, removed
 
 
 if __name__ == "__main__":
     c = Cleaner(sys.argv[1])
-    c.clean()
+    visited, removed = c.clean()
+    print(f'Visited {visited} keys, removed {removed}')
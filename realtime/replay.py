@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Replays archived scraper responses into the subscriber handlers, e.g. to rebuild state after a redeploy.
+"""
+import argparse
+import collections
+import concurrent.futures
+import datetime
+import json
+from pathlib import Path
+
+from backend.util import Util
+
+
+class LocalSource:
+    """
+    Archived responses in a local directory laid out like the bucket (bustracker/raw/<command>/<day>/...).
+    """
+    def __init__(self, root: Path):
+        self.root = Path(root)
+
+    def iter_keys(self, prefix):
+        prefix_path = self.root / prefix
+        directory = prefix_path.parent
+        if not directory.exists():
+            return
+        for path in sorted(directory.iterdir()):
+            if path.is_file() and path.name.startswith(prefix_path.name):
+                yield str(path.relative_to(self.root))
+
+    def get_raw_contents(self, key):
+        return (self.root / key).read_text()
+
+    def stats(self):
+        pass
+
+
+class Replayer:
+    """
+    Fetches archived objects with a pool of threads while handing them to the handler strictly in key order,
+    which for a single command is time order. Commands are replayed one after another so each topic's
+    ordering is preserved; at most LOOKAHEAD objects per worker are held in memory.
+    """
+    LOOKAHEAD = 2
+
+    def __init__(self, source, handler, workers=8):
+        self.source = source
+        self.handler = handler
+        self.workers = workers
+        self.replayed = 0
+
+    def keys_for(self, cmd, start: datetime.datetime, hours):
+        for x in range(hours):
+            dt = start + datetime.timedelta(hours=x)
+            prefix = f'bustracker/raw/{cmd}/{dt.strftime("%Y%m%d")}/t{dt.hour:02d}'
+            print(f'Getting prefix {prefix}')
+            yield from self.source.iter_keys(prefix)
+
+    def replay_keys(self, cmd, keys):
+        window = self.workers * self.LOOKAHEAD
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = collections.deque()
+            for key in keys:
+                pending.append(executor.submit(self.source.get_raw_contents, key))
+                if len(pending) >= window:
+                    self.handle(cmd, pending.popleft().result())
+            while pending:
+                self.handle(cmd, pending.popleft().result())
+
+    def handle(self, cmd, raw):
+        # all requests of one object go to the handler together, as one bundle
+        self.handler(json.loads(raw)['requests'], cmd)
+        self.replayed += 1
+
+    def replay(self, cmds, start: datetime.datetime, hours):
+        begin = datetime.datetime.now()
+        for cmd in cmds:
+            self.replay_keys(cmd, self.keys_for(cmd, start, hours))
+        self.source.stats()
+        print(f'Replayed {self.replayed} objects in {datetime.datetime.now() - begin}')
+        return {'refreshed': self.replayed}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Replay archived responses and print per-topic counts.')
+    parser.add_argument('cmds', nargs='+',
+                        help='Commands to replay, e.g. getvehicles ttpositions.aspx')
+    parser.add_argument('--hours', type=int, default=1,
+                        help='Number of hours to replay, ending with the current hour.')
+    parser.add_argument('--local', type=str,
+                        help='Replay from this directory instead of S3.')
+    parser.add_argument('--endpoint-url', type=str,
+                        help='S3 endpoint, e.g. a local moto server.')
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+    if args.local:
+        source = LocalSource(Path(args.local))
+    else:
+        from realtime.load_patterns import S3Getter
+        source = S3Getter(endpoint_url=args.endpoint_url)
+    counts = collections.Counter()
+    replayer = Replayer(source, lambda data, cmd: counts.update([cmd]), workers=args.workers)
+    now = Util.utcnow()
+    replayer.replay(args.cmds, now - datetime.timedelta(hours=args.hours - 1), args.hours)
+    print(dict(counts))
@@ -1,7 +1,7 @@
 import datetime
 from typing import List
 
-from sqlalchemy import create_engine, String, ForeignKey
+from sqlalchemy import create_engine, String, ForeignKey, Computed
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 from sqlalchemy.orm import DeclarativeBase
 from geoalchemy2 import Geometry
@@ -35,6 +35,9 @@ class Stop(Base):
     #lat: Mapped[float]
     #lon: Mapped[float]
     geom = mapped_column(Geometry(geometry_type='POINT', srid=4326))
+    # EPSG:26916 copy of geom maintained by postgres, GiST indexed for ST_DWithin in meters
+    geom_chicago = mapped_column(Geometry(geometry_type='POINT', srid=26916),
+                                 Computed('ST_Transform(geom, 26916)', persisted=True))
 
     pattern_stops: Mapped[List["PatternStop"]] = relationship(back_populates="stop")
 
@@ -99,6 +102,8 @@ class CurrentVehicleState(Base):
     #lat: Mapped[float]
     #lon: Mapped[float]
     geom = mapped_column(Geometry(geometry_type='POINT', srid=4326))
+    geom_chicago = mapped_column(Geometry(geometry_type='POINT', srid=26916),
+                                 Computed('ST_Transform(geom, 26916)', persisted=True))
     pid = mapped_column(ForeignKey("pattern.id"))  # index manually added
     rt = mapped_column(ForeignKey("route.id"))
     distance: Mapped[int]
@@ -111,6 +116,8 @@ class CurrentVehicleState(Base):
 
 class BusPosition(Base):
     __tablename__ = "bus_position"
+    # hourly partitions are managed by realtime.partitions.PartitionManager
+    __table_args__ = {'postgresql_partition_by': 'RANGE (timestamp)'}
 
     vid: Mapped[int] = mapped_column(primary_key=True)
     timestamp: Mapped[datetime.datetime] = mapped_column(primary_key=True)
@@ -155,6 +162,7 @@ class BusPosition(Base):
 
 class TrainPosition(Base):
     __tablename__ = "train_position"
+    __table_args__ = {'postgresql_partition_by': 'RANGE (timestamp)'}
 
     run: Mapped[int] = mapped_column(primary_key=True)
     timestamp: Mapped[datetime.datetime] = mapped_column(primary_key=True)
@@ -186,6 +194,8 @@ class CurrentTrainState(Base):
     id: Mapped[int] = mapped_column(primary_key=True)
     last_update: Mapped[datetime.datetime]
     geom = mapped_column(Geometry(geometry_type='POINT', srid=4326))
+    geom_chicago = mapped_column(Geometry(geometry_type='POINT', srid=26916),
+                                 Computed('ST_Transform(geom, 26916)', persisted=True))
     rt = mapped_column(ForeignKey("route.id"))
     dest_station: Mapped[int]
     dest_station_name: Mapped[str]
@@ -268,11 +278,12 @@ class ScheduleDestinations(Base):
     direction: Mapped[str]
 
 
-def db_init(config, echo=False):
+def db_init(config, echo=False, create_tables=True):
     conn_str = f'postgresql://postgres:rttransit@{config.get_server("vehicle-db")}/rttransitstate'
     print(f'Connecting to {conn_str}')
     engine = create_engine(conn_str, echo=echo)
-    Base.metadata.create_all(engine)
+    if create_tables:
+        Base.metadata.create_all(engine)
     return engine
 
 
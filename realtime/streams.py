@@ -0,0 +1,162 @@
+import asyncio
+import os
+import socket
+
+import redis
+from prometheus_client import Counter, Gauge
+
+from realtime.pipeline import Pipeline
+
+
+class StreamReader:
+    """
+    Reads scraper bundles from Redis Streams through a consumer group, as an alternative to pub/sub.
+
+    Entries are acknowledged only after the pipeline has handled them successfully; the pipeline never drops or
+    coalesces stream entries, so entries read but not processed before a crash, or whose handler failed, stay
+    pending and are replayed. On startup the consumer first re-reads its own pending entries, then continues
+    with new ones; entries left pending for longer than CLAIM_IDLE_MSECS, by another consumer or by a failed
+    handler here, are taken over with XAUTOCLAIM. An entry delivered MAX_DELIVERIES times without success is
+    moved to a dead-letter stream instead of being retried forever. The publisher trims streams with an
+    approximate MAXLEN.
+    """
+    GROUP = 'subscriber'
+    COMMANDS = ['getvehicles', 'ttpositions.aspx', 'getpredictions', 'ttarrivals.aspx']
+    BLOCK_MSECS = 1000
+    READ_COUNT = 10
+    CLAIM_IDLE_MSECS = 60 * 1000
+    CLAIM_INTERVAL = 30
+    MAX_DELIVERIES = 5
+    DEAD_LETTER_MAXLEN = 1000
+
+    def __init__(self, host, redis_client, pipeline: Pipeline):
+        self.redis_client = redis_client
+        self.pipeline = pipeline
+        # acknowledgements come from worker threads, so they use a synchronous client
+        self.ack_client = redis.Redis(host=host)
+        self.consumer = os.getenv('SUBSCRIBER_NAME', socket.gethostname())
+        self.streams = [f'stream:{command}' for command in self.COMMANDS]
+        # (stream, entry id) queued in the pipeline but not yet acknowledged; XAUTOCLAIM also returns this
+        # consumer's own slow entries, which must not be queued twice
+        self.in_flight = set()
+        self.lag_gauge = Gauge('transit_subscriber_stream_lag', 'Stream entries not yet delivered to the group',
+                               ['stream'])
+        self.pending_gauge = Gauge('transit_subscriber_stream_pending',
+                                   'Stream entries delivered but not acknowledged', ['stream'])
+        self.claim_counter = Counter('transit_subscriber_stream_claimed',
+                                     'Stuck stream entries claimed for redelivery', ['stream'])
+        self.dead_letter_counter = Counter('transit_subscriber_stream_dead_letter',
+                                           'Stream entries given up on after MAX_DELIVERIES attempts', ['stream'])
+
+    async def create_groups(self):
+        for stream in self.streams:
+            try:
+                await self.redis_client.xgroup_create(stream, self.GROUP, id='0', mkstream=True)
+            except redis.exceptions.ResponseError as e:
+                if 'BUSYGROUP' not in str(e):
+                    raise
+
+    def acker(self, stream, entry_id):
+        def done(success):
+            # a failed entry stays pending; once idle for CLAIM_IDLE_MSECS claim_stuck delivers it again
+            if success:
+                self.ack_client.xack(stream, self.GROUP, entry_id)
+            self.in_flight.discard((stream, entry_id))
+        return done
+
+    async def retire_failing(self, stream, entries):
+        """
+        Moves entries that have been delivered more than MAX_DELIVERIES times to the stream's dead-letter stream.
+        :return: the remaining entries
+        """
+        pipeline = self.redis_client.pipeline(transaction=False)
+        for entry_id, _ in entries:
+            pipeline.xpending_range(stream, self.GROUP, min=entry_id, max=entry_id, count=1)
+        rv = []
+        for (entry_id, fields), pending in zip(entries, await pipeline.execute()):
+            if not fields or not pending or pending[0]['times_delivered'] <= self.MAX_DELIVERIES:
+                rv.append((entry_id, fields))
+                continue
+            print(f'Giving up on {stream} entry {entry_id} after {pending[0]["times_delivered"]} deliveries')
+            await self.redis_client.xadd(f'{stream}:dead', {'data': fields[b'data'], 'id': entry_id},
+                                         maxlen=self.DEAD_LETTER_MAXLEN, approximate=True)
+            await self.redis_client.xack(stream, self.GROUP, entry_id)
+            self.dead_letter_counter.labels(stream=stream).inc()
+        return rv
+
+    async def dispatch(self, stream, entries):
+        for entry_id, fields in entries:
+            if not fields:
+                # entry was trimmed while pending
+                self.ack_client.xack(stream, self.GROUP, entry_id)
+                continue
+            if (stream, entry_id) in self.in_flight:
+                continue
+            self.in_flight.add((stream, entry_id))
+            await self.pipeline.dispatch(stream, fields[b'data'], on_done=self.acker(stream, entry_id))
+
+    async def read_pending(self):
+        """
+        Redelivers entries this consumer read but never acknowledged, e.g. before a restart.
+        """
+        for stream in self.streams:
+            last_id = '0'
+            while True:
+                response = await self.redis_client.xreadgroup(self.GROUP, self.consumer, {stream: last_id},
+                                                              count=self.READ_COUNT)
+                entries = response[0][1] if response else []
+                if not entries:
+                    break
+                print(f'Resuming {len(entries)} pending entries from {stream}')
+                await self.dispatch(stream, entries)
+                last_id = entries[-1][0]
+
+    async def read(self):
+        await self.create_groups()
+        await self.read_pending()
+        while True:
+            try:
+                response = await self.redis_client.xreadgroup(
+                    self.GROUP, self.consumer, {stream: '>' for stream in self.streams},
+                    count=self.READ_COUNT, block=self.BLOCK_MSECS)
+            except redis.exceptions.ConnectionError as e:
+                print(f'Redis connection error: {e}. Retrying')
+                await asyncio.sleep(5)
+                continue
+            for stream, entries in response or []:
+                await self.dispatch(stream.decode('utf-8'), entries)
+
+    async def claim_stuck(self):
+        for stream in self.streams:
+            start_id = '0-0'
+            while True:
+                response = await self.redis_client.xautoclaim(stream, self.GROUP, self.consumer,
+                                                              min_idle_time=self.CLAIM_IDLE_MSECS,
+                                                              start_id=start_id, count=self.READ_COUNT)
+                start_id = response[0]
+                entries = [e for e in response[1] if (stream, e[0]) not in self.in_flight]
+                if entries:
+                    entries = await self.retire_failing(stream, entries)
+                if entries:
+                    self.claim_counter.labels(stream=stream).inc(len(entries))
+                    await self.dispatch(stream, entries)
+                if start_id in {b'0-0', '0-0'}:
+                    break
+
+    async def update_lag(self):
+        for stream in self.streams:
+            for group in await self.redis_client.xinfo_groups(stream):
+                if group['name'] not in {self.GROUP, self.GROUP.encode('utf-8')}:
+                    continue
+                if group.get('lag') is not None:
+                    self.lag_gauge.labels(stream=stream).set(group['lag'])
+                self.pending_gauge.labels(stream=stream).set(group['pending'])
+
+    async def maintain(self):
+        while True:
+            await asyncio.sleep(self.CLAIM_INTERVAL)
+            try:
+                await self.claim_stuck()
+                await self.update_lag()
+            except redis.exceptions.RedisError as e:
+                print(f'Stream maintenance error: {e}')
@@ -8,14 +8,16 @@ import asyncio
 import json
 import os
 import sys
+import threading
 import time
 from pathlib import Path
 
+import numpy as np
 import requests
 import shapely
 import sqlalchemy
-from geoalchemy2.shape import to_shape
-from sqlalchemy import select, func, text
+from sqlalchemy import select, func, update
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import Session
 import redis
 import redis.asyncio as redis_async
@@ -24,7 +26,14 @@ from prometheus_client import start_http_server, Counter
 from backend.util import Util
 from realtime.rtmodel import *
 from realtime.load_patterns import load_routes, S3Getter
-from realtime.redisclean import Cleaner
+from realtime.trajectories import TrajectoryBatch
+from realtime.dimensions import DimensionCache
+from realtime.partitions import PartitionManager
+from realtime.maintenance import Maintenance
+from realtime.trainstate import TrainPoint, RunTracker
+from realtime.pipeline import Pipeline
+from realtime.streams import StreamReader
+from realtime.replay import Replayer, LocalSource
 from interfaces import ureg, Q_
 
 from schedules.schedule_analyzer import ScheduleAnalyzer, ShapeManager
@@ -33,6 +42,7 @@ from schedules.schedule_analyzer import ScheduleAnalyzer, ShapeManager
 class DatabaseUpdater:
     def __init__(self, subscriber):
         self.subscriber = subscriber
+        self.dimensions: DimensionCache = subscriber.dimensions
         self.r = redis.Redis()
 
     def subscriber_callback(self, data):
@@ -66,6 +76,10 @@ class TrainUpdater(DatabaseUpdater):
                                                 'Train position missing in database error')
         self.invalid_position_counter = Counter('transit_train_position_invalid_error',
                                                 'Train position invalid in database error')
+        self.run_tracker = RunTracker()
+        # positions are tracked on the ttpositions worker; expiry runs from the maintenance thread
+        self.run_lock = threading.Lock()
+        self.rebuild_run_state()
         #self.refresh(hours=8)
 
 
@@ -87,82 +101,74 @@ class TrainUpdater(DatabaseUpdater):
      - detect pattern
      - assign new pattern id
     """
-    def find_finalized_trips(self):
-        finish_thresh = datetime.timedelta(minutes=5)
+    def rebuild_run_state(self):
+        """
+        Reloads the in-memory run tracker from uncompleted train positions, e.g. after a restart.
+        """
         with Session(self.subscriber.engine) as session:
-            local_now = Util.ctanow()
-            # only consider one run at a time
-            runs = {}
-            stmt = (select(TrainPosition)
-                    .join(Stop, TrainPosition.dest_station == Stop.id)
+            self.run_tracker.last_trip_id = session.query(func.max(TrainPosition.synthetic_trip_id)).scalar()
+            stmt = (select(TrainPosition.run, TrainPosition.timestamp, TrainPosition.rt, TrainPosition.dest_station,
+                           TrainPosition.dest_name, TrainPosition.direction, TrainPosition.next_stop,
+                           TrainPosition.next_stop_distance, TrainPosition.approaching,
+                           func.ST_X(TrainPosition.geom), func.ST_Y(TrainPosition.geom))
                     .where(TrainPosition.completed.is_(False))
-                    .where(func.ST_Distance(
-                            Stop.geom.ST_Transform(26916), TrainPosition.geom.ST_Transform(26916)
-                        ) < 1000
-                        )
-                    .order_by(TrainPosition.run, TrainPosition.timestamp)
-                    )
-            try:
-                for pos in session.scalars(stmt):
-                    key = (pos.run, pos.dest_name, pos.direction)
-                    previous = runs.get(key)
-                    if not previous or pos.timestamp > previous.timestamp:
-                        runs[key] = pos
-            except sqlalchemy.exc.InternalError as e:
-                print(f'Internal error: {e}')
-            count = 0
-            succeeded = 0
-            for k, v in runs.items():
-                count += 1
-                #print(f'Found {v.run} ts {v.timestamp.isoformat()}')
-                ts = v.timestamp.replace(tzinfo=Util.CTA_TIMEZONE)
-                update_age = local_now - ts
-                if update_age < finish_thresh:
-                    #print(f'Skipping fresh update for {k}')
-                    continue
-                success = self.finalize_trip(session, v)
-                if success:
-                    succeeded += 1
+                    .order_by(TrainPosition.run, TrainPosition.timestamp))
+            for row in session.execute(stmt):
+                self.track_position(TrainPoint(*row))
+        print(f'Rebuilt run state with {len(self.run_tracker)} pending train positions')
+
+    def track_position(self, point: TrainPoint):
+        dest_distance = None
+        dest_stop = self.dimensions.get_stop(point.dest_station)
+        if dest_stop:
+            dest_distance = ShapeManager.geom_distance(shapely.Point(point.lon, point.lat), dest_stop[1])
+        self.run_tracker.add(point, dest_distance)
+
+    def find_finalized_trips(self):
+        """
+        Finalizes the trips the run tracker reports as finished. Runs without a finished trip don't touch
+        the database.
+        """
+        finished = self.run_tracker.pop_finished(Util.ctanow())
+        if not finished:
+            return
+        history = TrajectoryBatch(self.r, self.redis_position_counter, self.redis_position_error)
+        with Session(self.subscriber.engine) as session:
+            for end_position in finished:
+                points = self.run_tracker.take_points(end_position.run, end_position.timestamp)
+                if points:
+                    # taken points leave the tracker for good, so their rows are closed too: points of an
+                    # earlier leg, outliers and trips too short to keep would otherwise stay uncompleted and
+                    # come back on the next rebuild. finalize_trip then fills in the trip's own rows.
+                    session.execute(update(TrainPosition), [
+                        {'run': end_position.run, 'timestamp': p.timestamp, 'completed': True} for p in points
+                    ])
+                self.finalize_trip(session, end_position, points, history)
             session.commit()
+        history.execute()
 
-    def finalize_trip(self, session, end_position):
+    def finalize_trip(self, session, end_position: TrainPoint, points: list[TrainPoint], history: TrajectoryBatch):
         run = end_position.run
-        # may want to use an ORM join but let's try this for now
-        stmt = (select(TrainPosition)
-                .where(TrainPosition.run == run)
-                .where(TrainPosition.completed.is_(False))
-                .where(TrainPosition.timestamp <= end_position.timestamp)
-                .order_by(TrainPosition.timestamp))
-        points = session.scalars(stmt).all()
         if not points:
             return None
         # process outliers
         run_length = 0
         prev_key = None
-        elide = []
+        elide = set([])
         first_run = True
         # also detect big time gaps here
         for i, p in enumerate(points):
-            key = (p.rt, p.dest_station, p.dest_name, p.direction)
+            key = p.key()
             if prev_key and prev_key != key:
                 if run_length == 1 and not first_run:
-                    elide.append(i - 1)
+                    elide.add(i - 1)
                 run_length = 0
                 first_run = False
             run_length += 1
             prev_key = key
-        p = points[0]
-        #if len(elide) > 1:
-        #    print(f'Too many outliers in {p.rt} {p.run} {p.timestamp.isoformat()} with {len(points)} points: {elide}')
-        #    return None
-        removed = 0
-        for e in elide:
-            remove_index = e - removed
-            removed += 1
-            points[remove_index].completed = True
-            points.pop(remove_index)
-        if removed > 0:
-            session.commit()
+        if elide:
+            # already marked completed by find_finalized_trips
+            points = [p for i, p in enumerate(points) if i not in elide]
         prev_dest_name = points[-1].dest_name
         start_position = None
         i = len(points) - 1
@@ -182,126 +188,95 @@ class TrainUpdater(DatabaseUpdater):
         if start_position is None:
             i = 0
             start_position = points[0]
-        if end_position.route.id in {'y', 'p'}:
+        if end_position.rt in {'y', 'p'}:
             min_points = 4
         else:
             min_points = 7
         if len(points[i:]) <= min_points:
             #print(f'Not enough points for trip {run} ts {end_position.timestamp.isoformat()}')
             return None
-        stop_name = session.get(Stop, points[i].next_stop).stop_name
-        end_stop_name = session.get(Stop, points[-1].next_stop).stop_name
+        stop_name, _ = self.dimensions.get_stop(points[i].next_stop) or (None, None)
+        end_stop_name, _ = self.dimensions.get_stop(points[-1].next_stop) or (None, None)
         #print(f'Looking for pattern (run {run}) from stop {stop_name} to {end_stop_name} with {len(points)} points index {i}')
 
-        stmt = (session.query(TrainPatternDetail, Stop, func.ST_Distance(
-                    Stop.geom.ST_Transform(26916), func.ST_Transform(start_position.geom, 26916)
-                    ).label('stop_dist'))
-                .join(Stop, TrainPatternDetail.first_stop_id == Stop.id)
-                .where(TrainPatternDetail.route_id == end_position.rt)
-                .where(TrainPatternDetail.last_stop_id == end_position.dest_station)
-                .where(TrainPatternDetail.pattern_id.not_in({308500036, 308500102}))
-                #.where(text('stop_dist < 1000')
-                    #)
-                )
-        pattern_result = stmt.all()
-        pattern_id = None
-        duplicate = False
+        start_point = shapely.Point(start_position.lon, start_position.lat)
+        pattern_id, pattern_result = self.schedule_analyzer.pattern_matcher.match_run(
+            end_position.rt, end_position.dest_station, start_point)
         dists = [999999999999]
         first_stop = None
         last_stop = None
-        match = None
-        for pr, stop, d in pattern_result:
-            #print(f' Pattern result: {pr.pattern_id} stop {stop.stop_name} dist {d}')
-            #print(f'  md: {type(pr)} {dir(pr)}')
+        for pr, d in pattern_result:
             dists.append(d)
             first_stop = pr.first_stop_name
             last_stop = pr.last_stop_name
-            if d < 4000:
-                if match is not None:
-                    if d >= match[2]:
-                        continue
-                match = (pr, stop, d)
-        if match:
-            pattern_id = match[0].pattern_id
-        else:
-            pattern_id = None
-        next_trip_id = session.query(func.max(TrainPosition.synthetic_trip_id)).scalar()
-        if next_trip_id is None:
-            next_trip_id = 0
-        else:
-            next_trip_id += 1
+        next_trip_id = self.run_tracker.next_trip_id()
 
         if pattern_id is None:
-            print(f'No p match run {end_position.run} rt {end_position.route.id} starting at {start_position.timestamp.isoformat()}: '
+            print(f'No p match run {end_position.run} rt {end_position.rt} starting at {start_position.timestamp.isoformat()}: '
                   f'patterns {len(pattern_result)} points {len(points[i:])} min dist {min(dists)} '
                   f'pat {first_stop}-{last_stop} pt {stop_name}-{end_stop_name}')
-            for point in points[i:]:
-                point.synthetic_trip_id = next_trip_id
-                point.completed = True
-            session.commit()
+            session.execute(update(TrainPosition), [
+                {'run': run, 'timestamp': point.timestamp, 'synthetic_trip_id': next_trip_id, 'completed': True}
+                for point in points[i:]
+            ])
             return False
+        updates = []
+        succeeded = False
         try:
             # get pattern stops
-            pattern_stmt = (select(PatternStop)
-                            .where(PatternStop.pattern_id == int(pattern_id)))
             stop_distances = {}
-            for ps in session.scalars(pattern_stmt):
-                stop_distances[ps.stop_id] = ps.distance
-
-            debug = run == 409
-            # if current.current_pattern is None:
-            #     print(f'Error finding pattern for run {run}')
-            #     continue
-            #pattern_id = pattern_result[0].pattern_id
+            for stop_id, (_, distance, _, _) in (self.dimensions.get_pattern_stops(int(pattern_id)) or {}).items():
+                stop_distances[stop_id] = distance
+
             shape_manager = self.schedule_analyzer.managed_shapes[pattern_id]
-            previous_distance = 0
-            previous_larger = False
             # clean up and discard outliers
+            projected = []
             for point in points[i:]:
-                train_point = to_shape(point.geom)
-                #train_distance = shape_manager.get_distance_along_shape(previous_distance, train_point, debug=debug)
-                point.pattern = pattern_id
-                point.synthetic_trip_id = next_trip_id
-                point.completed = True
+                values = {'run': run, 'timestamp': point.timestamp, 'pattern': pattern_id,
+                          'synthetic_trip_id': next_trip_id, 'completed': True, 'pattern_distance': None}
+                updates.append(values)
 
-                if point.next_stop_distance < 100 and not point.approaching:
+                if point.next_stop_distance is not None and point.next_stop_distance < 100 and not point.approaching:
                     # insert into error table
                     continue
 
                 stop_pattern_distance = stop_distances.get(point.next_stop)
                 if stop_pattern_distance is None:
-                    print(f'Warning: couldn\'t find stop pattern distance for stop {point.next_stop} pattern {pattern_id} computing trip {next_trip_id} at {point.timestamp.isoformat()}. Using fallback (prev larger {previous_larger})')
+                    print(f'Warning: couldn\'t find stop pattern distance for stop {point.next_stop} pattern {pattern_id} computing trip {next_trip_id} at {point.timestamp.isoformat()}. Using fallback')
                     #continue
-
-                previous_larger, train_distance = shape_manager.get_distance_along_shape_anchor(stop_pattern_distance, train_point, previous_larger)
-                point.pattern_distance = train_distance
-
-                redis_key = f'trainposition:{pattern_id}:{run}-{next_trip_id}'
-                if not self.r.exists(redis_key):
-                    self.r.ts().create(redis_key, retention_msecs=60 * 60 * 24 * 1000)
-                self.r.ts().add(redis_key, int(point.timestamp.timestamp()), train_distance)
-                self.redis_position_counter.inc()
-            return True
-        except redis.exceptions.ResponseError as e:
-            print(f'Redis summarizer error: {e}')
-            self.redis_position_error.inc()
+                projected.append((values, point, stop_pattern_distance))
+
+            lons = np.array([point.lon for _, point, _ in projected])
+            lats = np.array([point.lat for _, point, _ in projected])
+            anchors = np.array([np.nan if d is None else d for _, _, d in projected])
+            _, train_distances = shape_manager.get_distances_along_shape_anchor(lons, lats, anchors)
+
+            redis_key = f'trainposition:{pattern_id}:{run}-{next_trip_id}'
+            labels = TrajectoryBatch.trip_labels('train', pattern_id, end_position.rt, f'{run}-{next_trip_id}',
+                                                 int(points[i].timestamp.timestamp()))
+            for (values, point, _), train_distance in zip(projected, train_distances):
+                train_distance = float(train_distance)
+                values['pattern_distance'] = train_distance
+                history.add(redis_key, int(point.timestamp.timestamp()), train_distance, labels=labels)
+            succeeded = True
         except KeyError as e:
             print(f'Bad pattern: {e}')
         except shapely.errors.GEOSException as e:
             print(f'GEOS error: {e}')
-        return False
+        if updates:
+            session.execute(update(TrainPosition), updates)
+        return succeeded
 
     def subscriber_callback(self, data):
         #print(f'Finding finalized trips data len {len(str(data))}')
         self.position_bundle_counter.inc()
-        self.find_finalized_trips()
+        new_positions = []
         with Session(self.subscriber.engine) as session:
             routes = data['route']
             for route in routes:
                 rt = route['@name']
-                route_db = session.get(Route, rt)
-                if route_db is None:
-                    print(f'Unknown route {route_db}')
+                if not self.dimensions.has_route(rt):
+                    print(f'Unknown route {rt}')
                     self.route_error_counter.inc()
                     continue
                 if 'train' not in route:
@@ -343,15 +318,16 @@ class TrainUpdater(DatabaseUpdater):
                         delayed=int(v['isDly']),
                         geom=geom,
                         heading=int(v['heading']),
-                        route=route_db,
+                        rt=rt,
                         completed=False,
                     )
                     session.add(upd)
+                    new_positions.append((upd, lon, lat))
                     self.position_counter_success.inc()
-                    next_stop = session.get(Stop, upd.next_stop)
+                    next_stop = self.dimensions.get_stop(upd.next_stop)
                     if next_stop:
                         llpoint = shapely.Point(lon, lat)
-                        upd.next_stop_distance = ShapeManager.geom_distance(llpoint, to_shape(next_stop.geom))
+                        upd.next_stop_distance = ShapeManager.geom_distance(llpoint, next_stop[1])
                     current = session.get(CurrentTrainState, run)
                     if not current:
                         current = CurrentTrainState(
@@ -374,7 +350,7 @@ class TrainUpdater(DatabaseUpdater):
                     current.delayed = int(v['isDly'])
                     current.geom = geom
                     current.heading = int(v['heading'])
-                    current.route = route_db
+                    current.rt = rt
                     #train_point = shapely.Point(lon, lat)
                     # start_of_trip = None
                     if current.update_count is None:
@@ -383,7 +359,20 @@ class TrainUpdater(DatabaseUpdater):
                         dest_station = 30069
                     current.dest_station = dest_station
                     upd.dest_station = dest_station
+            points = [TrainPoint(upd.run, upd.timestamp, upd.rt, upd.dest_station, upd.dest_name, upd.direction,
+                                 upd.next_stop, upd.next_stop_distance, upd.approaching, lon, lat)
+                      for upd, lon, lat in new_positions]
             session.commit()
+        for point in points:
+            self.subscriber.maintenance.trains.seen(point.run, point.timestamp)
+        with self.run_lock:
+            for point in points:
+                self.track_position(point)
+            self.find_finalized_trips()
+
+    def expire_runs(self):
+        with self.run_lock:
+            self.run_tracker.expire(Util.ctanow().replace(tzinfo=None))
 
     def prediction_callback(self, data):
         self.prediction_bundle_counter.inc()
@@ -417,12 +406,9 @@ class TrainUpdater(DatabaseUpdater):
 
 
 class BusUpdater(DatabaseUpdater):
-    def __init__(self, *args):
+    def __init__(self, *args, bulk_ingest=False):
         super().__init__(*args)
-        self.cleanup_iteration = 0
-        self.cleanup_counter = Counter('transit_bus_cleanup_base', 'Standard cleanup run')
-        self.cleanup_position_counter = Counter('transit_bus_cleanup_position', 'Clean up positions')
-        self.cleanup_redis_counter = Counter('transit_bus_cleanup_redis', 'Clean up old redis entries')
+        self.bulk_ingest = bulk_ingest
         self.prediction_bundle_counter = Counter('transit_bus_prediction_bundle',
                                                  'Bundles of bus predictions')
         self.prediction_counter = Counter('transit_bus_prediction_individual', 'Individual bus predictions')
@@ -443,45 +429,6 @@ class BusUpdater(DatabaseUpdater):
         self.missing_position_counter = Counter('transit_bus_position_missing_error',
                                                 'Bus position missing in database error')
 
-    def periodic_cleanup(self):
-        """
-        select count(*) from active_trip where (now() at time zone 'America/Chicago' - active_trip.timestamp) > make_interval(hours => 24);
-
-        select count(*) from current_vehicle_state where ((select max(last_update) from current_vehicle_state) - current_vehicle_state.last_update) > make_interval(mins => 5);
-        update bus_position set completed = true where origtatripno not in (select origtatripno from current_vehicle_state);
-        :return:
-        """
-        start = datetime.datetime.now()
-        self.cleanup_counter.inc()
-        with Session(self.subscriber.engine) as session:
-            session.execute(text('DELETE from current_vehicle_state where ((select max(last_update) from '
-                                 'current_vehicle_state) - current_vehicle_state.last_update)'
-                                 ' > make_interval(mins => 5)'))
-            session.execute(text('DELETE from current_train_state where ((select max(last_update) from '
-                                 'current_train_state) - current_train_state.last_update)'
-                                 ' > make_interval(mins => 10)'))
-            #session.execute(text('update bus_position set completed = true where origtatripno not in '
-            #                     '(select origtatripno from current_vehicle_state)'))
-            session.execute(text('UPDATE pattern t2 SET rt = t1.rt '
-                                 'FROM bus_position t1 WHERE t2.id = t1.pid'))
-            if self.cleanup_iteration % 10 == 0:
-                self.cleanup_position_counter.inc()
-                session.execute(text('delete from bus_position where timestamp < '
-                                     '(select max(timestamp) - interval \'24 hours\' from bus_position)'))
-                session.execute(text('delete from train_position where timestamp < '
-                                     '(select max(timestamp) - interval \'24 hours\' from train_position)'))
-            self.cleanup_iteration += 1
-            session.commit()
-        if self.cleanup_iteration % 500 == 0:
-            self.cleanup_redis_counter.inc()
-            host = None
-            print(f'  Cleaning up redis {host}')
-            c = Cleaner(host=host)
-            c.clean()
-        finish = datetime.datetime.now()
-        td = finish - start
-        print(f'Cleanup run {self.cleanup_iteration} took {td}')
-
     def finish_past_trips(self):
         with Session(self.subscriber.engine) as session:
             vids = select(BusPosition.vid, func.min(BusPosition.timestamp).label("ts")).group_by(BusPosition.vid).order_by("ts", "vid")
@@ -566,9 +513,24 @@ class BusUpdater(DatabaseUpdater):
                     v['tmstmp'], '%Y%m%d %H:%M')
             session.commit()
 
+    def new_history_batch(self):
+        return TrajectoryBatch(self.r, self.redis_position_counter, self.redis_position_error)
+
+    @staticmethod
+    def record_history(history, pid, rt, origtatripno, timestamp, pdist):
+        bus_position = Q_(int(pdist), 'ft')
+        redis_key = f'busposition:{pid}:{origtatripno}'
+        # labels only take effect when the sample creates the series, so start is the trip's first sample
+        history.add(redis_key, int(timestamp.timestamp()), bus_position.to(ureg.meters).m,
+                    labels=TrajectoryBatch.trip_labels('bus', pid, rt, origtatripno, int(timestamp.timestamp())))
+
     def subscriber_callback(self, data):
         #print(f'Bus {len(data)}')
         #self.finish_past_trips()
+        if self.bulk_ingest:
+            self.bulk_subscriber_callback(data)
+            return
+        history = self.new_history_batch()
         with Session(self.subscriber.engine) as session:
             self.position_bundle_counter.inc()
             for v in data:
@@ -576,8 +538,8 @@ class BusUpdater(DatabaseUpdater):
                 vid = int(v['vid'])
                 timestamp = datetime.datetime.strptime(v['tmstmp'], '%Y%m%d %H:%M:%S')
                 existing = session.get(BusPosition, {'vid': vid, 'timestamp': timestamp})
-                route = session.get(Route, v['rt'])
-                if route is None:
+                route = v['rt']
+                if not self.dimensions.has_route(route):
                     print(f'Unknown route {route}')
                     self.route_error_counter.inc()
                     continue
@@ -592,6 +554,7 @@ class BusUpdater(DatabaseUpdater):
                     self.duplicate_key_counter.inc()
                     continue
                 self.position_counter_success.inc()
+                self.subscriber.maintenance.vehicles.seen(vid, timestamp)
                 upd = BusPosition(
                     vid=vid,
                     timestamp=timestamp,
@@ -599,7 +562,7 @@ class BusUpdater(DatabaseUpdater):
                     #lon=float(v['lon']),
                     geom=geom,
                     pid=v['pid'],
-                    route=route,
+                    rt=route,
                     pdist=v['pdist'],
                     tatripid=v['tatripid'],
                     origtatripno=v['origtatripno'],
@@ -607,26 +570,10 @@ class BusUpdater(DatabaseUpdater):
                     destination=v['des'],
                     completed=False
                 )
-                bus_position = Q_(int(v['pdist']), 'ft')
-                redis_key = f'busposition:{v["pid"]}:{v["origtatripno"]}'
-                try:
-                    if not self.r.exists(redis_key):
-                        self.r.ts().create(redis_key, retention_msecs=60 * 60 * 24 * 1000)
-                    self.r.ts().add(redis_key, int(timestamp.timestamp()), bus_position.to(ureg.meters).m)
-                    self.redis_position_counter.inc()
-                except redis.exceptions.ResponseError as e:
-                    print(f'Redis summarizer error: {e}')
-                    self.redis_position_error.inc()
+                self.record_history(history, v['pid'], v['rt'], v['origtatripno'], timestamp, v['pdist'])
                 session.add(upd)
-                pattern = session.get(Pattern, v['pid'])
-                if pattern is None:
-                    pattern = Pattern(
-                        id=v['pid'],
-                        updated=datetime.datetime.fromtimestamp(0),
-                        route=route,
-                        length=0,
-                    )
-                    session.add(pattern)
+                pattern = int(v['pid'])
+                self.dimensions.ensure_patterns(session, {pattern: route})
                 existing_state = session.get(CurrentVehicleState, vid)
                 if not existing_state:
                     current_state = CurrentVehicleState(
@@ -635,10 +582,10 @@ class BusUpdater(DatabaseUpdater):
                         #lat=float(v['lat']),
                         #lon=float(v['lon']),
                         geom=geom,
-                        route=route,
+                        rt=route,
                         distance=v['pdist'],
                         origtatripno=v['origtatripno'],
-                        pattern=pattern,
+                        pid=pattern,
                         destination=v['des'],
                     )
                     session.add(current_state)
@@ -646,24 +593,149 @@ class BusUpdater(DatabaseUpdater):
                     existing_state.last_update = timestamp
                     existing_state.lat = float(v['lat'])
                     existing_state.lon = float(v['lon'])
-                    existing_state.route = route
+                    existing_state.rt = route
                     existing_state.distance = v['pdist']
                     existing_state.origtatripno = v['origtatripno']
-                    existing_state.pattern = pattern
+                    existing_state.pid = pattern
                     existing_state.destination = v['des']
             session.commit()
+        history.execute()
+
+    def bulk_subscriber_callback(self, data):
+        """
+        Set-based version of subscriber_callback. The whole bundle is written with one insert each for
+        patterns, positions and current vehicle state instead of several round trips per vehicle.
+        Duplicate positions are dropped by the primary key and stale current state by the last_update
+        guard, so no per-row lookups are needed.
+        """
+        self.position_bundle_counter.inc()
+        positions = {}
+        for v in data:
+            self.position_counter_total.inc()
+            vid = int(v['vid'])
+            timestamp = datetime.datetime.strptime(v['tmstmp'], '%Y%m%d %H:%M:%S')
+            key = (vid, timestamp)
+            if key in positions:
+                self.duplicate_key_counter.inc()
+                continue
+            positions[key] = {
+                'vid': vid,
+                'timestamp': timestamp,
+                'geom': f'POINT({v["lon"]} {v["lat"]})',
+                'pid': int(v['pid']),
+                'rt': v['rt'],
+                'pdist': int(v['pdist']),
+                'tatripid': v['tatripid'],
+                'origtatripno': v['origtatripno'],
+                'tablockid': v['tablockid'],
+                'destination': v['des'],
+                'completed': False,
+            }
+        if not positions:
+            return
+        with Session(self.subscriber.engine) as session:
+            rows = []
+            for p in positions.values():
+                if not self.dimensions.has_route(p['rt']):
+                    print(f'Unknown route {p["rt"]}')
+                    self.route_error_counter.inc()
+                    continue
+                rows.append(p)
+            if not rows:
+                return
+
+            patterns = {}
+            for p in rows:
+                patterns.setdefault(p['pid'], p['rt'])
+            self.dimensions.ensure_patterns(session, patterns)
+
+            position_stmt = (insert(BusPosition).values(rows)
+                             .on_conflict_do_nothing(index_elements=[BusPosition.vid, BusPosition.timestamp])
+                             .returning(BusPosition.vid, BusPosition.timestamp))
+            inserted = set(session.execute(position_stmt).tuples())
+            self.position_counter_success.inc(len(inserted))
+            self.missing_position_counter.inc(len(rows) - len(inserted))
+
+            latest = {}
+            for p in rows:
+                previous = latest.get(p['vid'])
+                if previous is None or p['timestamp'] > previous['timestamp']:
+                    latest[p['vid']] = p
+            state_rows = [{
+                'id': p['vid'],
+                'last_update': p['timestamp'],
+                'geom': p['geom'],
+                'pid': p['pid'],
+                'rt': p['rt'],
+                'distance': p['pdist'],
+                'origtatripno': p['origtatripno'],
+                'destination': p['destination'],
+            } for p in latest.values()]
+            state_stmt = insert(CurrentVehicleState).values(state_rows)
+            excluded = state_stmt.excluded
+            state_stmt = state_stmt.on_conflict_do_update(
+                index_elements=[CurrentVehicleState.id],
+                set_={
+                    'last_update': excluded.last_update,
+                    'geom': excluded.geom,
+                    'pid': excluded.pid,
+                    'rt': excluded.rt,
+                    'distance': excluded.distance,
+                    'origtatripno': excluded.origtatripno,
+                    'destination': excluded.destination,
+                },
+                where=CurrentVehicleState.last_update < excluded.last_update
+            )
+            session.execute(state_stmt)
+            session.commit()
+        for vid, p in latest.items():
+            self.subscriber.maintenance.vehicles.seen(vid, p['timestamp'])
+
+        history = self.new_history_batch()
+        for p in rows:
+            if (p['vid'], p['timestamp']) in inserted:
+                self.record_history(history, p['pid'], p['rt'], p['origtatripno'], p['timestamp'], p['pdist'])
+        history.execute()
 
 
 class Subscriber:
     def __init__(self, host, schedule_analyzer):
         self.host = host
         self.engine = db_init(Config('local'))
+        self.partitions = PartitionManager(self.engine)
+        self.partitions.maintain()
+        self.dimensions = DimensionCache(self.engine)
+        self.dimensions.refresh()
         schedule_analyzer.engine = self.engine
         self.train_updater = TrainUpdater(self, schedule_analyzer=schedule_analyzer)
-        self.bus_updater = BusUpdater(self)
+        self.bus_updater = BusUpdater(self, bulk_ingest=Util.env_flag('BULK_INGEST'))
         self.redis_client = redis_async.Redis(host=self.host)
+        self.maintenance = Maintenance(self)
+        self.pipeline = self.create_pipeline()
+        self.use_streams = os.getenv('TRANSPORT', 'pubsub') == 'streams'
+        self.stream_reader = StreamReader(self.host, self.redis_client, self.pipeline)
         self.handle_refresh()
 
+    def create_pipeline(self):
+        maxsize = int(os.getenv('SUBSCRIBER_QUEUE_SIZE', '100'))
+        pipeline = Pipeline()
+        pipeline.add_topic('getvehicles', self.handler, maxsize, coalesce_key=self.vehicle_routes)
+        pipeline.add_topic('getpredictions', self.handler, maxsize)
+        pipeline.add_topic('ttpositions', self.handler, maxsize)
+        pipeline.add_topic('ttarrivals', self.handler, maxsize)
+        return pipeline
+
+    @staticmethod
+    def vehicle_routes(data):
+        """
+        :return: the routes a getvehicles bundle was requested for, or None if unknown; a later bundle for the
+          same routes supersedes it
+        """
+        routes = frozenset(item.get('request_args', {}).get('rt') for item in data)
+        if not routes or None in routes:
+            return None
+        return routes
+
     def handle_refresh(self):
         hours = os.getenv('REFRESH_HOURS')
         if hours is None:
@@ -683,35 +755,26 @@ class Subscriber:
         if not cmds:
             print(f'Empty command set. Not refreshing')
         now = Util.utcnow()
-        getter = S3Getter()
-        for x in reversed(range(hours)):
-            dt = now - datetime.timedelta(hours=x)
-            daystr = dt.strftime("%Y%m%d")
-            for cmd in cmds:
-                self.s3_refresh(getter, cmd, daystr, dt.hour)
-        getter.stats()
-
-    def s3_refresh(self, getter, cmd, daystr, hour):
-        #cmd = 'ttpositions.aspx'
-        prefix = f'bustracker/raw/{cmd}/{daystr}/t{hour:02d}'
-        print(f'Getting prefix {prefix}')
-        keys = getter.list_with_prefix(prefix)
-        refreshed = 0
-        for k in keys.get('Contents', []):
-            #print(f'Refreshing {k["Key"]}')
-            jd = getter.get_json_contents(k['Key'])
-            datalist = jd['requests']
-            refreshed += 1
-            self.handler(datalist, cmd)
-            # for item in datalist:
-            #     response = item['response']
-            #     self.subscriber_callback(response['ctatt'])
-        return {'refreshed': refreshed}
-
-    async def periodic_cleanup(self):
+        replay_dir = os.getenv('REPLAY_DIR')
+        if replay_dir:
+            source = LocalSource(Path(replay_dir))
+        else:
+            source = S3Getter()
+        replayer = Replayer(source, self.handler, workers=int(os.getenv('REPLAY_WORKERS', '8')))
+        # replayed bundles overlap heavily with what's already stored; the bulk path handles that with
+        # ON CONFLICT instead of checking each row
+        bulk = Util.env_flag('REPLAY_BULK', default=True)
+        saved_bulk = self.bus_updater.bulk_ingest
+        self.bus_updater.bulk_ingest = saved_bulk or bulk
+        try:
+            return replayer.replay(cmds, now - datetime.timedelta(hours=hours - 1), hours)
+        finally:
+            self.bus_updater.bulk_ingest = saved_bulk
+
+    async def refresh_dimensions(self):
         while True:
-            self.bus_updater.periodic_cleanup()
             await asyncio.sleep(60)
+            await asyncio.to_thread(self.dimensions.maybe_refresh)
 
     def handler(self, data, topic):
         print(f'Received {topic} data len {len(str(data))} first {str(data)[:100]}')
@@ -736,21 +799,26 @@ class Subscriber:
             return
         train_bundle = response.json()['train_bundle']
         for k, v in train_bundle.items():
-            self.handler(v, f'catchup-{k}')
+            self.pipeline.submit(f'catchup-{k}', v)
         response = requests.get(f'http://{self.host}:8002/bus-bundle')
         if response.status_code != 200:
             print(f'Error getting bus bundle: {response.status_code}')
             return
         bus_bundle = response.json()['bus_bundle']
         for k, v in bus_bundle.items():
-            self.handler(v, f'catchup-{k}')
+            self.pipeline.submit(f'catchup-{k}', v)
 
     async def catchup_wrapper(self):
         print('catching up')
-        self.catchup()
+        await asyncio.to_thread(self.catchup)
         print('caught up')
 
     async def start_clients(self):
+        """
+        Reads pubsub messages and hands the raw payloads to the pipeline; parsing and database work happen on
+        the topic workers.
+        """
+        self.pipeline.start()
         while True:
             print(f'Creating subscriber task')
             print(f'Starting listener')
@@ -760,15 +828,25 @@ class Subscriber:
             print(f'Starting async')
             while True:
                 try:
-                    message = await pubsub.get_message(ignore_subscribe_messages=True)
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
                 except redis.exceptions.ConnectionError as e:
                     print(f'Redis connection error: {e}. Retrying')
-                    time.sleep(5)
+                    await asyncio.sleep(5)
                     break
                 if message is not None:
                     channel = message['channel'].decode('utf-8')
-                    data = message['data'].decode('utf-8')
-                    self.handler(json.loads(data), channel)
+                    await self.pipeline.dispatch(channel, message['data'])
+
+
+    async def start_stream_clients(self):
+        """
+        Stream transport equivalent of start_clients, resuming from the consumer group's position.
+        """
+        self.pipeline.start()
+        print(f'Reading streams as consumer {self.stream_reader.consumer}')
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(self.stream_reader.read())
+            tg.create_task(self.stream_reader.maintain())
 
 
 async def main(host: str):
@@ -779,12 +857,15 @@ async def main(host: str):
     schedule_analyzer = ScheduleAnalyzer(schedule_file, engine=None)
     subscriber = Subscriber(host, schedule_analyzer)
     async with asyncio.TaskGroup() as tg:
-        client_task = tg.create_task(subscriber.start_clients())
-        catchup_task = tg.create_task(subscriber.catchup_wrapper())
-        cleanup_task = tg.create_task(subscriber.periodic_cleanup())
+        if subscriber.use_streams:
+            # the consumer group position replaces the bundle catchup
+            client_task = tg.create_task(subscriber.start_stream_clients())
+        else:
+            client_task = tg.create_task(subscriber.start_clients())
+            tg.create_task(subscriber.catchup_wrapper())
+        tg.create_task(subscriber.refresh_dimensions())
+        subscriber.maintenance.start()
     print(client_task.result())
-    print(cleanup_task.result())
-    print(catchup_task.result())
     print(f'Tasks finished.')
 
 
@@ -0,0 +1,126 @@
+import bisect
+import datetime
+
+from backend.util import Util
+
+
+class TrainPoint:
+    """
+    The subset of a train_position row needed to detect and finalize trips, kept in memory per run.
+    """
+    __slots__ = ('run', 'timestamp', 'rt', 'dest_station', 'dest_name', 'direction', 'next_stop',
+                 'next_stop_distance', 'approaching', 'lon', 'lat')
+
+    def __init__(self, run, timestamp, rt, dest_station, dest_name, direction, next_stop,
+                 next_stop_distance, approaching, lon, lat):
+        self.run = run
+        self.timestamp = timestamp
+        self.rt = rt
+        self.dest_station = dest_station
+        self.dest_name = dest_name
+        self.direction = direction
+        self.next_stop = next_stop
+        self.next_stop_distance = next_stop_distance
+        self.approaching = approaching
+        self.lon = float(lon)
+        self.lat = float(lat)
+
+    def key(self):
+        return self.rt, self.dest_station, self.dest_name, self.direction
+
+    def wkt(self):
+        return f'POINT({self.lon} {self.lat})'
+
+
+class RunTracker:
+    """
+    Incremental trip-end detection for trains. Each new position is added to its run; a position within
+    DESTINATION_RADIUS meters of its destination station becomes that run's end candidate for the
+    (dest_name, direction) pair. Once a candidate hasn't been superseded for FINISH_THRESH the trip is
+    reported as finished along with the run's pending points up to that position.
+
+    This replaces rescanning every uncompleted train_position row on each update, so the work done per
+    message depends only on the new points. The state can be rebuilt by replaying uncompleted rows.
+    """
+    FINISH_THRESH = datetime.timedelta(minutes=5)
+    DESTINATION_RADIUS = 1000
+    MAX_AGE = datetime.timedelta(hours=24)
+
+    def __init__(self):
+        # run -> pending points ordered by timestamp
+        self.points = {}
+        # (run, dest_name, direction) -> latest point near the destination station
+        self.candidates = {}
+        self.last_trip_id = None
+
+    def __len__(self):
+        return sum(len(v) for v in self.points.values())
+
+    def add(self, point: TrainPoint, dest_distance):
+        points = self.points.setdefault(point.run, [])
+        if not points or points[-1].timestamp < point.timestamp:
+            points.append(point)
+        else:
+            timestamps = [p.timestamp for p in points]
+            index = bisect.bisect_left(timestamps, point.timestamp)
+            if index < len(points) and points[index].timestamp == point.timestamp:
+                return
+            points.insert(index, point)
+        if dest_distance is None or dest_distance >= self.DESTINATION_RADIUS:
+            return
+        key = (point.run, point.dest_name, point.direction)
+        previous = self.candidates.get(key)
+        if not previous or point.timestamp > previous.timestamp:
+            self.candidates[key] = point
+
+    def pop_finished(self, local_now: datetime.datetime) -> list[TrainPoint]:
+        """
+        :param local_now: current Chicago time
+        :return: end positions of trips that are finished, oldest first
+        """
+        finished = []
+        for key, end_position in list(self.candidates.items()):
+            ts = end_position.timestamp.replace(tzinfo=Util.CTA_TIMEZONE)
+            if local_now - ts < self.FINISH_THRESH:
+                continue
+            del self.candidates[key]
+            finished.append(end_position)
+        finished.sort(key=lambda p: p.timestamp)
+        return finished
+
+    def take_points(self, run, timestamp) -> list[TrainPoint]:
+        """
+        Removes and returns the pending points for a run up to and including timestamp. The caller marks their
+        rows completed, so a rebuild from uncompleted rows agrees with the tracker.
+        """
+        points = self.points.get(run, [])
+        index = bisect.bisect_right([p.timestamp for p in points], timestamp)
+        taken = points[:index]
+        remaining = points[index:]
+        if remaining:
+            self.points[run] = remaining
+        else:
+            self.points.pop(run, None)
+        return taken
+
+    def next_trip_id(self):
+        if self.last_trip_id is None:
+            self.last_trip_id = 0
+        else:
+            self.last_trip_id += 1
+        return self.last_trip_id
+
+    def expire(self, now: datetime.datetime):
+        """
+        Drops pending points older than MAX_AGE; these have been removed from the database by then.
+        """
+        thresh = now - self.MAX_AGE
+        for run in list(self.points.keys()):
+            points = [p for p in self.points[run] if p.timestamp >= thresh]
+            if points:
+                self.points[run] = points
+            else:
+                del self.points[run]
+        for key, point in list(self.candidates.items()):
+            if point.timestamp < thresh:
+                del self.candidates[key]
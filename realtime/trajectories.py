@@ -0,0 +1,65 @@
+import redis
+
+
+class TrajectoryBatch:
+    """
+    Collects vehicle trajectory samples for the history Redis and writes them in one pipelined round trip.
+    TS.ADD creates a missing series itself (with retention and labels), so there is no EXISTS / TS.CREATE
+    check per sample.
+
+    Sample timestamps are in seconds, and retention is measured in the same units as the timestamps, so the
+    24 hour retention is given in seconds.
+    """
+    RETENTION = 60 * 60 * 24
+
+    def __init__(self, redis_client, success_counter, error_counter):
+        self.pipeline = redis_client.pipeline(transaction=False)
+        self.success_counter = success_counter
+        self.error_counter = error_counter
+        self.keys = []
+
+    def __len__(self):
+        return len(self.keys)
+
+    @staticmethod
+    def trip_labels(mode, pattern, route, trip, start: int):
+        """
+        Labels identifying a trip series. Estimate queries look up all trips of a pattern with
+        TS.MGET FILTER pattern=<pid>, so every series needs at least the pattern label.
+        :param start: timestamp of the trip's first sample
+        """
+        return {'mode': mode, 'pattern': pattern, 'route': route, 'trip': trip, 'start': start}
+
+    def add(self, redis_key, timestamp: int, value: float, labels: dict):
+        self.pipeline.ts().add(redis_key, timestamp, value,
+                               retention_msecs=self.RETENTION,
+                               labels={k: str(v) for k, v in labels.items() if v is not None},
+                               duplicate_policy='last')
+        self.keys.append(redis_key)
+
+    def execute(self):
+        """
+        Sends all queued samples. Per-key failures are logged and counted rather than raised so that one
+        bad series doesn't discard the rest of the bundle.
+        :return: number of samples written
+        """
+        if not self.keys:
+            return 0
+        keys = self.keys
+        self.keys = []
+        try:
+            results = self.pipeline.execute(raise_on_error=False)
+        except redis.exceptions.RedisError as e:
+            print(f'Redis trajectory batch error: {e}')
+            self.error_counter.inc(len(keys))
+            self.pipeline.reset()
+            return 0
+        written = 0
+        for key, result in zip(keys, results):
+            if isinstance(result, Exception):
+                print(f'Redis summarizer error for {key}: {result}')
+                self.error_counter.inc()
+                continue
+            written += 1
+        self.success_counter.inc(written)
+        return written
@@ -7,8 +7,9 @@ import grequests
 
 from interfaces import ureg
 from interfaces.estimates import BusResponse, TrainEstimate, TrainResponse, TransitEstimate, StopEstimates, \
-    StopEstimate, CombinedResponseType, TransitOutput, BusEstimate, Mode, PositionInfo
-from realtimeinfo.queries import QueryManager, TrainQuery
+    StopEstimate, CombinedResponseType, TransitOutput, BusEstimate, Mode, PositionInfo, METERS_PER_MILE, \
+    to_meters, miles, format_miles
+from realtimeinfo.queries import QueryManager
 
 
 logger = logging.getLogger(__file__)
@@ -40,13 +41,13 @@ class NearStopQuery:
                 logger.debug(f'coalesce {dirname} {k}  vp {d.vehicle_position}  sp {d.stop_position}  le {d.low_estimate}')
                 routev.append(d)
                 d.age = self.td_round(d.age)
-                d.distance_from_vehicle = d.distance_from_vehicle.to(ureg.miles)
+                distance_m = to_meters(d.distance_from_vehicle)
+                d.distance_from_vehicle = miles(distance_m)
                 # logger.debug(json.dumps(d, indent=4))
                 if d.low_estimate is None:
-                    miles = d.distance_from_vehicle.to(ureg.miles)
-                    if miles <= ureg.miles * 1:
+                    if distance_m <= METERS_PER_MILE:
                         d.display = True
-                        if d.distance_from_vehicle <= (200 * ureg.meter):
+                        if distance_m <= 200:
                             d.displayed_estimate = 'Due'
                     else:
                         d.display = False
@@ -93,57 +94,18 @@ class NearStopQuery:
         return results
 
     async def fetch_routing(self, results: list[TransitEstimate]):
-        routing_queries = set([])
-        urls = []
-        reqs = []
-        routing_responses = {}
-        stop_to_pattern = {}
+        stops = {}
         for item in results:
-            stop_to_pattern[item.stop_id] = item.pattern
-            if item.stop_id in routing_queries:
-                continue
-            routing_queries.add(item.stop_id)
-            routing_json = {"locations": [
-                {"lat": self.lat,
-                 "lon": self.lon,
-                 "street": "Street1"},
-                {"lat": item.stop_lat,
-                 "lon": item.stop_lon,
-                 "street": "Street2"}],
-                "costing": "pedestrian",
-                "units": "miles",
-                "id": str(item.stop_id)}
-            jp = json.dumps(routing_json)
-            urls.append(f'{self.qm.config.get_server("valhalla")}/route?json={jp}')
-        for u in urls:
-            logger.debug(f'Requesting routing {u}')
-            reqs.append(grequests.get(u))
-
-        def handler(request, exception):
-            logger.warning(f'Issue with {request}: {exception}')
-
-        responses = grequests.map(reqs, exception_handler=handler)
-        #logger.debug('index', index.keys())
-        logger.debug(f'Sent {len(reqs)} requests and got {len(responses)} responses')
-        for resp in responses:
-            if resp is None:
-                logger.warning(f'  Got null response')
-                continue
-            if resp.status_code not in {200, 201}:
-                logger.warning(f'   Response status code to {resp.request.url}: {resp.staus_code}')
-                continue
-
-            jd = resp.json()
-            summary = jd['trip']['summary']
-            seconds = summary['time']
-            miles = summary['length']
-            stop_id = int(jd['id'])
-            routing_queries.discard(stop_id)
-            routing_responses[stop_id] = (datetime.timedelta(seconds=int(seconds)), miles * ureg.miles)
+            stops.setdefault(item.stop_id, (item.stop_id, item.stop_lat, item.stop_lon))
+        # cached walking times, with misses fetched in one Valhalla matrix request on a worker thread
+        walking = await asyncio.to_thread(self.qm.walking.get, self.lat, self.lon, list(stops.values()))
+        logger.debug(f'Requested walking times to {len(stops)} stops and got {len(walking)}')
+        routing_responses = {}
+        for stop_id, (walk_time, length_mi) in walking.items():
+            routing_responses[stop_id] = (walk_time, length_mi * ureg.miles)
         return routing_responses
 
-    async def estimate_vehicle_locations(self, results: list[TransitEstimate]) -> CombinedResponseType:
-        directions = {'Northbound': [], 'Southbound': [], 'Eastbound': [], 'Westbound': []}
+    async def estimate_vehicle_locations(self, results: list[TransitEstimate]):
         index = {}
         ests = {}
 
@@ -173,11 +135,7 @@ class NearStopQuery:
         reqs.append(grequests.post('http://localhost:8500/estimates/', data=estimates_query.model_dump_json()))
         logger.debug(f'Requesting estimate http://localhost:8500/estimates/ post {estimates_query.model_dump_json(indent=4)}')
 
-        gathered = await asyncio.gather(
-            self.qm.get_estimates(estimates_query),
-            self.fetch_routing(results)
-        )
-        estimate_response, routing_responses = gathered
+        estimate_response = await self.qm.get_estimates(estimates_query)
 
         for p in estimate_response.patterns:
             pattern_id = p.pattern_id
@@ -191,6 +149,8 @@ class NearStopQuery:
                 else:
                     logger.warning(f'Warning: pattern {pattern_id} vehicle position missing {vehicle_position}')
 
+    def apply_routing(self, results: list[TransitEstimate], routing_responses) -> CombinedResponseType:
+        directions = {'Northbound': [], 'Southbound': [], 'Eastbound': [], 'Westbound': []}
         for item in results:
             rr = routing_responses.get(item.stop_id)
             if rr:
@@ -201,35 +161,62 @@ class NearStopQuery:
             directions.setdefault(item.direction, []).append(item)
         return directions
 
-    async def nearest_buses(self) -> BusResponse:
+    async def nearest_buses(self, lat, lon) -> BusResponse:
         start = datetime.datetime.now()
-        results = self.qm.nearest_stop_vehicles(self.lat, self.lon)
+        results = await self.qm.nearest_stop_vehicles_async(lat, lon)
         end = datetime.datetime.now()
         latency = int((end - start).total_seconds())
         return BusResponse(
             results=results,
             start=start,
             latency=latency,
-            lat=self.lat,
-            lon=self.lon
+            lat=lat,
+            lon=lon
         )
 
-    async def nearest_trains(self) -> TrainResponse:
+    async def nearest_trains(self, lat, lon) -> TrainResponse:
         if self.sa is None:
             return TrainResponse(results=[])
-        tq = TrainQuery(self.qm.engine, self.sa)
-        return TrainResponse(results=tq.get_relevant_stops(self.lat, self.lon))
+        tq = self.qm.train_query(self.sa)
+        # CPU bound projection; a worker thread lets it overlap the bus lookup
+        results = await asyncio.to_thread(tq.get_relevant_stops, lat, lon)
+        return TrainResponse(results=results)
 
-    async def run_query(self) -> CombinedResponseType:
+    async def nearest_vehicles(self, lat, lon) -> list[TransitEstimate]:
         results: list[TransitEstimate] = []
         logger.debug(f'Running query')
-        resp = await asyncio.gather(self.nearest_buses(), self.nearest_trains())
+        resp = await asyncio.gather(self.nearest_buses(lat, lon), self.nearest_trains(lat, lon))
         logger.debug(f'Gathered')
         bus_response, train_response = resp
         logger.debug(f'resp done')
         results += bus_response.results
         results += train_response.results
-        directions = await self.estimate_vehicle_locations(results)
+        return results
+
+    async def shared_estimates(self, lat, lon):
+        """
+        The part of a response that doesn't depend on who is asking, for the response cache.
+        :return: (time computed, estimates for vehicles approaching stops near lat, lon)
+        """
+        computed = datetime.datetime.now()
+        results = await self.nearest_vehicles(lat, lon)
+        await self.estimate_vehicle_locations(results)
+        return computed, results
+
+    async def run_query(self) -> CombinedResponseType:
+        if self.qm.responses is None:
+            results = await self.nearest_vehicles(self.lat, self.lon)
+            _, routing_responses = await asyncio.gather(
+                self.estimate_vehicle_locations(results),
+                self.fetch_routing(results)
+            )
+        else:
+            computed, shared = await self.qm.responses.get(self.lat, self.lon, self.shared_estimates)
+            # shallow copies: the overlay below only reassigns fields, so the cached items stay untouched
+            elapsed = datetime.datetime.now() - computed
+            results = [item.model_copy(update={'age': item.age + elapsed}) for item in shared]
+            routing_responses = await self.fetch_routing(results)
+        directions = self.apply_routing(results, routing_responses)
         directions2 = {}
         for k, v in directions.items():
             directions2[k] = self.route_coalesce(k, v)
@@ -245,7 +232,6 @@ class NearStopQuery:
         else:
             mode = Mode.TRAIN
             vehicle = e.run
-        miles = lambda x: f"{x.to('mi').m:0.2f} mi" if x is not None else None
         minutes = lambda x: round(x.total_seconds() / 60) if x is not None else None
         if e.waiting_to_depart:
             adj = e.predicted_minutes - e.age
@@ -261,10 +247,10 @@ class NearStopQuery:
             stop_name=e.stop_name,
             stop_lat=e.stop_lat,
             stop_lon=e.stop_lon,
-            stop_position=miles(e.stop_position),
-            vehicle_position=miles(e.vehicle_position),
-            distance_from_vehicle=miles(e.distance_from_vehicle),
-            distance_to_stop=miles(e.distance_to_stop),
+            stop_position=format_miles(e.stop_position),
+            vehicle_position=format_miles(e.vehicle_position),
+            distance_from_vehicle=format_miles(e.distance_from_vehicle),
+            distance_to_stop=format_miles(e.distance_to_stop),
             last_update=e.last_update.isoformat(),
             age_seconds=round(e.age.total_seconds()),
             destination_stop_id=e.destination_stop_id,
@@ -276,6 +262,6 @@ class NearStopQuery:
             walk_time_minutes=minutes(e.walk_time),
             total_low_minutes=minutes(e.low_estimate + adj),
             total_high_minutes=minutes(e.high_estimate + adj),
-            walk_distance=miles(e.walk_distance),
+            walk_distance=format_miles(e.walk_distance),
             display=e.display
         )
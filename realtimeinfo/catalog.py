@@ -0,0 +1,294 @@
+import collections
+import datetime
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+import shapely
+from geoalchemy2.elements import WKBElement
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from interfaces.estimates import Mode
+from realtime.rtmodel import TrainPatternDetail
+from schedules.schedule_analyzer import ShapeManager
+
+
+logger = logging.getLogger(__file__)
+
+
+# one pattern stop of the catalog, as selected by StopCatalog.query
+CatalogRow = collections.namedtuple('CatalogRow', ['pattern_id', 'rt', 'stop_id', 'sequence', 'distance',
+                                                   'stop_headsign', 'direction_change', 'stop_name', 'lat', 'lon'])
+
+
+class NearbyStop:
+    """
+    A pattern stop near a query point. stop_pattern_distance is the pattern_stop distance as stored (feet for
+    buses, meters for trains); dist is meters from the query point.
+    """
+    def __init__(self, pattern_id, rt, stop_id, stop_name, stop_lat, stop_lon, stop_pattern_distance,
+                 stop_headsign, direction_change, last_stop_id, dist):
+        self.pattern_id = pattern_id
+        self.rt = rt
+        self.stop_id = stop_id
+        self.stop_name = stop_name
+        self.stop_lat = stop_lat
+        self.stop_lon = stop_lon
+        self.stop_pattern_distance = stop_pattern_distance
+        self.stop_headsign = stop_headsign
+        self.direction_change = direction_change
+        self.last_stop_id = last_stop_id
+        self.dist = dist
+
+
+class StopIndex:
+    """
+    Immutable snapshot of the stop catalog: every stop projected to EPSG:26916 in an STRtree, with the pattern
+    stops served there. Replaced as a whole on reload.
+    """
+    def __init__(self, rows):
+        stops = {}
+        # pattern id -> (sequence, stop id) of its last stop
+        last = {}
+        for row in rows:
+            stops.setdefault(row.stop_id, (row.stop_name, row.lat, row.lon, []))[3].append(row)
+            if row.pattern_id not in last or row.sequence > last[row.pattern_id][0]:
+                last[row.pattern_id] = (row.sequence, row.stop_id)
+        self.last_stops = {pid: stop_id for pid, (_, stop_id) in last.items()}
+        self.stop_ids = list(stops)
+        self.stops = [stops[stop_id] for stop_id in self.stop_ids]
+        lats = np.array([lat for _, lat, _, _ in self.stops], dtype=float)
+        lons = np.array([lon for _, _, lon, _ in self.stops], dtype=float)
+        self.x, self.y = ShapeManager.transform_arrays(lons, lats)
+        self.tree = shapely.STRtree(shapely.points(self.x, self.y))
+
+    def __len__(self):
+        return len(self.stop_ids)
+
+    def nearest(self, lat, lon, thresh, mode: Mode):
+        """
+        :return: NearbyStop list ordered by distance, with the nearest stop of each bus pattern or of each
+          train pattern and headsign within thresh meters
+        """
+        x, y = ShapeManager.XFM.transform(lat, lon)
+        candidates = self.tree.query(shapely.Point(x, y), predicate='dwithin', distance=thresh)
+        if not len(candidates):
+            return []
+        distances = np.hypot(self.x[candidates] - x, self.y[candidates] - y)
+        best = {}
+        for index, dist in zip(candidates, distances):
+            if dist >= thresh:
+                continue
+            stop_name, stop_lat, stop_lon, pattern_stops = self.stops[index]
+            for row in pattern_stops:
+                is_train = row.pattern_id >= 300000000
+                if is_train != (mode == Mode.TRAIN):
+                    continue
+                key = (row.pattern_id, row.stop_headsign) if is_train else row.pattern_id
+                previous = best.get(key)
+                if previous is not None and previous.dist <= dist:
+                    continue
+                best[key] = NearbyStop(
+                    pattern_id=row.pattern_id,
+                    rt=row.rt,
+                    stop_id=row.stop_id,
+                    stop_name=stop_name,
+                    stop_lat=stop_lat,
+                    stop_lon=stop_lon,
+                    stop_pattern_distance=row.distance,
+                    stop_headsign=row.stop_headsign,
+                    direction_change=row.direction_change,
+                    last_stop_id=self.last_stops.get(row.pattern_id),
+                    dist=float(dist),
+                )
+        return sorted(best.values(), key=lambda s: s.dist)
+
+
+class StopCatalog:
+    """
+    Stop and pattern stop dimensions held in the query server, so finding the stops near a point doesn't need
+    a distance computed for every row of stop x pattern_stop x pattern. The catalog is reloaded in the
+    background every RELOAD_INTERVAL seconds to pick up newly learned patterns, unless the index is supplied
+    and kept current by the caller.
+    """
+    RELOAD_INTERVAL = 60 * 60
+
+    def __init__(self, engine, index: StopIndex = None):
+        self.engine = engine
+        self.index = index if index is not None else self.load()
+        self.thread = threading.Thread(target=self.run, name='catalog', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    @staticmethod
+    def query(engine) -> list[CatalogRow]:
+        query = ('select pattern_stop.pattern_id, pattern.rt, pattern_stop.stop_id, pattern_stop.sequence, '
+                 'pattern_stop.distance, pattern_stop.stop_headsign, pattern_stop.direction_change, '
+                 'stop.stop_name, st_y(stop.geom) as lat, st_x(stop.geom) as lon from pattern_stop '
+                 'inner join stop on stop.id = pattern_stop.stop_id '
+                 'inner join pattern on pattern.id = pattern_stop.pattern_id')
+        with Session(engine) as session:
+            return [CatalogRow(*row) for row in session.execute(text(query))]
+
+    def load(self) -> StopIndex:
+        start = time.monotonic()
+        index = StopIndex(self.query(self.engine))
+        logger.info(f'Loaded {len(index)} stops for {len(index.last_stops)} patterns '
+                    f'in {time.monotonic() - start:.2f}s')
+        return index
+
+    def nearest(self, lat, lon, thresh, mode: Mode):
+        return self.index.nearest(lat, lon, thresh, mode)
+
+    def run(self):
+        while True:
+            time.sleep(self.RELOAD_INTERVAL)
+            try:
+                self.index = self.load()
+            except Exception as e:
+                logger.warning(f'Error reloading stop catalog: {e}')
+
+
+class SqlStopFinder:
+    """
+    Same lookup as StopCatalog, answered by Postgres for deployments that don't hold the catalog in memory.
+    Stops are filtered with ST_DWithin on the GiST indexed stop.geom_chicago column before pattern_stop is
+    joined, so only stops near the point are ever transformed or joined.
+    """
+    def __init__(self, engine):
+        self.engine = engine
+
+    def start(self):
+        pass
+
+    @staticmethod
+    def statement(mode: Mode):
+        if mode == Mode.TRAIN:
+            distinct = 'pattern_stop.pattern_id, pattern_stop.stop_headsign'
+            pattern_filter = 'pattern_stop.pattern_id >= 300000000'
+        else:
+            distinct = 'pattern_stop.pattern_id'
+            pattern_filter = 'pattern_stop.pattern_id < 300000000'
+        return text(f"""
+            select distinct on ({distinct})
+                pattern_stop.pattern_id, pattern.rt, nearby.id as stop_id, nearby.stop_name,
+                st_y(nearby.geom) as stop_lat, st_x(nearby.geom) as stop_lon,
+                pattern_stop.distance as stop_pattern_distance, pattern_stop.stop_headsign,
+                pattern_stop.direction_change,
+                (select final.stop_id from pattern_stop as final where final.pattern_id = pattern_stop.pattern_id
+                    order by final.sequence desc limit 1) as last_stop_id,
+                nearby.dist
+            from (
+                select stop.id, stop.stop_name, stop.geom,
+                    ST_Distance(stop.geom_chicago, point.geom) as dist
+                from stop,
+                    (select ST_Transform(ST_SetSRID(ST_MakePoint(:lon, :lat), 4326), 26916) as geom) as point
+                where ST_DWithin(stop.geom_chicago, point.geom, :thresh)
+            ) as nearby
+            inner join pattern_stop on pattern_stop.stop_id = nearby.id
+            inner join pattern on pattern.id = pattern_stop.pattern_id
+            where {pattern_filter}
+            order by {distinct}, nearby.dist
+        """)
+
+    def nearest(self, lat, lon, thresh, mode: Mode):
+        with Session(self.engine) as session:
+            rows = session.execute(self.statement(mode), {'lat': lat, 'lon': lon, 'thresh': thresh})
+            rv = [NearbyStop(**row._asdict()) for row in rows]
+        return sorted(rv, key=lambda s: s.dist)
+
+
+class CatalogSnapshot:
+    """
+    Everything slowly changing the query server needs before it can answer: last stops, pattern info from the
+    scraper, the stop catalog and the train pattern shapes and stops. Written to a local file so a restart can
+    serve from it straight away instead of waiting on Postgres and the scraper; files written with a different
+    VERSION are ignored.
+    """
+    VERSION = 1
+    SHAPE_COLUMNS = [c.key for c in TrainPatternDetail.__table__.columns if c.key != 'geom']
+
+    def __init__(self, last_stops, patterns, stops, shapes, pattern_stops, created: datetime.datetime):
+        """
+        :param last_stops: dict of pattern id to (last stop id, last stop name)
+        :param patterns: dict of pattern id to scraper pattern info
+        :param stops: list of CatalogRow
+        :param shapes: list of (train pattern detail, first stop geometry or None) as from query_shapes
+        :param pattern_stops: list of train pattern stops as from query_pattern_stops
+        """
+        self.last_stops = last_stops
+        self.patterns = patterns
+        self.stops = stops
+        self.shapes = shapes
+        self.pattern_stops = pattern_stops
+        self.created = created
+
+    def to_json(self):
+        shapes = []
+        for pattern, first_stop_geom in self.shapes:
+            item = {column: getattr(pattern, column) for column in self.SHAPE_COLUMNS}
+            item['geom'] = pattern.geom.desc
+            item['first_stop_geom'] = first_stop_geom.desc if first_stop_geom is not None else None
+            shapes.append(item)
+        return {
+            'version': self.VERSION,
+            'created': self.created.isoformat(),
+            'last_stops': [[pid, stop_id, stop_name] for pid, (stop_id, stop_name) in self.last_stops.items()],
+            'patterns': list(self.patterns.values()),
+            'stops': [list(row) for row in self.stops],
+            'shapes': shapes,
+            'pattern_stops': [list(row) for row in self.pattern_stops],
+        }
+
+    @classmethod
+    def from_json(cls, d):
+        shapes = []
+        for item in d['shapes']:
+            first_stop_geom = item.pop('first_stop_geom')
+            geom = item.pop('geom')
+            pattern = TrainPatternDetail(geom=WKBElement(geom, srid=26916), **item)
+            shapes.append((pattern, WKBElement(first_stop_geom) if first_stop_geom is not None else None))
+        return cls(
+            last_stops={pid: (stop_id, stop_name) for pid, stop_id, stop_name in d['last_stops']},
+            patterns={p['pattern_id']: p for p in d['patterns']},
+            stops=[CatalogRow(*row) for row in d['stops']],
+            shapes=shapes,
+            pattern_stops=[tuple(row) for row in d['pattern_stops']],
+            created=datetime.datetime.fromisoformat(d['created']),
+        )
+
+    def write(self, path):
+        # written beside the target and renamed, so a crash never leaves a truncated snapshot behind
+        tmp_path = f'{path}.tmp'
+        with gzip.open(tmp_path, 'wt') as fh:
+            json.dump(self.to_json(), fh)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def read(cls, path):
+        """
+        :return: the snapshot stored at path, or None if it is missing, unreadable or from another version
+        """
+        start = time.monotonic()
+        try:
+            with gzip.open(path, 'rt') as fh:
+                d = json.load(fh)
+        except FileNotFoundError:
+            logger.info(f'No catalog snapshot at {path}')
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f'Error reading catalog snapshot {path}: {e}')
+            return None
+        if d.get('version') != cls.VERSION:
+            logger.warning(f'Ignoring catalog snapshot {path} with version {d.get("version")}')
+            return None
+        snapshot = cls.from_json(d)
+        logger.info(f'Read catalog snapshot from {snapshot.created} with {len(snapshot.stops)} pattern stops '
+                    f'in {time.monotonic() - start:.2f}s')
+        return snapshot
@@ -6,6 +6,7 @@ from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
 import datetime
 import logging
+import os
 
 from sqlalchemy import text
 from sqlalchemy.orm import Session
@@ -15,7 +16,7 @@ from interfaces.estimates import BusResponse, TrainResponse, StopEstimates, Stop
     EstimateResponse, DetailRequest, CombinedResponse, CombinedOutput, PositionInfo, CombinedEstimateRequest
 from realtimeinfo.assembly import NearStopQuery
 from realtime.rtmodel import db_init
-from realtimeinfo.queries import QueryManager, TrainQuery
+from realtimeinfo.queries import QueryManager
 from backend.util import Config
 
 from schedules.schedule_analyzer import ScheduleAnalyzer
@@ -44,12 +45,16 @@ app.add_middleware(CORSMiddleware,
                    allow_headers=["*"]
                    )
 
-engine = db_init(connection_config, echo=False)
-qm = QueryManager(engine, connection_config)
+# with a catalog snapshot file, startup reads it instead of querying Postgres and the scraper, and the
+# schema is left to the scraper that owns it
+catalog_file = os.getenv('CATALOG_SNAPSHOT')
+engine = db_init(connection_config, echo=False, create_tables=catalog_file is None)
 # fix for prod
 schedule_file = Path('/app/cta_gtfs_20250206.zip')
 sa = ScheduleAnalyzer(schedule_file, engine=engine)
-sa.setup_shapes()
+qm = QueryManager(engine, connection_config, schedule_analyzer=sa, catalog_file=catalog_file)
+if catalog_file is None:
+    sa.setup_shapes()
 
 
 @app.get('/')
@@ -68,10 +73,12 @@ def nearest_stops(lat: float, lon: float):
     rv = []
     with Session(engine) as session:
         query = (
-            'select pattern_id, rt, id, stop_name, dist from (select DISTINCT ON (pattern_id) pattern_id, rt, id, stop_name, dist from (select stop.id, pattern_stop.pattern_id, stop_name, pattern.rt, '  
-            'ST_TRANSFORM(geom, 26916) <-> ST_TRANSFORM(\'SRID=4326;POINT(:lon :lat)\'\\:\\:geometry, 26916) as dist '
-            'from stop inner join pattern_stop on stop.id = pattern_stop.stop_id inner join pattern on pattern_stop.pattern_id = pattern.id ORDER BY dist) ' 
-            'WHERE dist < :thresh) order by dist'
+            'select pattern_id, rt, id, stop_name, dist from (select DISTINCT ON (pattern_id) pattern_id, rt, id, stop_name, dist from (select nearby.id, pattern_stop.pattern_id, stop_name, pattern.rt, dist '
+            'from (select stop.id, stop.stop_name, ST_Distance(stop.geom_chicago, point.geom) as dist from stop, '
+            '(select ST_Transform(ST_SetSRID(ST_MakePoint(:lon, :lat), 4326), 26916) as geom) as point '
+            'where ST_DWithin(stop.geom_chicago, point.geom, :thresh)) as nearby '
+            'inner join pattern_stop on nearby.id = pattern_stop.stop_id inner join pattern on pattern_stop.pattern_id = pattern.id ORDER BY dist) '
+            ') order by dist'
         )
         result = session.execute(text(query), {"lat": float(lat), "lon": float(lon), "thresh": 1000})
         for row in result:
@@ -102,7 +109,7 @@ def nearest_estimates(lat: float, lon: float) -> BusResponse:
 def nearest_trains(lat: float, lon: float) -> TrainResponse:
     if sa is None:
         return TrainResponse(results=[])
-    tq = TrainQuery(engine, sa)
+    tq = qm.train_query(sa)
     return TrainResponse(results=tq.get_relevant_stops(lat, lon))
 
 
@@ -0,0 +1,215 @@
+import logging
+import threading
+import time
+
+import numpy as np
+from prometheus_client import Counter, Gauge
+
+
+logger = logging.getLogger(__file__)
+
+
+def pattern_filter(pid):
+    return [f'pattern={pid}']
+
+
+def latest_samples(redis_client, pid):
+    """
+    Latest sample of every trip series of a pattern, found through the series' pattern label in a single
+    TS.MGET instead of scanning the keyspace.
+    :return: list of (redis key, (timestamp, distance))
+    """
+    return parse_latest(redis_client.ts().mget(pattern_filter(pid)))
+
+
+def parse_latest(reply):
+    samples = []
+    for item in reply:
+        for redis_key, (_, timestamp, value) in item.items():
+            if timestamp is None:
+                continue
+            if isinstance(redis_key, bytes):
+                redis_key = redis_key.decode('utf-8')
+            samples.append((redis_key, (timestamp, value)))
+    return samples
+
+
+def monotonic_trajectory(timestamps, distances):
+    """
+    Cleans a trip trajectory for interpolation: distances are made non-decreasing (GPS noise can step
+    backwards) and only the first sample at each distance is kept.
+    :return: (timestamps, distances) arrays with strictly increasing distances
+    """
+    timestamps = np.asarray(timestamps, dtype=float)
+    distances = np.maximum.accumulate(np.asarray(distances, dtype=float))
+    keep = np.concatenate(([True], np.diff(distances) > 0))
+    return timestamps[keep], distances[keep]
+
+
+class PatternProfile:
+    """
+    Travel-time profile of one pattern: for each of the most recent completed trips, the time at which it
+    passed every GRID_SPACING meters along the pattern. Times outside the part of the pattern a trip covered
+    are NaN.
+    """
+    def __init__(self, pid, spacing, window):
+        self.pid = pid
+        self.spacing = spacing
+        self.window = window
+        # redis key -> (end timestamp, times on the grid)
+        self.trips = {}
+        # redis key -> timestamp of the series' last sample when it was fetched, so trips that got more samples
+        # after being taken as completed are fetched again
+        self.fetched = {}
+        self.matrix = None
+
+    def __len__(self):
+        return len(self.trips)
+
+    def __contains__(self, redis_key):
+        return redis_key in self.trips
+
+    def copy(self):
+        profile = PatternProfile(self.pid, self.spacing, self.window)
+        profile.trips = dict(self.trips)
+        profile.fetched = dict(self.fetched)
+        return profile
+
+    def add_trip(self, redis_key, timestamps, distances):
+        self.fetched[redis_key] = timestamps[-1]
+        timestamps, distances = monotonic_trajectory(timestamps, distances)
+        if len(distances) < 2:
+            return False
+        grid = np.arange(0, distances[-1] + self.spacing, self.spacing)
+        times = np.interp(grid, distances, timestamps, left=np.nan, right=np.nan)
+        self.trips[redis_key] = (timestamps[-1], times)
+        if len(self.trips) > self.window:
+            oldest = min(self.trips, key=lambda k: self.trips[k][0])
+            del self.trips[oldest]
+        self.matrix = None
+        return True
+
+    def get_matrix(self):
+        """
+        :return: (redis keys, end timestamps, times) with one row of times per trip, padded with NaN
+        """
+        if self.matrix is None:
+            keys = sorted(self.trips, key=lambda k: self.trips[k][0])
+            width = max(len(self.trips[k][1]) for k in keys)
+            times = np.full((len(keys), width), np.nan)
+            for row, key in enumerate(keys):
+                trip_times = self.trips[key][1]
+                times[row, :len(trip_times)] = trip_times
+            ends = np.array([self.trips[k][0] for k in keys])
+            self.matrix = keys, ends, times
+        return self.matrix
+
+    def times_at(self, positions):
+        """
+        :param positions: pattern positions in meters
+        :return: array of shape (trips, positions) with the time each trip passed each position
+        """
+        keys, ends, times = self.get_matrix()
+        index = np.asarray(positions, dtype=float) / self.spacing
+        lo = np.floor(index).astype(int)
+        inside = (lo >= 0) & (lo + 1 < times.shape[1])
+        lo = np.clip(lo, 0, times.shape[1] - 2)
+        frac = index - lo
+        rv = times[:, lo] * (1 - frac) + times[:, lo + 1] * frac
+        rv[:, ~inside] = np.nan
+        return rv
+
+    def travel_times(self, from_positions, to_positions):
+        """
+        :return: (redis keys, end timestamps, travel times) with travel times of shape (trips, positions);
+          NaN where a trip didn't cover both positions
+        """
+        keys, ends, _ = self.get_matrix()
+        return keys, ends, self.times_at(to_positions) - self.times_at(from_positions)
+
+
+class ProfileBuilder:
+    """
+    Background builder of per-pattern travel-time profiles from the trip series in the history Redis. Only
+    patterns that estimates have asked for are maintained. A trip counts as completed once its series hasn't
+    had a sample for COMPLETE_AFTER seconds, measured against the newest sample of any trip on the pattern
+    since series timestamps are local time rather than epoch; its full trajectory is then fetched and
+    resampled, and fetched again if its series has grown since.
+    """
+    GRID_SPACING = 100
+    WINDOW = 10
+    MIN_TRIPS = 3
+    COMPLETE_AFTER = 10 * 60
+    INTERVAL = 60
+
+    def __init__(self, redis_client):
+        self.redis = redis_client
+        self.lock = threading.Lock()
+        self.profiles = {}
+        self.requested = set()
+        self.thread = threading.Thread(target=self.run, name='profiles', daemon=True)
+        self.trip_counter = Counter('transit_profile_trips', 'Completed trips added to travel-time profiles')
+        self.pattern_gauge = Gauge('transit_profile_patterns', 'Patterns with a usable travel-time profile')
+        self.pattern_gauge.set_function(lambda: sum(1 for p in list(self.profiles.values())
+                                                    if len(p) >= self.MIN_TRIPS))
+
+    def start(self):
+        self.thread.start()
+
+    def get(self, pid):
+        """
+        Marks pid as in demand and returns its profile if it has enough trips to estimate from.
+        """
+        with self.lock:
+            self.requested.add(pid)
+            profile = self.profiles.get(pid)
+        if profile is None or len(profile) < self.MIN_TRIPS:
+            return None
+        return profile
+
+    def refresh_pattern(self, pid):
+        latest = latest_samples(self.redis, pid)
+        if not latest:
+            return 0
+        now = max(ts for _, (ts, _) in latest)
+        profile = self.profiles.get(pid)
+        if profile is None:
+            profile = PatternProfile(pid, self.GRID_SPACING, self.WINDOW)
+        else:
+            profile = profile.copy()
+            live = {key for key, _ in latest}
+            profile.fetched = {key: ts for key, ts in profile.fetched.items() if key in live}
+        completed = sorted(((ts, key) for key, (ts, _) in latest
+                            if now - ts > self.COMPLETE_AFTER), reverse=True)[:self.WINDOW]
+        new_keys = [key for ts, key in completed if profile.fetched.get(key) != ts]
+        if not new_keys:
+            return 0
+        pipeline = self.redis.pipeline(transaction=False)
+        for key in new_keys:
+            pipeline.ts().range(key, '-', '+')
+        added = 0
+        for key, samples in zip(new_keys, pipeline.execute()):
+            if not samples:
+                continue
+            timestamps, distances = zip(*samples)
+            if profile.add_trip(key, timestamps, distances):
+                added += 1
+        # profiles are copied and replaced rather than mutated while estimates may be reading them
+        with self.lock:
+            self.profiles[pid] = profile
+        self.trip_counter.inc(added)
+        return added
+
+    def refresh(self):
+        with self.lock:
+            requested = list(self.requested)
+        for pid in requested:
+            self.refresh_pattern(pid)
+
+    def run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.warning(f'Error refreshing travel-time profiles: {e}')
+            time.sleep(self.INTERVAL)
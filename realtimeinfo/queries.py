@@ -1,105 +1,225 @@
+import asyncio
+import concurrent.futures
 import datetime
 import cProfile
+import os
 import heapq
-import statistics
 import logging
+import threading
+import time
 
-import geoalchemy2
-import sqlalchemy.exc
+import numpy as np
 from sqlalchemy import text, select, func
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import create_async_engine
 from geoalchemy2.shape import to_shape
 
 import requests
 import redis
+import redis.asyncio
 
-from realtime.rtmodel import db_init, BusPosition, CurrentVehicleState, Stop, TrainPosition, PatternStop, \
+from realtime.rtmodel import db_init, BusPosition, CurrentVehicleState, Stop, TrainPosition, \
     CurrentTrainState
 from backend.util import Util, Config
 from schedules.schedule_analyzer import ScheduleAnalyzer, ShapeManager
 from interfaces.estimates import TrainEstimate, BusEstimate, StopEstimate, SingleEstimate, EstimateResponse, \
-    PatternResponse, DetailRequest, Mode, StopEstimates
+    PatternResponse, DetailRequest, Mode, StopEstimates, METERS_PER_FOOT, to_meters, meters, format_miles
 from interfaces import ureg, Q_
+from realtimeinfo.catalog import StopCatalog, SqlStopFinder, StopIndex, CatalogSnapshot
+from realtimeinfo.snapshot import VehicleSnapshot
+from realtimeinfo.responses import ResponseCache
+from realtimeinfo.walking import WalkingTimes
+from realtimeinfo.profiles import ProfileBuilder, PatternProfile, latest_samples, monotonic_trajectory, \
+    parse_latest, pattern_filter
 
 
 logger = logging.getLogger(__file__)
 
 
-class EstimateFinder:
-    def __init__(self, redis_client, estimate_request: StopEstimate,
-                 engine=None, recalculate_positions=False,
-                 schedule_analyzer=None):
+class TripSamples:
+    """
+    Reference trip samples shared by every estimate in one request. The latest trips of each pattern are
+    loaded once, chosen against the furthest stop requested on that pattern, and the closest-sample lookups
+    for all vehicles and stops are sent in a single pipeline. Distances are plain float meters.
+    """
+    HEAPSIZE = 10
+    # how far either side of a position to look for samples
+    BUS_WINDOW = 3000 * METERS_PER_FOOT
+    TRAIN_WINDOW = 3000
+
+    def __init__(self, redis_client, estimates: list[StopEstimate], debug=False):
         self.redis = redis_client
-        self.estimate_request = estimate_request
-        self.debug = estimate_request.debug
-        self.recalculate_positions = recalculate_positions
-        self.engine = engine
-        self.schedule_analyzer = schedule_analyzer
-        if self.recalculate_positions:
-            assert self.engine is not None
-            assert self.schedule_analyzer is not None
+        self.debug = debug
+        # pattern id -> furthest requested stop position
+        self.furthest = {}
+        for row in estimates:
+            stop_m = to_meters(row.stop_position)
+            previous = self.furthest.get(row.pattern_id)
+            if previous is None or stop_m > previous:
+                self.furthest[row.pattern_id] = stop_m
+        # pattern id -> [(timestamp, redis key)] most recent trips last
+        self.trips = {}
+        # (redis key, rounded meters) -> distance of pending closest-sample lookups
+        self.lookups = {}
+        self.results = {}
+        # redis key -> (timestamps, distances) of full trip trajectories, for the interpolating estimator
+        self.trajectory_requests = set()
+        self.trajectories = {}
 
-    def get_redis_keys(self, pid):
-        if pid >= 308500000:
-            redis_keys = self.redis.keys(pattern=f'trainposition:{pid}:*')
-        else:
-            redis_keys = self.redis.keys(pattern=f'busposition:{pid}:*')
-        return redis_keys
+    def get_trips(self, pid, stop_m):
+        if pid not in self.trips:
+            furthest = self.furthest.setdefault(pid, stop_m)
+            self.trips[pid] = self.load_trips(pid, max(furthest, stop_m))
+        return self.trips[pid]
 
-    def get_latest_redis(self, pid, stop_position):
-        #r = self.redis
-        pipeline = self.redis.pipeline()
-        ts = pipeline.ts()
+    def load_trips(self, pid, stop_m):
+        return self.select_trips(pid, stop_m, latest_samples(self.redis, pid))
+
+    async def prefetch(self, redis_client):
+        """
+        Loads the trips of every requested pattern in one pipeline on an asyncio Redis client, so that
+        get_trips doesn't block the event loop.
+        """
+        pids = [pid for pid in self.furthest if pid not in self.trips]
+        if not pids:
+            return
+        pipeline = redis_client.pipeline(transaction=False)
+        for pid in pids:
+            pipeline.ts().mget(pattern_filter(pid))
+        for pid, reply in zip(pids, await pipeline.execute()):
+            self.trips[pid] = self.select_trips(pid, self.furthest[pid], parse_latest(reply))
+
+    def select_trips(self, pid, stop_m, samples):
         heap = []
-        heapsize = 10
-        redis_keys = self.get_redis_keys(pid)
-        for item in redis_keys:
-            ts.get(item)
-        results = pipeline.execute()
-        index = 0
         filtered = 0
-        for item in redis_keys:
-            value = results[index]
-            index += 1
-            if value[1] < stop_position.m:
+        for item, value in samples:
+            if value[1] < stop_m:
                 filtered += 1
                 continue
             heapq.heappush(heap, (value[0], item))
-            if len(heap) > heapsize:
+            if len(heap) > self.HEAPSIZE:
                 heapq.heappop(heap)
 
         if self.debug:
-            print(f'    Filtered {filtered} trips for {pid} not reaching {stop_position.m}')
+            print(f'    Filtered {filtered} trips for {pid} not reaching {stop_m}')
 
         heap.sort()
         return heap
 
-    def get_closest(self, pipeline, redis_key, dist):
+    @staticmethod
+    def lookup_key(redis_key, dist):
+        return redis_key, round(dist, 3)
+
+    def request(self, redis_key, dist):
+        """
+        Registers a lookup of the samples closest to dist (in meters) for the next execute().
+        """
+        key = self.lookup_key(redis_key, dist)
+        if key not in self.results:
+            self.lookups.setdefault(key, dist)
+
+    def request_trajectory(self, redis_key):
+        if redis_key not in self.trajectories:
+            self.trajectory_requests.add(redis_key)
+
+    def trajectory(self, redis_key):
+        return self.trajectories.get(redis_key)
+
+    def execute(self):
+        if not self.lookups and not self.trajectory_requests:
+            return
+        pipeline = self.redis.pipeline(transaction=False)
+        batch = self.queue(pipeline)
+        self.collect(batch, pipeline.execute())
+
+    async def execute_async(self, redis_client):
+        """
+        Same as execute, sent through an asyncio Redis client.
+        """
+        if not self.lookups and not self.trajectory_requests:
+            return
+        pipeline = redis_client.pipeline(transaction=False)
+        batch = self.queue(pipeline)
+        self.collect(batch, await pipeline.execute())
+
+    def queue(self, pipeline):
+        """
+        Adds the pending trajectory and closest-sample lookups to pipeline.
+        :return: what was queued, for collect
+        """
+        pending = list(self.lookups.items())
+        self.lookups = {}
+        trajectory_keys = list(self.trajectory_requests)
+        self.trajectory_requests = set()
         ts = pipeline.ts()
-        thresh = ureg.feet * 3000
-        if redis_key.decode('utf-8').startswith('train'):
-            thresh = 3000 * ureg.meter
-        ts.range(redis_key, '-', '+', count=1, aggregation_type='max', bucket_size_msec=1,
-                 filter_by_min_value=(dist-thresh).m, filter_by_max_value=dist.m)
-        ts.range(redis_key, '-', '+', count=1, aggregation_type='min', bucket_size_msec=1,
-                 filter_by_min_value=dist.m, filter_by_max_value=(dist+thresh).m)
-
-        def callback(left, right):
-            if self.debug:
-                print(f'    closest to {dist} in {redis_key}: {left}, {right}')
-            if not left and not right:
-                return None
-            if not left:
-                return right[0]
-            if not right:
-                return left[0]
-            left_ts, left_dist = left[0]
-            right_ts, right_dist = right[0]
-            if abs(dist.m - left_dist) < abs(dist.m - right_dist):
-                return left[0]
+        for redis_key in trajectory_keys:
+            ts.range(redis_key, '-', '+')
+        for (redis_key, _), dist in pending:
+            thresh = self.TRAIN_WINDOW if redis_key.startswith('train') else self.BUS_WINDOW
+            ts.range(redis_key, '-', '+', count=1, aggregation_type='max', bucket_size_msec=1,
+                     filter_by_min_value=dist - thresh, filter_by_max_value=dist)
+            ts.range(redis_key, '-', '+', count=1, aggregation_type='min', bucket_size_msec=1,
+                     filter_by_min_value=dist, filter_by_max_value=dist + thresh)
+        return trajectory_keys, pending
+
+    def collect(self, batch, results):
+        trajectory_keys, pending = batch
+        for redis_key, samples in zip(trajectory_keys, results):
+            if len(samples) < 2:
+                self.trajectories[redis_key] = None
+                continue
+            timestamps, distances = zip(*samples)
+            self.trajectories[redis_key] = monotonic_trajectory(timestamps, distances)
+        results = results[len(trajectory_keys):]
+        for index, (key, dist) in enumerate(pending):
+            left = results[2 * index]
+            right = results[2 * index + 1]
+            self.results[key] = self.pick_closest(key[0], dist, left, right)
+
+    def pick_closest(self, redis_key, dist, left, right):
+        if self.debug:
+            print(f'    closest to {dist} in {redis_key}: {left}, {right}')
+        if not left and not right:
+            return None
+        if not left:
             return right[0]
+        if not right:
+            return left[0]
+        left_ts, left_dist = left[0]
+        right_ts, right_dist = right[0]
+        if abs(dist - left_dist) < abs(dist - right_dist):
+            return left[0]
+        return right[0]
+
+    def closest(self, redis_key, dist):
+        return self.results.get(self.lookup_key(redis_key, dist))
 
-        return redis_key, callback
+
+class EstimateFinder:
+    # snap to the nearest samples around each position, or interpolate along full trip trajectories
+    ESTIMATORS = {'closest', 'interp'}
+
+    def __init__(self, redis_client, estimate_request: StopEstimate,
+                 engine=None, recalculate_positions=False,
+                 schedule_analyzer=None, trip_samples=None, profiles: ProfileBuilder = None,
+                 estimator='closest'):
+        self.redis = redis_client
+        self.estimate_request = estimate_request
+        self.debug = estimate_request.debug
+        if trip_samples is None:
+            trip_samples = TripSamples(redis_client, [estimate_request], debug=self.debug)
+        self.trip_samples: TripSamples = trip_samples
+        self.profiles = profiles
+        self.profile: PatternProfile = None
+        assert estimator in self.ESTIMATORS
+        self.estimator = estimator
+        self.vehicle_distances = None
+        self.recalculate_positions = recalculate_positions
+        self.engine = engine
+        self.schedule_analyzer = schedule_analyzer
+        if self.recalculate_positions:
+            assert self.engine is not None
+            assert self.schedule_analyzer is not None
 
     @staticmethod
     def printable_ts(ts: int):
@@ -120,31 +240,29 @@ class EstimateFinder:
                     vehicles[position_info.vehicle_id] = vehicle
             return vehicles
 
-    def get_train_distance(self, session, stop_pattern_distance, pid, train):
+    def get_train_distance(self, stop_m, pid, train):
         shape_manager: ShapeManager = self.schedule_analyzer.managed_shapes.get(pid)
-        stmt = (select(PatternStop).where(PatternStop.pattern_id == int(pid)).
-                where(PatternStop.stop_id == int(train.next_stop)))
-        try:
-            pattern_stop = session.scalar(stmt)
-        except sqlalchemy.exc.NoResultFound as e:
-            pattern_stop = None
+        pattern_stop = self.schedule_analyzer.get_pattern_stop(pid, train.next_stop)
         if pattern_stop is None:
             logger.warning(f'Could not find pattern stop {pid} {train.rt} {train.id}')
             return None
-        next_train_pattern_distance = pattern_stop.distance
+        next_train_pattern_distance, _, _ = pattern_stop
         train_wkb = train.geom
         train_point = to_shape(train_wkb)
         _, train_dist = shape_manager.get_distance_along_shape_anchor(next_train_pattern_distance, train_point, False)
-        train_dist_m = train_dist * ureg.meters
-        logger.debug(f'Got train distance: {train_dist_m} stop pattern {stop_pattern_distance}')
-        if train_dist_m > stop_pattern_distance:
+        logger.debug(f'Got train distance: {train_dist} stop pattern {stop_m}')
+        if train_dist > stop_m:
             return None
-        return train_dist_m
+        return train_dist
 
-    def get_single_estimate(self):
+    def get_vehicle_distances(self):
+        """
+        :return: list of (position info, vehicle position in meters, timestamp) for vehicles that haven't passed
+          the stop
+        """
         row = self.estimate_request
         pid = row.pattern_id
-        stop_dist = row.stop_position
+        stop_m = to_meters(row.stop_position)
         vehicles = {}
         if pid >= 300000000:
             mode = Mode.TRAIN
@@ -158,43 +276,79 @@ class EstimateFinder:
         if recalculate:
             vehicles = self.do_recalculate(mode)
             logger.debug(f'vehicles {vehicles}')
+        rv = []
         for position_info in row.vehicle_positions:
             bus_dist = None
             timestamp = None
             if row.vehicle_positions[0].vehicle_position.m == 0:
-                bus_dist = 0 * ureg.feet
+                bus_dist = 0.0
             # bus dist is position, not delta
             if recalculate and position_info.vehicle_id in vehicles:
                 recalc = vehicles[position_info.vehicle_id]
                 if mode == mode.TRAIN:
                     logger.debug(f'got train: {recalc.__dict__}')
-                    with Session(self.engine) as session:
-                        bus_dist = self.get_train_distance(session,
-                                                           stop_dist, pid, recalc)
+                    bus_dist = self.get_train_distance(stop_m, pid, recalc)
                 else:
-                    bus_dist = recalc.distance * ureg.feet
+                    bus_dist = recalc.distance * METERS_PER_FOOT
                 timestamp = recalc.last_update
             logger.debug(f'Using bus dist {bus_dist}')
             if bus_dist is None:
-                bus_dist = position_info.vehicle_position
+                bus_dist = to_meters(position_info.vehicle_position)
                 logger.debug(f'Bus dist fallback to {bus_dist}')
             if self.debug:
-                logger.debug(f'Getting estimate {pid} vehicle {bus_dist} stop {stop_dist}')
-            if bus_dist >= stop_dist:
+                logger.debug(f'Getting estimate {pid} vehicle {bus_dist} stop {stop_m}')
+            if bus_dist >= stop_m:
                 logger.debug(f'  skipping')
                 continue
-            trips = self.get_latest_redis(pid, stop_dist)
-            if self.debug:
-                logger.debug(f'  Found {len(trips)} total trips')
-            info = {"estimates": []}
-            pipeline = self.redis.pipeline()
-            estimates = []
-            pipeline_stack = []
+            rv.append((position_info, bus_dist, timestamp))
+        return rv
+
+    def request_samples(self):
+        """
+        Works out vehicle positions and registers the closest-sample lookups (or, for the interpolating
+        estimator, the trip trajectories) this estimate needs with the shared TripSamples, without sending them.
+        """
+        row = self.estimate_request
+        self.vehicle_distances = self.get_vehicle_distances()
+        if not self.vehicle_distances:
+            return
+        if self.profiles is not None:
+            self.profile = self.profiles.get(row.pattern_id)
+        if self.profile is not None:
+            # estimates come from the in-memory profile; no Redis lookups needed
+            return
+        stop_m = to_meters(row.stop_position)
+        trips = self.trip_samples.get_trips(row.pattern_id, stop_m)
+        if self.estimator == 'interp':
             for ts, redis_key in trips:
-                pipeline_stack.append(self.get_closest(pipeline, redis_key, bus_dist.to(ureg.meters)))
-                pipeline_stack.append(self.get_closest(pipeline, redis_key, stop_dist.to(ureg.meters)))
+                self.trip_samples.request_trajectory(redis_key)
+            return
+        for _, bus_dist, _ in self.vehicle_distances:
+            for ts, redis_key in trips:
+                self.trip_samples.request(redis_key, bus_dist)
+                self.trip_samples.request(redis_key, stop_m)
 
-            results = pipeline.execute()
+    def get_single_estimate(self):
+        row = self.estimate_request
+        pid = row.pattern_id
+        stop_m = to_meters(row.stop_position)
+        if self.vehicle_distances is None:
+            self.request_samples()
+        if not self.vehicle_distances:
+            return
+        if self.profile is not None:
+            yield from self.get_profile_estimates()
+            return
+        self.trip_samples.execute()
+        trips = self.trip_samples.get_trips(pid, stop_m)
+        if self.debug:
+            logger.debug(f'  Found {len(trips)} total trips')
+        if self.estimator == 'interp':
+            yield from self.get_interpolated_estimates(trips)
+            return
+        for position_info, bus_dist, timestamp in self.vehicle_distances:
+            info = {"estimates": []}
+            estimates = []
 
             def process(closest_bus, closest_stop, rk1, rk2):
                 if self.debug:
@@ -211,7 +365,7 @@ class EstimateFinder:
                     return None
                 travel_rate = travel_dist / travel_time
                 # in meters
-                actual_dist = (stop_dist - bus_dist).m
+                actual_dist = stop_m - bus_dist
                 key = datetime.datetime.fromtimestamp(stop_time_samp).isoformat()
                 d = {}
                 d['timestamp']  = key
@@ -230,73 +384,217 @@ class EstimateFinder:
                 info['estimates'].append(d)
                 return computed
 
-            while pipeline_stack:
-                rk1, cb1 = pipeline_stack.pop(0)
-                result1 = cb1(results.pop(0), results.pop(0))
-
-                rk2, cb2 = pipeline_stack.pop(0)
-                result2 = cb2(results.pop(0), results.pop(0))
+            for ts, redis_key in trips:
+                result1 = self.trip_samples.closest(redis_key, bus_dist)
+                result2 = self.trip_samples.closest(redis_key, stop_m)
 
-                result = process(result1, result2, rk1, rk2)
+                result = process(result1, result2, redis_key, redis_key)
                 if self.debug:
-                    logger.debug(f'  process {result1} {result2}  {rk1} {rk2} => {result}')
+                    logger.debug(f'  process {result1} {result2}  {redis_key} => {result}')
 
                 if result:
                     estimates.append(result)
 
-            if not estimates or len(estimates) < 2:
-                continue
+            single_estimate = self.build_estimate(position_info, bus_dist, timestamp, info, estimates)
+            if single_estimate is not None:
+                yield single_estimate
+
+    def get_profile_estimates(self):
+        """
+        Estimates from the pattern's travel-time profile: the travel time of every profiled trip between each
+        vehicle's position and the stop, computed for all vehicles at once.
+        """
+        stop_m = to_meters(self.estimate_request.stop_position)
+        from_m = np.array([bus_dist for _, bus_dist, _ in self.vehicle_distances])
+        keys, ends, travel = self.profile.travel_times(from_m, np.full(len(from_m), stop_m))
+        yield from self.estimates_from_matrix(keys, ends, travel, from_m, stop_m, 'profile')
 
-            # consider more sophisticated percentile stuff
-            stdev = statistics.stdev(estimates)
-            mean = statistics.mean(estimates)
-            considered = [x for x in estimates if abs(x - mean) < 2 * stdev]
-            if not considered:
+    def get_interpolated_estimates(self, trips):
+        """
+        Estimates from each reference trip's full trajectory: the times it passed every vehicle position and
+        the stop are interpolated with np.interp for all vehicles at once.
+        """
+        stop_m = to_meters(self.estimate_request.stop_position)
+        from_m = np.array([bus_dist for _, bus_dist, _ in self.vehicle_distances])
+        keys = []
+        at_stops = []
+        rows = []
+        for ts, redis_key in trips:
+            trajectory = self.trip_samples.trajectory(redis_key)
+            if trajectory is None:
                 continue
-            info['stdev'] = stdev
-            info['mean'] = mean
-            info['considered'] = considered
-            info['bus_position'] = bus_dist.m
-            for e in info['estimates']:
-                if abs(e['raw_estimate_seconds'] - info['mean']) > (4 * stdev):
-                    e['display'] = False
-            info['estimates'].sort(key=lambda x: x['timestamp'], reverse=True)
-            miles = lambda x: f"{x.to('mi').m:0.2f} mi" if x is not None else None
-            low_estimate = datetime.timedelta(seconds=min(considered))
-            high_estimate = datetime.timedelta(seconds=max(considered))
-            distance_to_vehicle = stop_dist - bus_dist
-            yield SingleEstimate(
-                vehicle_position=bus_dist,
-                distance_to_vehicle_mi=str(miles(distance_to_vehicle)),
-                timestamp=timestamp,
-                vehicle_id=position_info.vehicle_id,
-                low_estimate=low_estimate,
-                high_estimate=high_estimate,
-                low_mins=round(low_estimate.total_seconds() / 60),
-                high_mins=round(high_estimate.total_seconds() / 60),
-                info=info
-            )
+            times, distances = trajectory
+            at_stop = np.interp(stop_m, distances, times, left=np.nan, right=np.nan)
+            at_vehicles = np.interp(from_m, distances, times, left=np.nan, right=np.nan)
+            keys.append(redis_key)
+            at_stops.append(at_stop)
+            rows.append(at_stop - at_vehicles)
+        travel = np.array(rows).reshape(len(rows), len(from_m))
+        yield from self.estimates_from_matrix(keys, at_stops, travel, from_m, stop_m, 'interpolated')
+
+    def estimates_from_matrix(self, keys, timestamps, travel, from_m, stop_m, source):
+        """
+        :param keys: redis key of each reference trip
+        :param timestamps: when each trip reached the stop (or finished)
+        :param travel: travel times of shape (trips, vehicles), NaN where unknown
+        """
+        for column, (position_info, bus_dist, timestamp) in enumerate(self.vehicle_distances):
+            info = {"estimates": [], "source": source}
+            estimates = []
+            travel_dist = stop_m - from_m[column]
+            for redis_key, end, travel_time in zip(keys, timestamps, travel[:, column]):
+                if not np.isfinite(travel_time) or travel_time <= 0:
+                    continue
+                travel_time = float(travel_time)
+                info['estimates'].append({
+                    'timestamp': datetime.datetime.fromtimestamp(end).isoformat(),
+                    'redis_key': redis_key,
+                    'from': float(from_m[column]),
+                    'to': stop_m,
+                    'travel_time': round(travel_time / 60, 1),
+                    'travel_dist': float(travel_dist),
+                    'travel_rate': float(travel_dist / travel_time),
+                    'display': True,
+                    'raw_estimate_seconds': travel_time,
+                    'raw_estimate': round(travel_time / 60, 1),
+                })
+                estimates.append(travel_time)
+            single_estimate = self.build_estimate(position_info, bus_dist, timestamp, info, estimates)
+            if single_estimate is not None:
+                yield single_estimate
+
+    def build_estimate(self, position_info, bus_dist, timestamp, info, estimates):
+        stop_m = to_meters(self.estimate_request.stop_position)
+        estimates = np.asarray(estimates, dtype=float)
+        if len(estimates) < 2:
+            return None
+
+        # consider more sophisticated percentile stuff
+        stdev = float(np.std(estimates, ddof=1))
+        mean = float(np.mean(estimates))
+        considered = estimates[np.abs(estimates - mean) < 2 * stdev]
+        if not len(considered):
+            return None
+        info['stdev'] = stdev
+        info['mean'] = mean
+        info['considered'] = considered.tolist()
+        info['bus_position'] = bus_dist
+        raw = np.array([e['raw_estimate_seconds'] for e in info['estimates']])
+        for e, outlier in zip(info['estimates'], np.abs(raw - mean) > 4 * stdev):
+            if outlier:
+                e['display'] = False
+        info['estimates'].sort(key=lambda x: x['timestamp'], reverse=True)
+        low_estimate = datetime.timedelta(seconds=float(considered.min()))
+        high_estimate = datetime.timedelta(seconds=float(considered.max()))
+        return SingleEstimate(
+            vehicle_position=meters(bus_dist),
+            distance_to_vehicle_mi=format_miles(stop_m - bus_dist),
+            timestamp=timestamp,
+            vehicle_id=position_info.vehicle_id,
+            low_estimate=low_estimate,
+            high_estimate=high_estimate,
+            low_mins=round(low_estimate.total_seconds() / 60),
+            high_mins=round(high_estimate.total_seconds() / 60),
+            info=info
+        )
 
 
 class QueryManager:
-    def __init__(self, engine, config):
+    # meters from the query point to look for stops
+    NEARBY_THRESHOLD = 1000
+
+    # async mode connection pools, per worker process
+    DB_POOL_SIZE = 10
+    DB_POOL_OVERFLOW = 10
+    REDIS_CONNECTIONS = 50
+
+    PREDICTIONS_QUERY = """
+        select pattern_id, stop_id, destination, route, timestamp, prediction from bus_prediction 
+        inner join schedule_destinations
+        on bus_prediction.stop_id = schedule_destinations.first_stop_id and bus_prediction.destination = schedule_destinations.destination_headsign
+        and bus_prediction.route = schedule_destinations.route_id
+        inner join pattern_destinations
+        on bus_prediction.stop_id = pattern_destinations.origin_stop
+        and bus_prediction.route = pattern_destinations.rt
+        and bus_prediction.prediction_type = 'D'
+        and schedule_destinations.last_stop_id = pattern_destinations.last_stop
+        where timestamp + make_interval(mins => prediction) >= now() at time zone 'America/Chicago'
+        and pattern_id = ANY(:pids)
+        order by pattern_id
+    """
+
+    def __init__(self, engine, config, schedule_analyzer: ScheduleAnalyzer = None, catalog_file=None):
+        """
+        :param schedule_analyzer: given together with catalog_file, its shapes and train pattern stops are set
+          from the catalog snapshot instead of by setup_shapes
+        :param catalog_file: path of a CatalogSnapshot file. If it can be read, startup uses it without touching
+          Postgres or the scraper and the catalog is refreshed in the background; otherwise the catalog is
+          loaded and the file written.
+        """
         self.engine = engine
         self.config = config
         self.patterns = {}
         self.redis = redis.Redis(host=self.config.get_server('redis-vehicle-history'))
-        logger.debug(f'Initialize redis: {self.redis.ping()}')
-        query = ('select p.pattern_id, pattern_stop.stop_id, stop.stop_name from pattern_stop inner join '
-                 '(select pattern_id, max(sequence) as endseq from pattern_stop group by pattern_id) as p '
-                 'on p.endseq = pattern_stop.sequence and p.pattern_id = pattern_stop.pattern_id inner join '
-                 'stop on stop.id = pattern_stop.stop_id')
         self.last_stops = {}
-        with Session(engine) as session:
-            rows = session.execute(text(query))
-            for row in rows:
-                pid, stop_id, stop_name = row
-                self.last_stops[pid] = (stop_id, stop_name)
-        self.load_pattern_info()
-        self.report()
+        self.schedule_analyzer = schedule_analyzer
+        self.catalog_file = catalog_file
+        self.catalog_snapshot = None
+        self.catalog_thread = None
+        if catalog_file is None:
+            logger.debug(f'Initialize redis: {self.redis.ping()}')
+            self.last_stops = self.query_last_stops()
+            self.load_pattern_info()
+            self.report()
+        else:
+            self.catalog_snapshot = CatalogSnapshot.read(catalog_file)
+            # a snapshot read from disk is refreshed right away, a freshly loaded one on the next reload
+            refresh_delay = 0
+            if self.catalog_snapshot is None:
+                self.catalog_snapshot = self.load_catalog()
+                self.write_catalog()
+                refresh_delay = StopCatalog.RELOAD_INTERVAL
+            self.catalog_thread = threading.Thread(target=self.refresh_catalog, args=(refresh_delay,),
+                                                   name='catalog-snapshot', daemon=True)
+        if Util.env_flag('STOP_CATALOG', default=True):
+            if self.catalog_snapshot is None:
+                self.catalog = StopCatalog(engine)
+            else:
+                self.catalog = StopCatalog(engine, index=StopIndex(self.catalog_snapshot.stops))
+        else:
+            self.catalog = SqlStopFinder(engine)
+        if self.catalog_snapshot is None:
+            self.catalog.start()
+        else:
+            # the snapshot thread keeps the stop index current instead of the catalog's own reload
+            self.apply_catalog(self.catalog_snapshot)
+            self.catalog_thread.start()
+        self.vehicles = VehicleSnapshot(engine)
+        self.vehicles.start()
+        self.trains = None
+        self.walking = WalkingTimes(self.config.get_server('valhalla'),
+                                    redis_client=self.redis if Util.env_flag('WALKING_REDIS_CACHE') else None)
+        self.responses = None
+        if Util.env_flag('RESPONSE_CACHE', default=True):
+            self.responses = ResponseCache(self.vehicles)
+        self.async_engine = None
+        self.async_redis = None
+        if Util.env_flag('QUERY_ASYNC'):
+            # asyncpg and redis.asyncio; requests wait for a free connection rather than opening unbounded ones
+            self.async_engine = create_async_engine(engine.url.set(drivername='postgresql+asyncpg'),
+                                                    pool_size=self.DB_POOL_SIZE, max_overflow=self.DB_POOL_OVERFLOW,
+                                                    pool_pre_ping=True)
+            self.async_redis = redis.asyncio.Redis(connection_pool=redis.asyncio.BlockingConnectionPool(
+                host=self.config.get_server('redis-vehicle-history'), max_connections=self.REDIS_CONNECTIONS))
+        self.estimator = os.getenv('ESTIMATOR', 'closest')
+        self.profiles = None
+        if Util.env_flag('ESTIMATE_PROFILES'):
+            self.profiles = ProfileBuilder(self.redis)
+            self.profiles.start()
+
+    def train_query(self, schedule_analyzer: ScheduleAnalyzer) -> 'TrainQuery':
+        if self.trains is None or self.trains.schedule_analyzer is not schedule_analyzer:
+            self.trains = TrainQuery(self.engine, schedule_analyzer, self.catalog, self.vehicles)
+        return self.trains
 
     def report(self):
         print(f'Database stats at load time')
@@ -305,20 +603,109 @@ class QueryManager:
                 count = conn.execute(select(func.count('*')).select_from(table)).all()
                 print(f'table {table} has count {count}')
 
-    def load_pattern_info(self):
+    def query_last_stops(self):
+        """
+        :return: dict of pattern id to (last stop id, last stop name)
+        """
+        query = ('select p.pattern_id, pattern_stop.stop_id, stop.stop_name from pattern_stop inner join '
+                 '(select pattern_id, max(sequence) as endseq from pattern_stop group by pattern_id) as p '
+                 'on p.endseq = pattern_stop.sequence and p.pattern_id = pattern_stop.pattern_id inner join '
+                 'stop on stop.id = pattern_stop.stop_id')
+        last_stops = {}
+        with Session(self.engine) as session:
+            rows = session.execute(text(query))
+            for row in rows:
+                pid, stop_id, stop_name = row
+                last_stops[pid] = (stop_id, stop_name)
+        return last_stops
+
+    def fetch_pattern_info(self):
+        """
+        :return: dict of pattern id to pattern info from the scraper, or None if it couldn't be reached
+        """
         url = f'{self.config.get_server("scrape-service"    )}/patterninfo'
-        resp = requests.get(url)
+        try:
+            resp = requests.get(url, timeout=30)
+        except requests.RequestException as e:
+            logger.warning(f'Error loading patterns: {e}')
+            return None
         if resp.status_code != 200:
             logger.warning(f'Error loading patterns: {resp.status_code}')
-            return
+            return None
         patterns = resp.json()['pattern_info']
-        for p in patterns:
-            self.patterns[p['pattern_id']] = p
+        return {p['pattern_id']: p for p in patterns}
+
+    def load_pattern_info(self):
+        patterns = self.fetch_pattern_info()
+        if patterns is not None:
+            self.patterns.update(patterns)
+
+    def load_catalog(self) -> CatalogSnapshot:
+        """
+        Loads every part of a CatalogSnapshot concurrently. Pattern info falls back to the current copy when the
+        scraper is down.
+        """
+        start = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
+            last_stops = executor.submit(self.query_last_stops)
+            patterns = executor.submit(self.fetch_pattern_info)
+            stops = executor.submit(StopCatalog.query, self.engine)
+            shapes = pattern_stops = None
+            if self.schedule_analyzer is not None:
+                shapes = executor.submit(self.schedule_analyzer.query_shapes)
+                pattern_stops = executor.submit(self.schedule_analyzer.query_pattern_stops)
+            snapshot = CatalogSnapshot(
+                last_stops=last_stops.result(),
+                patterns=patterns.result(),
+                stops=stops.result(),
+                shapes=shapes.result() if shapes is not None else [],
+                pattern_stops=pattern_stops.result() if pattern_stops is not None else [],
+                created=datetime.datetime.now(),
+            )
+        if snapshot.patterns is None:
+            logger.warning(f'Using {len(self.patterns)} cached patterns')
+            snapshot.patterns = self.patterns
+        logger.info(f'Loaded catalog in {time.monotonic() - start:.2f}s')
+        return snapshot
+
+    def write_catalog(self):
+        try:
+            self.catalog_snapshot.write(self.catalog_file)
+        except OSError as e:
+            logger.warning(f'Error writing catalog snapshot {self.catalog_file}: {e}')
+
+    def apply_catalog(self, snapshot: CatalogSnapshot):
+        """
+        Switches to the snapshot's last stops, pattern info, train shapes and train pattern stops. The stop index
+        is built separately since it is the slowest part.
+        """
+        self.last_stops = snapshot.last_stops
+        self.patterns = snapshot.patterns
+        if self.schedule_analyzer is not None and snapshot.shapes:
+            self.schedule_analyzer.build_shapes(snapshot.shapes)
+            self.schedule_analyzer.set_pattern_stops(snapshot.pattern_stops)
+
+    def refresh_catalog(self, delay):
+        while True:
+            time.sleep(delay)
+            delay = StopCatalog.RELOAD_INTERVAL
+            try:
+                snapshot = self.load_catalog()
+            except Exception as e:
+                logger.warning(f'Error refreshing catalog: {e}')
+                continue
+            if isinstance(self.catalog, StopCatalog):
+                self.catalog.index = StopIndex(snapshot.stops)
+            self.apply_catalog(snapshot)
+            self.catalog_snapshot = snapshot
+            self.write_catalog()
 
     async def get_estimates(self, request: StopEstimates,
                             schedule_analyzer=None) -> EstimateResponse:
         rv = EstimateResponse(patterns=[])
         rows = request.estimates
+        trip_samples = TripSamples(self.redis, rows, debug=any(row.debug for row in rows))
+        finders = []
         for row in rows:
             response = PatternResponse(
                 pattern_id=row.pattern_id,
@@ -328,131 +715,96 @@ class QueryManager:
             estimate_finder = EstimateFinder(self.redis, row,
                                              self.engine,
                                              recalculate_positions=request.recalculate_positions,
-                                             schedule_analyzer=schedule_analyzer)
+                                             schedule_analyzer=schedule_analyzer,
+                                             trip_samples=trip_samples,
+                                             profiles=self.profiles,
+                                             estimator=self.estimator)
+            finders.append((response, estimate_finder))
+        if self.async_redis is not None:
+            await trip_samples.prefetch(self.async_redis)
+        for _, estimate_finder in finders:
+            estimate_finder.request_samples()
+        # one pipeline for the closest-sample lookups of every stop and vehicle in the request
+        if self.async_redis is not None:
+            await trip_samples.execute_async(self.async_redis)
+        else:
+            trip_samples.execute()
+        for response, estimate_finder in finders:
             for single_estimate in estimate_finder.get_single_estimate():
                 response.single_estimates.append(single_estimate)
             rv.patterns.append(response)
         return rv
 
+    def nearby_bus_stops(self, lat, lon):
+        # nearest stop of each pattern comes from the in-memory catalog; only live state is queried
+        return self.catalog.nearest(float(lat), float(lon), self.NEARBY_THRESHOLD, Mode.BUS)
+
     def nearest_stop_vehicles(self, lat, lon) -> list[BusEstimate]:
-        query = """
-        select current_vehicle_state.last_update, current_vehicle_state.distance,
-            current_vehicle_state.id as vehicle_id, stop_pattern_distance, 
-            pattern_id, x.rt, x.id as stop_id, stop_name, st_y(stop_geom) as stop_lat, st_x(stop_geom) as stop_lon, dist 
-            from (
-                 select DISTINCT ON (pattern_id) pattern_id, rt, id, stop_name, stop_geom, dist, stop_pattern_distance 
-                 from (
-                     select stop.id, pattern_stop.pattern_id, stop_name, stop.geom as stop_geom, 
-                     pattern_stop.distance as stop_pattern_distance, pattern.rt, 
-                     ST_TRANSFORM(geom, 26916) <-> ST_TRANSFORM(\'SRID=4326;POINT(:lon :lat)\'\\:\\:geometry, 26916) as dist 
-                     from stop 
-                        inner join pattern_stop on stop.id = pattern_stop.stop_id 
-                        inner join pattern on pattern_stop.pattern_id = pattern.id ORDER BY dist
-                 ) WHERE dist < :thresh ORDER BY pattern_id, dist
-            ) as x 
-              left join current_vehicle_state on current_vehicle_state.pid = pattern_id 
-               
-              order by dist, distance
-        """
+        nearby = self.nearby_bus_stops(lat, lon)
+        if not nearby:
+            return []
+        with Session(self.engine) as session:
+            prediction_result = session.execute(text(self.PREDICTIONS_QUERY),
+                                                {"pids": [stop.pattern_id for stop in nearby]}).all()
+        return self.bus_estimates(nearby, prediction_result)
 
-        predictions = """
-            select pattern_id, stop_id, destination, route, timestamp, prediction from bus_prediction 
-            inner join schedule_destinations
-            on bus_prediction.stop_id = schedule_destinations.first_stop_id and bus_prediction.destination = schedule_destinations.destination_headsign
-            and bus_prediction.route = schedule_destinations.route_id
-            inner join pattern_destinations
-            on bus_prediction.stop_id = pattern_destinations.origin_stop
-            and bus_prediction.route = pattern_destinations.rt
-            and bus_prediction.prediction_type = 'D'
-            and schedule_destinations.last_stop_id = pattern_destinations.last_stop
-            where timestamp + make_interval(mins => prediction) >= now() at time zone 'America/Chicago'
-            and pattern_id in (
-            
-            select pattern_id from (
-            select DISTINCT ON (pattern_id) pattern_id, rt, id, stop_name, stop_geom, dist, stop_pattern_distance 
-                             from (
-                                 select stop.id, pattern_stop.pattern_id, stop_name, stop.geom as stop_geom, 
-                                 pattern_stop.distance as stop_pattern_distance, pattern.rt, 
-                                 ST_TRANSFORM(geom, 26916) <-> ST_TRANSFORM(\'SRID=4326;POINT(:lon :lat)\'\\:\\:geometry, 26916) as dist 
-                                 from stop 
-                                    inner join pattern_stop on stop.id = pattern_stop.stop_id 
-                                    inner join pattern on pattern_stop.pattern_id = pattern.id ORDER BY dist
-                             ) WHERE dist < :thresh ORDER BY pattern_id, dist
-            )                 
-            
-            )
-            order by pattern_id
+    async def nearest_stop_vehicles_async(self, lat, lon) -> list[BusEstimate]:
         """
+        nearest_stop_vehicles without blocking the event loop: through the async engine in async mode,
+        otherwise on a worker thread.
+        """
+        if self.async_engine is None:
+            return await asyncio.to_thread(self.nearest_stop_vehicles, lat, lon)
+        nearby = self.nearby_bus_stops(lat, lon)
+        if not nearby:
+            return []
+        async with self.async_engine.connect() as connection:
+            prediction_result = (await connection.execute(text(self.PREDICTIONS_QUERY),
+                                                          {"pids": [stop.pattern_id for stop in nearby]})).all()
+        return self.bus_estimates(nearby, prediction_result)
+
+    def bus_estimates(self, nearby, prediction_result) -> list[BusEstimate]:
+        snapshot = self.vehicles.get()
         #routes = {}
         all_items = []
-        with Session(self.engine) as session:
-            result = session.execute(text(query), {"lat": float(lat), "lon": float(lon), "thresh": 1000})
-            prediction_result = session.execute(text(predictions),
-                                                {"lat": float(lat), "lon": float(lon), "thresh": 1000})
-            startquery = Util.ctanow().replace(tzinfo=None)
-            predictions = {}
-            seen = set([])
-            for p in prediction_result:
-                key = p.pattern_id
-                predictions[key] = p
-            local_now = Util.ctanow()
-            for row in result:
-                row_distance = row.distance
-                logger.debug(f'Looking for pattern {row.pattern_id}  distance {row_distance} stop distance {row.stop_pattern_distance}')
-                last_stop_id, last_stop_name = self.last_stops.get(row.pattern_id, (None, None))
-                if last_stop_id is None:
-                    logger.debug(f'No last stop found for {row.pattern_id} - {row.stop_name} {row.rt}')
-                    continue
-                info = self.patterns.get(row.pattern_id, {})
-                direction = info.get('direction')
-                if direction is None:
-                    logger.debug(f'Warning: Unknown direction in route {row.rt} pattern {row.pattern_id}')
-                    direction = 'unknown'
-                row_update = row.last_update
-                if row_distance is None or row_distance >= row.stop_pattern_distance:
-                    prediction = predictions.get(row.pattern_id)
-                    if prediction is None:
-                        logger.debug(f'No prediction found for {row.pattern_id} - {row.stop_name} {row.rt}')
-                        continue
-                    if row.pattern_id in seen:
-                        continue
-                    row_distance = 0
-                    seen.add(row.pattern_id)
-                    row_update = prediction.timestamp
-                    predicted_minutes = prediction.prediction
-
-                    pts = Util.CTA_TIMEZONE.localize(prediction.timestamp)
-                    age = (local_now - pts).total_seconds() / 60
-                    predicted_minutes = round(predicted_minutes - age)
-                    logger.debug(f'Prediction: {row.pattern_id} - {row.stop_name} {row.rt} / {row_update} mins raw {prediction.prediction} adjusted {predicted_minutes}  age {age}')
-                    dxx = BusEstimate(
-                        query_start=startquery,
-                        pattern=row.pattern_id,
-                        route=row.rt,
-                        direction=direction,
-                        stop_id=row.stop_id,
-                        stop_name=row.stop_name,
-                        stop_lat=row.stop_lat,
-                        stop_lon=row.stop_lon,
-                        stop_position=Q_(row.stop_pattern_distance, 'ft'),
-                        vehicle_position=Q_(row_distance, 'ft'),
-                        distance_from_vehicle=Q_(row.stop_pattern_distance, 'ft'),
-                        last_update=row_update,
-                        distance_to_stop=Q_(row.dist, 'm'),
-                        age=datetime.timedelta(seconds=age),
-                        destination_stop_id=last_stop_id,
-                        destination_stop_name=last_stop_name,
-                        waiting_to_depart=True,
-                        predicted_minutes=datetime.timedelta(minutes=predicted_minutes),
-                        vehicle=row.vehicle_id,
-                    )
-                    all_items.append(dxx)
+        startquery = Util.ctanow().replace(tzinfo=None)
+        predictions = {}
+        seen = set([])
+        for p in prediction_result:
+            key = p.pattern_id
+            predictions[key] = p
+        local_now = Util.ctanow()
+        # nearest stops first, then each pattern's vehicles by distance; None for patterns without vehicles
+        result = [(row, vehicle) for row in nearby for vehicle in snapshot.buses(row.pattern_id) or [None]]
+        for row, vehicle in result:
+            row_distance = vehicle.distance if vehicle else None
+            logger.debug(f'Looking for pattern {row.pattern_id}  distance {row_distance} stop distance {row.stop_pattern_distance}')
+            last_stop_id, last_stop_name = self.last_stops.get(row.pattern_id, (None, None))
+            if last_stop_id is None:
+                logger.debug(f'No last stop found for {row.pattern_id} - {row.stop_name} {row.rt}')
+                continue
+            info = self.patterns.get(row.pattern_id, {})
+            direction = info.get('direction')
+            if direction is None:
+                logger.debug(f'Warning: Unknown direction in route {row.rt} pattern {row.pattern_id}')
+                direction = 'unknown'
+            row_update = vehicle.last_update if vehicle else None
+            if row_distance is None or row_distance >= row.stop_pattern_distance:
+                prediction = predictions.get(row.pattern_id)
+                if prediction is None:
+                    logger.debug(f'No prediction found for {row.pattern_id} - {row.stop_name} {row.rt}')
                     continue
-                if row_distance >= row.stop_pattern_distance:
+                if row.pattern_id in seen:
                     continue
-                bus_distance = row.stop_pattern_distance - row_distance
+                row_distance = 0
+                seen.add(row.pattern_id)
+                row_update = prediction.timestamp
+                predicted_minutes = prediction.prediction
 
-                age = (startquery - row_update).total_seconds()
+                pts = Util.CTA_TIMEZONE.localize(prediction.timestamp)
+                age = (local_now - pts).total_seconds() / 60
+                predicted_minutes = round(predicted_minutes - age)
+                logger.debug(f'Prediction: {row.pattern_id} - {row.stop_name} {row.rt} / {row_update} mins raw {prediction.prediction} adjusted {predicted_minutes}  age {age}')
                 dxx = BusEstimate(
                     query_start=startquery,
                     pattern=row.pattern_id,
@@ -464,16 +816,44 @@ class QueryManager:
                     stop_lon=row.stop_lon,
                     stop_position=Q_(row.stop_pattern_distance, 'ft'),
                     vehicle_position=Q_(row_distance, 'ft'),
-                    distance_from_vehicle=Q_(bus_distance, 'ft'),
+                    distance_from_vehicle=Q_(row.stop_pattern_distance, 'ft'),
                     last_update=row_update,
                     distance_to_stop=Q_(row.dist, 'm'),
                     age=datetime.timedelta(seconds=age),
                     destination_stop_id=last_stop_id,
                     destination_stop_name=last_stop_name,
-                    waiting_to_depart=False,
-                    vehicle=row.vehicle_id,
+                    waiting_to_depart=True,
+                    predicted_minutes=datetime.timedelta(minutes=predicted_minutes),
+                    vehicle=vehicle.id if vehicle else None,
                 )
                 all_items.append(dxx)
+                continue
+            if row_distance >= row.stop_pattern_distance:
+                continue
+            bus_distance = row.stop_pattern_distance - row_distance
+
+            age = (startquery - row_update).total_seconds()
+            dxx = BusEstimate(
+                query_start=startquery,
+                pattern=row.pattern_id,
+                route=row.rt,
+                direction=direction,
+                stop_id=row.stop_id,
+                stop_name=row.stop_name,
+                stop_lat=row.stop_lat,
+                stop_lon=row.stop_lon,
+                stop_position=Q_(row.stop_pattern_distance, 'ft'),
+                vehicle_position=Q_(row_distance, 'ft'),
+                distance_from_vehicle=Q_(bus_distance, 'ft'),
+                last_update=row_update,
+                distance_to_stop=Q_(row.dist, 'm'),
+                age=datetime.timedelta(seconds=age),
+                destination_stop_id=last_stop_id,
+                destination_stop_name=last_stop_name,
+                waiting_to_depart=False,
+                vehicle=vehicle.id if vehicle else None,
+            )
+            all_items.append(dxx)
         return all_items
 
     async def detail(self, request: DetailRequest):
@@ -483,52 +863,46 @@ class QueryManager:
                 vehicle_positions=[]
         )
 
-        with Session(self.engine) as session:
-            # TODO: make this work for buses
-            pid = request.pattern_id
-            if pid >= 300000000:
-                mode = Mode.TRAIN
-            else:
-                mode = Mode.BUS
-            if mode == mode.TRAIN:
-                return None
-            elif mode == mode.BUS:
-                dist_ft = request.stop_position.to(ureg.feet).m
-                stmt = (select(CurrentVehicleState)
-                        .where(CurrentVehicleState.pid == pid)
-                        .where(CurrentVehicleState.distance < dist_ft)
-                        .order_by(CurrentVehicleState.distance))
-            result = session.scalars(stmt)
-            rt = None
-            rv = []
-            rd = {}
-            for row in result:
-                vehicle_position = row.distance * ureg.feet
-                stop_estimate.vehicle_positions.append(vehicle_position)
-                rt = row.rt
-                rd[vehicle_position] = row
-
-            response = await self.get_estimates(StopEstimates(estimates=[stop_estimate]))
-            rp = response.patterns[0]
-            d = lambda x: round(x.total_seconds() / 60)
-            for single_estimate in rp.single_estimates:
-                mi_from_here = (request.stop_position - single_estimate.vehicle_position).to('mi')
-                row = rd[single_estimate.vehicle_position]
-                rv.append({
-                    'bus_pattern_dist': single_estimate.vehicle_position,
-                    'mi_from_here': f'{mi_from_here:.2f~P}',
-                    'timestamp': row.last_update.isoformat(),
-                    'vid': row.id,
-                    'destination': row.destination,
-                    'estimate': f'{d(single_estimate.low_estimate)} min - {d(single_estimate.high_estimate)} min'
-                })
-            return {
-                'rt': rt,
-                'pid': pid,
-                'stop_distance': f'{request.stop_position:.2f~P}',
-                'updates': rv
-            }
+        # TODO: make this work for buses
+        pid = request.pattern_id
+        if pid >= 300000000:
+            mode = Mode.TRAIN
+        else:
+            mode = Mode.BUS
+        if mode == mode.TRAIN:
+            return None
+        elif mode == mode.BUS:
+            dist_ft = request.stop_position.to(ureg.feet).m
+            result = self.vehicles.get().buses(pid, max_distance=dist_ft)
+        rt = None
+        rv = []
+        rd = {}
+        for row in result:
+            vehicle_position = row.distance * ureg.feet
+            stop_estimate.vehicle_positions.append(vehicle_position)
+            rt = row.rt
+            rd[vehicle_position] = row
 
+        response = await self.get_estimates(StopEstimates(estimates=[stop_estimate]))
+        rp = response.patterns[0]
+        d = lambda x: round(x.total_seconds() / 60)
+        for single_estimate in rp.single_estimates:
+            mi_from_here = (request.stop_position - single_estimate.vehicle_position).to('mi')
+            row = rd[single_estimate.vehicle_position]
+            rv.append({
+                'bus_pattern_dist': single_estimate.vehicle_position,
+                'mi_from_here': f'{mi_from_here:.2f~P}',
+                'timestamp': row.last_update.isoformat(),
+                'vid': row.id,
+                'destination': row.destination,
+                'estimate': f'{d(single_estimate.low_estimate)} min - {d(single_estimate.high_estimate)} min'
+            })
+        return {
+            'rt': rt,
+            'pid': pid,
+            'stop_distance': f'{request.stop_position:.2f~P}',
+            'updates': rv
+        }
 
 class TrainQuery:
     DIRECTION_MAPPING = {
@@ -559,111 +933,89 @@ class TrainQuery:
     Maintains state for train position queries. There are far fewer trains and the live updates don't have pattern info,
     so we gather the data from the database and join here
     """
-    def __init__(self, engine, schedule_analyzer: ScheduleAnalyzer):
+    # patterns left out of train results
+    EXCLUDED_PATTERNS = {308500040, 308500084, 308500128, 308500129, 308500022, 308500029, 308500038, 308500039}
+
+    def __init__(self, engine, schedule_analyzer: ScheduleAnalyzer, catalog: StopCatalog | SqlStopFinder,
+                 vehicles: VehicleSnapshot):
         self.engine = engine
         self.schedule_analyzer = schedule_analyzer
+        self.catalog = catalog
+        self.vehicles = vehicles
 
     def get_relevant_stops(self, lat, lon) -> list[TrainEstimate]:
         # TODO: handle rare trips better
-        query = """
-        select 
-            stop_pattern_distance, pid, 
-            x.rt as xrt, x.id as stop_id, stop_name, st_y(stop_geom) as stop_lat, st_x(stop_geom) as stop_lon, dist, last_stop.stop_id as last_stop_id, stop_headsign, direction_change
-            from 
-            (
-             select DISTINCT ON (pattern_id, stop_headsign) pattern_id as pid, rt, id, stop_name, stop_geom, dist, stop_pattern_distance, stop_headsign, direction_change from (
-        
-                select stop.id, pattern_stop.pattern_id, stop_name, stop.geom as stop_geom, pattern_stop.distance as stop_pattern_distance, pattern.rt, 
-                pattern_stop.stop_headsign, pattern_stop.direction_change,
-                ST_TRANSFORM(geom, 26916) <-> ST_TRANSFORM('SRID=4326;POINT(:lon :lat)'\\:\\:geometry, 26916) as dist from 
-                  stop 
-                    inner join pattern_stop on stop.id = pattern_stop.stop_id inner join pattern on pattern_stop.pattern_id = pattern.id 
-                    WHERE pattern.id > 300000000
-                    ORDER BY dist
-                ) 
-        
-              WHERE dist < :thresh ORDER BY pattern_id, stop_headsign, dist
-                )
-            as x 
-            INNER JOIN last_stop on last_stop.pattern_id = x.pid
-            WHERE pid not in ('308500040', '308500084', '308500128', '308500129', '308500022', '308500029', '308500038', '308500039')
-            order by dist
-        """
+        # nearest stop of each train pattern and headsign, from the in-memory catalog
+        result = [row for row in self.catalog.nearest(float(lat), float(lon), QueryManager.NEARBY_THRESHOLD,
+                                                      Mode.TRAIN)
+                  if row.pattern_id not in self.EXCLUDED_PATTERNS and row.last_stop_id is not None]
         startquery = Util.ctanow().replace(tzinfo=None)
-        with Session(self.engine) as session:
-            state_query = 'select * from current_train_state'
-            trains = {}
-            current_state = session.execute(text(state_query))
-            for row in current_state:
-                logger.debug(f'Found {row.dest_station}')
-                key = (row.dest_station, row.direction)
-                trains.setdefault(key, []).append(row)
-
-            rv = []
-
-            result = session.execute(text(query), {"lat": float(lat), "lon": float(lon),
-                                                   "thresh": 1000})
-
-            for row in result:
-                logger.debug(f'Found {row}')
-                shape_manager: ShapeManager = self.schedule_analyzer.managed_shapes.get(row.pid)
-                direction = self.DIRECTION_MAPPING.get((row.xrt, row.stop_headsign))
-                if not direction:
-                    logger.debug(f'Unrecognized route / headsign combo: {row.xrt}, {row.stop_headsign}')
+        # current trains grouped by (destination station, direction)
+        trains = self.vehicles.get().trains
+        rv = []
+
+        for row in result:
+            logger.debug(f'Found {row}')
+            shape_manager: ShapeManager = self.schedule_analyzer.managed_shapes.get(row.pattern_id)
+            direction = self.DIRECTION_MAPPING.get((row.rt, row.stop_headsign))
+            if not direction:
+                logger.debug(f'Unrecognized route / headsign combo: {row.rt}, {row.stop_headsign}')
+                continue
+            key = (row.last_stop_id, direction)
+            if direction == 1:
+                dirname = "Northbound"
+            else:
+                dirname = "Southbound"
+            pattern_trains = trains.get(key)
+            if not pattern_trains:
+                continue
+            stop_id = row.stop_id
+            rt = row.rt
+            projected = []
+            for train in pattern_trains:
+                pattern_stop = self.schedule_analyzer.get_pattern_stop(row.pattern_id, train.next_stop)
+                if pattern_stop is None:
+                    logger.debug(f'Could not find pattern stop {row.pattern_id} {rt} {train.id}')
                     continue
-                key = (row.last_stop_id, direction)
-                if direction == 1:
-                    dirname = "Northbound"
-                else:
-                    dirname = "Southbound"
-                pattern_trains = trains.get(key)
-                if not pattern_trains:
+                next_train_pattern_distance, _, _ = pattern_stop
+                projected.append((train, next_train_pattern_distance))
+            if not projected:
+                continue
+            _, train_dists = shape_manager.get_distances_along_shape_anchor(
+                np.array([train.lon for train, _ in projected], dtype=float),
+                np.array([train.lat for train, _ in projected], dtype=float),
+                np.array([d for _, d in projected], dtype=float))
+            for (train, next_train_pattern_distance), train_dist in zip(projected, train_dists):
+                train_dist = float(train_dist)
+                if train_dist > row.stop_pattern_distance:
                     continue
-                stop_id = row.stop_id
-                rt = row.xrt
-                for train in pattern_trains:
-                    stmt = (select(PatternStop).where(PatternStop.pattern_id == int(row.pid)).
-                            where(PatternStop.stop_id == int(train.next_stop)))
-                    try:
-                        pattern_stop = session.scalar(stmt)
-                    except sqlalchemy.exc.NoResultFound as e:
-                        pattern_stop = None
-                    if pattern_stop is None:
-                        logger.debug(f'Could not find pattern stop {row.pid} {rt} {train.id}')
-                        continue
-                    next_train_pattern_distance = pattern_stop.distance
-                    train_wkb = geoalchemy2.elements.WKBElement(train.geom)
-                    train_point = to_shape(train_wkb)
-                    _, train_dist = shape_manager.get_distance_along_shape_anchor(next_train_pattern_distance, train_point, False)
-                    if train_dist > row.stop_pattern_distance:
-                        continue
-                    dist_from_train = row.stop_pattern_distance - train_dist
-                    age = (startquery - train.last_update).total_seconds()
-                    result = TrainEstimate(
-                        query_start=startquery,
-                        pattern=row.pid,
-                        route=rt,
-                        direction=dirname,
-                        destination=train.dest_station_name,
-                        run=train.id,
-                        stop_id=stop_id,
-                        stop_name=row.stop_name,
-                        stop_lat=row.stop_lat,
-                        stop_lon=row.stop_lon,
-                        stop_position=Q_(row.stop_pattern_distance, 'm'),
-                        vehicle_position=Q_(train_dist, 'm'),
-                        distance_from_vehicle=Q_(dist_from_train, 'm'),
-                        distance_to_stop=Q_(row.dist, 'm'),
-                        age=datetime.timedelta(seconds=age),
-                        destination_stop_id=train.dest_station,
-                        destination_stop_name=train.dest_station_name,
-                        next_stop_position=Q_(next_train_pattern_distance, 'm'),
-                        next_stop_id=train.next_stop,
-                        waiting_to_depart=False,
-                        last_update=train.last_update,
-                    )
-                    rv.append(result)
-            return rv
+                dist_from_train = row.stop_pattern_distance - train_dist
+                age = (startquery - train.last_update).total_seconds()
+                result = TrainEstimate(
+                    query_start=startquery,
+                    pattern=row.pattern_id,
+                    route=rt,
+                    direction=dirname,
+                    destination=train.dest_station_name,
+                    run=train.id,
+                    stop_id=stop_id,
+                    stop_name=row.stop_name,
+                    stop_lat=row.stop_lat,
+                    stop_lon=row.stop_lon,
+                    stop_position=Q_(row.stop_pattern_distance, 'm'),
+                    vehicle_position=Q_(train_dist, 'm'),
+                    distance_from_vehicle=Q_(dist_from_train, 'm'),
+                    distance_to_stop=Q_(row.dist, 'm'),
+                    age=datetime.timedelta(seconds=age),
+                    destination_stop_id=train.dest_station,
+                    destination_stop_name=train.dest_station_name,
+                    next_stop_position=Q_(next_train_pattern_distance, 'm'),
+                    next_stop_id=train.next_stop,
+                    waiting_to_depart=False,
+                    last_update=train.last_update,
+                )
+                rv.append(result)
+        return rv
 
 
 def main():
@@ -0,0 +1,70 @@
+import asyncio
+import datetime
+import time
+
+from prometheus_client import Counter
+
+
+class ResponseCache:
+    """
+    Short lived cache of the shared part of a combined estimate: the vehicles approaching stops near a point
+    and their arrival estimates. Query points are snapped to the center of a CELL_DEGREES grid cell, so nearby
+    users share one computation. An entry lasts until the vehicle snapshot it was computed from is replaced, and
+    never longer than TTL. Concurrent misses for the same cell wait on a single computation instead of each
+    starting their own.
+    """
+    CELL_DEGREES = 0.002
+    TTL = datetime.timedelta(seconds=30)
+    MAX_ENTRIES = 10000
+
+    def __init__(self, vehicles):
+        self.vehicles = vehicles
+        # cell -> (snapshot version, expiry, value)
+        self.entries = {}
+        # cell -> task computing it
+        self.pending = {}
+        self.lookup_counter = Counter('transit_response_cache', 'Combined estimate cache lookups by result',
+                                      ['result'])
+
+    @classmethod
+    def cell(cls, lat, lon):
+        return round(lat / cls.CELL_DEGREES), round(lon / cls.CELL_DEGREES)
+
+    @classmethod
+    def cell_center(cls, cell):
+        return cell[0] * cls.CELL_DEGREES, cell[1] * cls.CELL_DEGREES
+
+    async def get(self, lat, lon, compute):
+        """
+        :param compute: coroutine function called with the cell center (lat, lon) on a miss
+        :return: the cached or newly computed value for the cell containing lat, lon
+        """
+        cell = self.cell(lat, lon)
+        version = self.vehicles.get().version
+        entry = self.entries.get(cell)
+        if entry is not None and entry[0] == version and entry[1] > time.monotonic():
+            self.lookup_counter.labels(result='hit').inc()
+            return entry[2]
+        task = self.pending.get(cell)
+        if task is None:
+            self.lookup_counter.labels(result='miss').inc()
+            task = asyncio.ensure_future(self.fill(cell, version, compute(*self.cell_center(cell))))
+            self.pending[cell] = task
+        else:
+            self.lookup_counter.labels(result='coalesced').inc()
+        # a cancelled request must not cancel the computation other requests are waiting on
+        return await asyncio.shield(task)
+
+    async def fill(self, cell, version, coro):
+        try:
+            value = await coro
+        finally:
+            del self.pending[cell]
+        now = time.monotonic()
+        if len(self.entries) >= self.MAX_ENTRIES:
+            self.entries = {k: v for k, v in self.entries.items() if v[1] > now}
+            if len(self.entries) >= self.MAX_ENTRIES:
+                self.entries.clear()
+        # keyed on the version seen when the computation started, so data that changed meanwhile isn't hidden
+        self.entries[cell] = (version, now + self.TTL.total_seconds(), value)
+        return value
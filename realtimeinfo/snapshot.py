@@ -0,0 +1,141 @@
+import datetime
+import logging
+import threading
+import time
+
+import numpy as np
+from prometheus_client import Gauge
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+
+logger = logging.getLogger(__file__)
+
+
+class BusState:
+    """
+    One bus from the snapshot, with the current_vehicle_state columns the queries use.
+    """
+    def __init__(self, id, pid, rt, distance, last_update, destination, lat, lon):
+        self.id = id
+        self.pid = pid
+        self.rt = rt
+        self.distance = distance
+        self.last_update = last_update
+        self.destination = destination
+        self.lat = lat
+        self.lon = lon
+
+
+class Snapshot:
+    """
+    Immutable columnar copy of current vehicle state, replaced as a whole on every poll. Buses are held in
+    NumPy arrays with each pattern's rows pre-sorted by distance; the few hundred trains are kept as rows
+    grouped by (destination station, direction), the key TrainQuery matches patterns on.
+    """
+    def __init__(self, bus_rows, train_rows, loaded: datetime.datetime):
+        self.loaded = loaded
+        # set by VehicleSnapshot; bumped only when some vehicle changed
+        self.version = 0
+        self.ids = np.array([r.id for r in bus_rows], dtype=np.int64)
+        self.pids = np.array([r.pid or 0 for r in bus_rows], dtype=np.int64)
+        self.distances = np.array([r.distance for r in bus_rows], dtype=float)
+        self.last_updates = np.array([r.last_update for r in bus_rows], dtype='datetime64[us]')
+        self.lats = np.array([r.lat for r in bus_rows], dtype=float)
+        self.lons = np.array([r.lon for r in bus_rows], dtype=float)
+        self.rts = [r.rt for r in bus_rows]
+        self.destinations = [r.destination for r in bus_rows]
+        # pattern id -> row indexes ordered by distance
+        self.by_pattern = {}
+        order = np.lexsort((self.distances, self.pids))
+        boundaries = np.flatnonzero(np.diff(self.pids[order])) + 1
+        for group in np.split(order, boundaries):
+            if len(group):
+                self.by_pattern[int(self.pids[group[0]])] = group
+        self.trains = {}
+        for row in train_rows:
+            self.trains.setdefault((row.dest_station, row.direction), []).append(row)
+        # (id, last update) of every vehicle in id order, for telling whether anything changed between polls
+        order = np.argsort(self.ids, kind='stable')
+        self.bus_keys = (self.ids[order], self.last_updates[order])
+        self.train_keys = sorted((row.id, row.last_update) for row in train_rows)
+
+    def same_vehicles(self, other: 'Snapshot') -> bool:
+        """
+        :return: True if other has exactly the same vehicles with the same last update times
+        """
+        return (np.array_equal(self.bus_keys[0], other.bus_keys[0]) and
+                np.array_equal(self.bus_keys[1], other.bus_keys[1]) and
+                self.train_keys == other.train_keys)
+
+    def bus(self, index) -> BusState:
+        return BusState(
+            id=int(self.ids[index]),
+            pid=int(self.pids[index]),
+            rt=self.rts[index],
+            distance=float(self.distances[index]),
+            last_update=self.last_updates[index].item(),
+            destination=self.destinations[index],
+            lat=float(self.lats[index]),
+            lon=float(self.lons[index]),
+        )
+
+    def buses(self, pid, max_distance=None) -> list[BusState]:
+        """
+        :return: buses on pattern pid ordered by distance, only those short of max_distance (feet) if given
+        """
+        group = self.by_pattern.get(pid)
+        if group is None:
+            return []
+        if max_distance is not None:
+            group = group[:np.searchsorted(self.distances[group], max_distance, side='left')]
+        return [self.bus(index) for index in group]
+
+
+class VehicleSnapshot:
+    """
+    Current bus and train state held in the query server. The state tables change every 30-60 seconds but are
+    read on every request, so they are reloaded from the database once per POLL_INTERVAL on a background
+    thread and requests read the latest Snapshot without touching the database. The version is only bumped
+    when a reload finds a vehicle added, removed or updated, so it can key caches of derived results.
+    """
+    POLL_INTERVAL = 1
+
+    BUS_QUERY = ('select id, pid, rt, distance, last_update, destination, st_y(geom) as lat, st_x(geom) as lon '
+                 'from current_vehicle_state')
+    TRAIN_QUERY = ('select id, last_update, rt, dest_station, dest_station_name, direction, next_stop, '
+                   'st_y(geom) as lat, st_x(geom) as lon from current_train_state')
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.snapshot = self.load()
+        self.checked = self.snapshot.loaded
+        self.thread = threading.Thread(target=self.run, name='vehicles', daemon=True)
+        self.age_gauge = Gauge('transit_vehicle_snapshot_age_seconds', 'Time since the vehicle snapshot was polled')
+        self.age_gauge.set_function(lambda: (datetime.datetime.now() - self.checked).total_seconds())
+
+    def start(self):
+        self.thread.start()
+
+    def load(self) -> Snapshot:
+        with Session(self.engine) as session:
+            bus_rows = session.execute(text(self.BUS_QUERY)).all()
+            train_rows = session.execute(text(self.TRAIN_QUERY)).all()
+        return Snapshot(bus_rows, train_rows, datetime.datetime.now())
+
+    def get(self) -> Snapshot:
+        return self.snapshot
+
+    def run(self):
+        while True:
+            time.sleep(self.POLL_INTERVAL)
+            try:
+                snapshot = self.load()
+                if snapshot.same_vehicles(self.snapshot):
+                    snapshot.version = self.snapshot.version
+                else:
+                    snapshot.version = self.snapshot.version + 1
+                self.snapshot = snapshot
+                self.checked = snapshot.loaded
+            except Exception as e:
+                logger.warning(f'Error loading vehicle snapshot: {e}')
@@ -0,0 +1,159 @@
+import collections
+import datetime
+import logging
+import threading
+import time
+
+import requests
+from prometheus_client import Counter, Histogram
+
+
+logger = logging.getLogger(__file__)
+
+
+class WalkingTimes:
+    """
+    Walking time and distance from a query point to nearby stops. Walking from roughly the same place to a
+    fixed stop doesn't change, so origins are snapped to the center of a CELL_DEGREES grid cell and results are
+    cached per (cell, stop id) in an in-process LRU with a TTL, optionally shared through Redis. Stops missing
+    from both are fetched from Valhalla in a single sources_to_targets matrix request.
+    """
+    CELL_DEGREES = 0.001
+    TTL = datetime.timedelta(hours=24)
+    MAX_ENTRIES = 100000
+    TIMEOUT = 5
+
+    def __init__(self, valhalla_url, redis_client=None):
+        self.valhalla_url = valhalla_url
+        self.redis = redis_client
+        self.lock = threading.Lock()
+        # (cell, stop id) -> (expiry, (walk time, miles)), least recently used first
+        self.cache = collections.OrderedDict()
+        self.lookup_counter = Counter('transit_walking_lookup', 'Walking time lookups by where they were answered',
+                                      ['source'])
+        self.matrix_histogram = Histogram('transit_walking_matrix_seconds',
+                                          'Time taken by Valhalla sources_to_targets requests',
+                                          buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+        self.error_counter = Counter('transit_walking_error', 'Failed Valhalla matrix requests')
+
+    @classmethod
+    def cell(cls, lat, lon):
+        return round(lat / cls.CELL_DEGREES), round(lon / cls.CELL_DEGREES)
+
+    @classmethod
+    def cell_center(cls, cell):
+        return cell[0] * cls.CELL_DEGREES, cell[1] * cls.CELL_DEGREES
+
+    @staticmethod
+    def redis_key(cell, stop_id):
+        return f'walk:{cell[0]}:{cell[1]}:{stop_id}'
+
+    def get_cached(self, key, now):
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is None:
+                return None
+            expiry, value = entry
+            if expiry < now:
+                del self.cache[key]
+                return None
+            self.cache.move_to_end(key)
+            return value
+
+    def put_cached(self, key, value, now):
+        with self.lock:
+            self.cache[key] = (now + self.TTL.total_seconds(), value)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.MAX_ENTRIES:
+                self.cache.popitem(last=False)
+
+    def get(self, lat, lon, stops):
+        """
+        :param stops: list of (stop id, lat, lon)
+        :return: dict of stop id to (walk time, miles) for the stops a time could be found for
+        """
+        cell = self.cell(lat, lon)
+        now = time.monotonic()
+        rv = {}
+        missing = {}
+        for stop_id, stop_lat, stop_lon in stops:
+            value = self.get_cached((cell, stop_id), now)
+            if value is not None:
+                rv[stop_id] = value
+            else:
+                missing[stop_id] = (stop_lat, stop_lon)
+        self.lookup_counter.labels(source='memory').inc(len(rv))
+        if missing and self.redis is not None:
+            found = self.get_redis(cell, list(missing))
+            for stop_id, value in found.items():
+                rv[stop_id] = value
+                self.put_cached((cell, stop_id), value, now)
+                del missing[stop_id]
+            self.lookup_counter.labels(source='redis').inc(len(found))
+        if not missing:
+            return rv
+        fetched = self.fetch_matrix(self.cell_center(cell), missing)
+        self.lookup_counter.labels(source='valhalla').inc(len(fetched))
+        for stop_id, value in fetched.items():
+            rv[stop_id] = value
+            self.put_cached((cell, stop_id), value, now)
+        if fetched and self.redis is not None:
+            self.put_redis(cell, fetched)
+        return rv
+
+    def get_redis(self, cell, stop_ids):
+        try:
+            values = self.redis.mget([self.redis_key(cell, stop_id) for stop_id in stop_ids])
+        except Exception as e:
+            logger.warning(f'Error reading walking times from Redis: {e}')
+            return {}
+        rv = {}
+        for stop_id, value in zip(stop_ids, values):
+            if value is None:
+                continue
+            seconds, miles = value.decode('utf-8').split(':')
+            rv[stop_id] = (datetime.timedelta(seconds=int(seconds)), float(miles))
+        return rv
+
+    def put_redis(self, cell, values):
+        pipeline = self.redis.pipeline(transaction=False)
+        for stop_id, (walk_time, miles) in values.items():
+            pipeline.set(self.redis_key(cell, stop_id), f'{int(walk_time.total_seconds())}:{miles}', ex=self.TTL)
+        try:
+            pipeline.execute()
+        except Exception as e:
+            logger.warning(f'Error writing walking times to Redis: {e}')
+
+    def fetch_matrix(self, origin, stops):
+        """
+        :param origin: (lat, lon)
+        :param stops: dict of stop id to (lat, lon)
+        :return: dict of stop id to (walk time, miles)
+        """
+        stop_ids = list(stops)
+        request = {
+            'sources': [{'lat': origin[0], 'lon': origin[1]}],
+            'targets': [{'lat': stops[stop_id][0], 'lon': stops[stop_id][1]} for stop_id in stop_ids],
+            'costing': 'pedestrian',
+            'units': 'miles',
+        }
+        start = time.monotonic()
+        try:
+            resp = requests.post(f'{self.valhalla_url}/sources_to_targets', json=request, timeout=self.TIMEOUT)
+        except requests.RequestException as e:
+            logger.warning(f'Error requesting walking times: {e}')
+            self.error_counter.inc()
+            return {}
+        self.matrix_histogram.observe(time.monotonic() - start)
+        if resp.status_code != 200:
+            logger.warning(f'Walking time request status code {resp.status_code}: {resp.text}')
+            self.error_counter.inc()
+            return {}
+        rv = {}
+        for item in resp.json()['sources_to_targets'][0]:
+            if item.get('time') is None:
+                # no pedestrian route to this stop
+                continue
+            stop_id = stop_ids[item['to_index']]
+            rv[stop_id] = (datetime.timedelta(seconds=int(item['time'])), item['distance'])
+        return rv
@@ -2,11 +2,12 @@
 from pathlib import Path
 
 import gtfs_kit
+import numpy as np
 import pyproj
 import shapely
 
 from shapely.ops import split
-from sqlalchemy import select, func
+from sqlalchemy import select
 from sqlalchemy.orm import Session
 from geoalchemy2.shape import to_shape, from_shape
 
@@ -45,6 +46,14 @@ class ShapeManager:
         coord_point = shapely.Point(ShapeManager.XFM.transform(point.y, point.x))
         return coord_point
 
+    @staticmethod
+    def transform_arrays(lons, lats):
+        """
+        Projects arrays of lat/lon coordinates in one call.
+        :return: (x, y) arrays in meters
+        """
+        return ShapeManager.XFM.transform(np.asarray(lats, dtype=float), np.asarray(lons, dtype=float))
+
     @staticmethod
     def geom_distance(p1: shapely.Point, p2: shapely.Point):
         """
@@ -144,6 +153,33 @@ class ShapeManager:
             rv = (complement > x), complement
         return rv
 
+    def get_distances_along_shape_anchor(self, lons, lats, anchors, prev_larger=False):
+        """
+        Array version of get_distance_along_shape_anchor for a sequence of points along one trip.
+        :param lons:
+        :param lats:
+        :param anchors: known pattern distances near each point; NaN where there is none
+        :param prev_larger: fallback choice before the first anchored point
+        :return: (larger, distances) arrays, matching the values the scalar version returns when called
+          point by point while threading prev_larger through
+        """
+        x, y = self.transform_arrays(lons, lats)
+        distances = shapely.line_locate_point(self.shape, shapely.points(x, y))
+        count = len(distances)
+        if not self.needs_loop_detection():
+            return np.zeros(count, dtype=bool), distances
+        complement = self.shape.length - distances
+        anchors = np.asarray(anchors, dtype=float)
+        anchored = ~np.isnan(anchors)
+        use_x = np.abs(distances - anchors) < np.abs(complement - anchors)
+        larger = np.where(use_x, distances > complement, complement > distances)
+        rv = np.where(use_x, distances, complement)
+        # without an anchor, the choice made at the most recent anchored point carries forward
+        last_anchored = np.maximum.accumulate(np.where(anchored, np.arange(count), -1))
+        carried = np.where(last_anchored >= 0, larger[np.maximum(last_anchored, 0)], prev_larger)
+        fallback = np.where(carried, np.maximum(distances, complement), np.minimum(distances, complement))
+        return carried, np.where(anchored, rv, fallback)
+
     def get_distance_along_shape_dc(self, direction_change, stop_point):
         coord_point = shapely.Point(self.XFM.transform(stop_point.y, stop_point.x))
         if self.front is None:
@@ -176,6 +212,102 @@ class ShapeManager:
         return (self.shape.length / 2) + 1
 
 
+class PatternMatcher:
+    """
+    In-memory spatial index for picking a train pattern without a database round trip. Patterns are grouped
+    by (route, last stop id); each group has an STRtree over the projected first-stop points and another
+    over the pattern linestrings. All geometries are in EPSG:26916 so distances are in meters.
+    """
+    EXCLUDED_PATTERNS = {308500036, 308500102}
+
+    def __init__(self):
+        self.pending = {}
+        # (route, last stop id) -> (pattern details, first stop points, first stop tree, shapes, shape tree)
+        self.groups = {}
+
+    def __len__(self):
+        return sum(len(group[0]) for group in self.groups.values())
+
+    def add(self, pattern: TrainPatternDetail, shape: shapely.LineString, first_stop_point: shapely.Point):
+        """
+        :param pattern:
+        :param shape: pattern linestring in EPSG:26916
+        :param first_stop_point: lat/lon point of the pattern's first stop
+        """
+        if pattern.pattern_id in self.EXCLUDED_PATTERNS:
+            return
+        key = (pattern.route_id, int(pattern.last_stop_id))
+        self.pending.setdefault(key, []).append((pattern, shape, ShapeManager.transform(first_stop_point)))
+
+    def build(self):
+        for key, items in self.pending.items():
+            details = [x[0] for x in items]
+            shapes = [x[1] for x in items]
+            points = [x[2] for x in items]
+            self.groups[key] = (details, points, shapely.STRtree(points), shapes, shapely.STRtree(shapes))
+        self.pending = {}
+
+    def start_candidates(self, rt: str, last_stop_id: int, point_chicago: shapely.Point, max_distance=None):
+        """
+        :return: list of (index, pattern detail, first stop distance) in pattern load order
+        """
+        group = self.groups.get((rt, int(last_stop_id)))
+        if group is None:
+            return []
+        details, points, point_tree, _, _ = group
+        if max_distance is None:
+            indices = range(len(details))
+        else:
+            indices = sorted(point_tree.query(point_chicago, predicate='dwithin', distance=max_distance))
+        return [(i, details[i], points[i].distance(point_chicago)) for i in indices]
+
+    def match_run(self, rt: str, last_stop_id: int, start_point: shapely.Point, max_distance=4000):
+        """
+        Picks the pattern whose first stop is closest to where a completed run started.
+        :param start_point: lat/lon point of the first position of the run
+        :return: (pattern id or None, list of (pattern detail, first stop distance) for every pattern on the
+          route ending at last_stop_id)
+        """
+        point_chicago = ShapeManager.transform(start_point)
+        candidates = self.start_candidates(rt, last_stop_id, point_chicago)
+        match = None
+        for _, detail, d in candidates:
+            if d < max_distance and (match is None or d < match[1]):
+                match = (detail.pattern_id, d)
+        pattern_id = match[0] if match else None
+        return pattern_id, [(detail, d) for _, detail, d in candidates]
+
+    def match_position(self, rt: str, last_stop_id: int, train_point: shapely.Point,
+                       start_distance=1000, shape_distance=200):
+        """
+        Picks a pattern for a train position: patterns whose first stop is within start_distance, and if more
+        than one, the closest shape within shape_distance.
+        :param train_point: lat/lon point
+        :return: pattern id or None
+        """
+        group = self.groups.get((rt, int(last_stop_id)))
+        if group is None:
+            return None
+        point_chicago = ShapeManager.transform(train_point)
+        candidates = self.start_candidates(rt, last_stop_id, point_chicago, max_distance=start_distance)
+        if len(candidates) == 1:
+            return candidates[0][1].pattern_id
+        if not candidates:
+            return None
+        details, _, _, shapes, shape_tree = group
+        near_shapes = set(shape_tree.query(point_chicago, predicate='dwithin', distance=shape_distance))
+        rdist = None
+        for i, detail, _ in candidates:
+            if i not in near_shapes:
+                continue
+            key = (shapes[i].distance(point_chicago), detail.pattern_id)
+            if rdist is None or key < rdist:
+                rdist = key
+        if rdist is None:
+            return None
+        return rdist[1]
+
+
 class ScheduleAnalyzer:
     def __init__(self, schedule_location: Path, engine=None):
         self.schedule_location = schedule_location
@@ -186,6 +318,9 @@ class ScheduleAnalyzer:
         self.feed = None
         self.geo_shapes = None
         self.managed_shapes = {}
+        # (pattern id, stop id) -> (distance, direction_change, stop_headsign) for train patterns
+        self.pattern_stops = {}
+        self.pattern_matcher = None
 
     def load_feed(self):
         if self.feed is not None:
@@ -207,52 +342,70 @@ class ScheduleAnalyzer:
             # need more input geometry sanitization
             print(f'Invalid train point {train_point}')
             return None
-        with Session(self.engine) as session:
-            #print(f'rt {rt}  last station {last_station}  train point {train_point}')
-            stmt = (select(TrainPatternDetail)
-                    .join(Stop, TrainPatternDetail.first_stop_id == Stop.id)
-                    .where(TrainPatternDetail.route_id == rt)
-                    .where(TrainPatternDetail.last_stop_id == last_station)
-                    .where(TrainPatternDetail.pattern_id.not_in({308500036, 308500102}))
-                    .where(func.ST_Distance(
-                            Stop.geom.ST_Transform(26916), func.ST_Transform(from_shape(train_point, srid=4326), 26916)
-                        ) < 1000
-                        )
-                    )
-            s = session.scalars(stmt)
-            candidates = s.all()
-            #candidates = j[(j.last_stop_id == str(last_station)) & (j.route_id.str.lower() == rt)]
-            #candidates = candidates[~candidates.shape_id.isin({'308500036', '308500102'})]
-            if len(candidates) == 1:
-                return candidates[0].pattern_id
-            if not candidates:
-                return None
-            rdist = None
-            transformed = ShapeManager.XFM.transform(train_point.y, train_point.x)
-            train_point_chicago = shapely.Point(*transformed)
-            for c in candidates:
-                shape_geom = c.geom
-                dist = shape_geom.distance(train_point_chicago)
-                key = (dist, c.pattern_id)
-                if rdist is None:
-                    rdist = key
-                elif key < rdist:
-                    rdist = key
-            if rdist is None:
-                return None
-            if rdist[0] > 200:
-                return None
-            return rdist[1]
+        if self.pattern_matcher is None:
+            self.setup_shapes()
+        return self.pattern_matcher.match_position(rt, last_station, train_point)
 
     def setup_shapes(self):
+        self.build_shapes(self.query_shapes())
+        self.load_pattern_stops()
+
+    def query_shapes(self):
+        """
+        :return: list of (train pattern detail, first stop geometry or None)
+        """
         with Session(self.engine) as session:
-            stmt = (select(TrainPatternDetail)
-                    .where(TrainPatternDetail.pattern_id.not_in({308500036, 308500102}))
+            stmt = (select(TrainPatternDetail, Stop.geom)
+                    .outerjoin(Stop, TrainPatternDetail.first_stop_id == Stop.id)
+                    .where(TrainPatternDetail.pattern_id.not_in(PatternMatcher.EXCLUDED_PATTERNS))
+                    .order_by(TrainPatternDetail.pattern_id)
                     )
-            rows = session.scalars(stmt)
-            for pattern in rows:
-                pattern_id = pattern.pattern_id
-                self.managed_shapes[pattern_id] = ShapeManager(pattern)
+            return session.execute(stmt).all()
+
+    def build_shapes(self, rows):
+        """
+        Builds the shape managers and pattern matcher from query_shapes rows, replacing the current ones.
+        """
+        pattern_matcher = PatternMatcher()
+        managed_shapes = {}
+        for pattern, first_stop_geom in rows:
+            pattern_id = pattern.pattern_id
+            shape_manager = ShapeManager(pattern)
+            managed_shapes[pattern_id] = shape_manager
+            if first_stop_geom is not None:
+                pattern_matcher.add(pattern, shape_manager.shape, to_shape(first_stop_geom))
+        pattern_matcher.build()
+        self.managed_shapes = managed_shapes
+        self.pattern_matcher = pattern_matcher
+
+    def load_pattern_stops(self):
+        """
+        Loads the stops of every train pattern, so train positions can be anchored to their next stop without a
+        query per train. Reloaded by update_db when a new schedule adds patterns.
+        """
+        self.set_pattern_stops(self.query_pattern_stops())
+
+    def query_pattern_stops(self):
+        """
+        :return: list of (pattern id, stop id, distance, direction_change, stop_headsign) for train patterns
+        """
+        with Session(self.engine) as session:
+            stmt = (select(PatternStop.pattern_id, PatternStop.stop_id, PatternStop.distance,
+                           PatternStop.direction_change, PatternStop.stop_headsign)
+                    .where(PatternStop.pattern_id >= 300000000))
+            return [tuple(row) for row in session.execute(stmt)]
+
+    def set_pattern_stops(self, rows):
+        pattern_stops = {}
+        for pattern_id, stop_id, distance, direction_change, stop_headsign in rows:
+            pattern_stops[(pattern_id, stop_id)] = (distance, direction_change, stop_headsign)
+        self.pattern_stops = pattern_stops
+
+    def get_pattern_stop(self, pattern_id, stop_id):
+        """
+        :return: (distance, direction_change, stop_headsign) of a train pattern stop, or None
+        """
+        return self.pattern_stops.get((int(pattern_id), int(stop_id)))
 
     def add_destinations_to_db(self):
         self.load_feed()
@@ -359,6 +512,7 @@ class ScheduleAnalyzer:
                     session.add(pattern_stop)
                     sequence += 1
             session.commit()
+        self.load_pattern_stops()
         print(f'Database updated')
 
     def train_trips(self):
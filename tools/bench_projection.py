@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Benchmarks ShapeManager.get_distances_along_shape_anchor against calling the scalar
+get_distance_along_shape_anchor point by point, and checks that both give the same distances. Uses a synthetic
+loop pattern through the Loop midpoint so the loop-complement logic is exercised.
+"""
+import argparse
+import sys
+import timeit
+
+import numpy as np
+import shapely
+from geoalchemy2.shape import from_shape
+
+from schedules.schedule_analyzer import ShapeManager
+
+
+class SyntheticPattern:
+    def __init__(self, shape):
+        self.pattern_id = 0
+        self.geom = from_shape(shape, srid=26916)
+        self.first_stop_name = 'Loop'
+        self.last_stop_name = 'Loop'
+
+
+def make_loop_pattern():
+    # out from the Loop, around a 2km block and back along the same tracks
+    mx, my = ShapeManager.XFM.transform(*ShapeManager.LOOP_MIDPOINT)
+    coords = [(mx, my - 5000), (mx, my), (mx, my + 8000), (mx + 2000, my + 8000), (mx + 2000, my + 10000),
+              (mx, my + 10000), (mx, my + 8000), (mx, my), (mx, my - 5000)]
+    return ShapeManager(SyntheticPattern(shapely.LineString(coords)))
+
+
+def make_points(shape_manager, count, rng):
+    shape = shape_manager.shape
+    distances = np.sort(rng.uniform(0, shape.length, count))
+    points = shapely.line_interpolate_point(shape, distances)
+    x = shapely.get_x(points) + rng.normal(0, 15, count)
+    y = shapely.get_y(points) + rng.normal(0, 15, count)
+    inverse = ShapeManager.XFM.transform(x, y, direction='INVERSE')
+    lats, lons = inverse
+    # roughly one in five points has no known next stop distance
+    anchors = np.where(rng.uniform(size=count) < 0.2, np.nan, distances + rng.normal(0, 100, count))
+    return np.asarray(lons), np.asarray(lats), anchors
+
+
+def scalar(shape_manager, lons, lats, anchors):
+    larger = False
+    rv = []
+    for lon, lat, anchor in zip(lons, lats, anchors):
+        anchor = None if np.isnan(anchor) else anchor
+        larger, distance = shape_manager.get_distance_along_shape_anchor(anchor, shapely.Point(lon, lat), larger)
+        rv.append(distance)
+    return np.array(rv)
+
+
+def batch(shape_manager, lons, lats, anchors):
+    _, distances = shape_manager.get_distances_along_shape_anchor(lons, lats, anchors)
+    return distances
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark batch vs scalar shape projection.')
+    parser.add_argument('--points', type=int, default=1000,
+                        help='Number of points per trip.')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='Number of timed runs of each version.')
+    args = parser.parse_args()
+    shape_manager = make_loop_pattern()
+    if not shape_manager.needs_loop_detection():
+        print('Synthetic pattern was not split at the loop midpoint')
+        sys.exit(1)
+    lons, lats, anchors = make_points(shape_manager, args.points, np.random.default_rng(0))
+
+    expected = scalar(shape_manager, lons, lats, anchors)
+    actual = batch(shape_manager, lons, lats, anchors)
+    if not np.allclose(expected, actual):
+        bad = np.flatnonzero(~np.isclose(expected, actual))
+        print(f'{len(bad)} distances differ, first at index {bad[0]}: {expected[bad[0]]} vs {actual[bad[0]]}')
+        sys.exit(1)
+
+    scalar_time = min(timeit.repeat(lambda: scalar(shape_manager, lons, lats, anchors),
+                                    number=1, repeat=args.repeat))
+    batch_time = min(timeit.repeat(lambda: batch(shape_manager, lons, lats, anchors),
+                                   number=1, repeat=args.repeat))
+    print(f'{args.points} points: scalar {scalar_time * 1000:.2f} ms, batch {batch_time * 1000:.2f} ms, '
+          f'speedup {scalar_time / batch_time:.1f}x')
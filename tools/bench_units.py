@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the CPU time of one estimate request through TripSamples and EstimateFinder, the part of
+QueryManager.get_estimates that runs once the trip samples are back from Redis. The history Redis is replaced
+by synthetic in-memory trajectories so only the estimate arithmetic is timed. Run it against two checkouts to
+compare them; the printed checksum should match when their estimates agree.
+"""
+import argparse
+import timeit
+
+import numpy as np
+
+from interfaces import Q_
+from interfaces.estimates import StopEstimate, PositionInfo
+from realtimeinfo.queries import TripSamples, EstimateFinder
+
+
+class SyntheticHistory:
+    """
+    Answers the TS.MGET and TS.RANGE calls the estimate code makes from in-memory trajectories.
+    """
+    def __init__(self, trajectories, patterns):
+        # redis key -> list of (timestamp, distance)
+        self.trajectories = trajectories
+        self.patterns = patterns
+        self.queued = []
+
+    def ts(self):
+        return self
+
+    def pipeline(self, transaction=False):
+        return SyntheticHistory(self.trajectories, self.patterns)
+
+    def mget(self, filters):
+        pid = int(filters[0].split('=')[1])
+        return [{key: [{}, samples[-1][0], samples[-1][1]]}
+                for key, samples in self.trajectories.items() if self.patterns[key] == pid]
+
+    def range(self, key, from_time, to_time, count=None, aggregation_type=None, bucket_size_msec=None,
+              filter_by_min_value=None, filter_by_max_value=None):
+        samples = self.trajectories[key]
+        if filter_by_min_value is not None:
+            samples = [(t, d) for t, d in samples if filter_by_min_value <= d <= filter_by_max_value]
+        if count is not None:
+            samples = samples[:count]
+        self.queued.append(samples)
+
+    def execute(self):
+        rv = self.queued
+        self.queued = []
+        return rv
+
+
+def make_request(patterns, trips, vehicles, rng):
+    trajectories = {}
+    pattern_of = {}
+    rows = []
+    start = 1700000000
+    for pid in range(1, patterns + 1):
+        for trip in range(trips):
+            speed = rng.uniform(4, 9)
+            times = np.arange(0, 15000 / speed, 30)
+            distances = np.minimum(times * speed + rng.normal(0, 10, len(times)), 15000)
+            key = f'busposition:{pid}:{trip}'
+            trajectories[key] = [(int(start + trip * 600 + t), float(d)) for t, d in zip(times, distances)]
+            pattern_of[key] = pid
+        positions = np.sort(rng.uniform(0, 9000, vehicles))
+        rows.append(StopEstimate(
+            pattern_id=pid,
+            stop_position=Q_(10000, 'm'),
+            vehicle_positions=[PositionInfo(vehicle_position=Q_(p, 'm'), vehicle_id=pid * 100 + i)
+                               for i, p in enumerate(positions)]))
+    return SyntheticHistory(trajectories, pattern_of), rows
+
+
+def estimate(history, rows):
+    trip_samples = TripSamples(history, rows)
+    finders = [EstimateFinder(history, row, trip_samples=trip_samples) for row in rows]
+    for finder in finders:
+        finder.request_samples()
+    trip_samples.execute()
+    return [single for finder in finders for single in finder.get_single_estimate()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the CPU time of an estimate request.')
+    parser.add_argument('--patterns', type=int, default=20,
+                        help='Number of patterns in the request.')
+    parser.add_argument('--trips', type=int, default=10,
+                        help='Number of reference trips per pattern.')
+    parser.add_argument('--vehicles', type=int, default=5,
+                        help='Number of vehicles per pattern.')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='Number of timed runs.')
+    args = parser.parse_args()
+    history, rows = make_request(args.patterns, args.trips, args.vehicles, np.random.default_rng(0))
+    results = estimate(history, rows)
+    checksum = sum(s.low_estimate.total_seconds() + s.high_estimate.total_seconds() for s in results)
+    elapsed = min(timeit.repeat(lambda: estimate(history, rows), number=1, repeat=args.repeat))
+    print(f'{len(rows)} patterns, {len(results)} estimates, checksum {checksum:.1f}: '
+          f'{elapsed * 1000:.2f} ms per request')
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+Checks that the Postgres nearby-stop queries can use the GiST index on stop.geom_chicago. Each query is
+EXPLAINed with sequential scans disabled: if the ST_DWithin filter is index-compatible the plan uses
+idx_stop_geom_chicago, otherwise Postgres falls back to a sequential scan anyway and the check fails.
+"""
+import argparse
+import sys
+
+from sqlalchemy import text
+
+from interfaces.estimates import Mode
+from realtime.rtmodel import db_init
+from realtimeinfo.catalog import SqlStopFinder
+from backend.util import Config
+
+
+INDEX = 'idx_stop_geom_chicago'
+
+
+def explain(connection, statement, params):
+    connection.execute(text('SET LOCAL enable_seqscan = off'))
+    rows = connection.execute(text(f'EXPLAIN {statement.text}'), params)
+    return '\n'.join(row[0] for row in rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Check that nearby-stop queries use the stop geometry index.')
+    parser.add_argument('--prod', action='store_true',
+                        help='Check prod instead of dev.')
+    parser.add_argument('--verbose', action='store_true',
+                        help='Print the query plans.')
+    args = parser.parse_args()
+    engine = db_init(Config('prod' if args.prod else 'dev'))
+    params = {'lat': 41.88322, 'lon': -87.626189, 'thresh': 1000}
+    failed = 0
+    for mode in [Mode.BUS, Mode.TRAIN]:
+        with engine.begin() as connection:
+            plan = explain(connection, SqlStopFinder.statement(mode), params)
+        uses_index = INDEX in plan
+        print(f'{mode} nearby stops: {"uses" if uses_index else "DOES NOT use"} {INDEX}')
+        if args.verbose or not uses_index:
+            print(plan)
+        if not uses_index:
+            failed += 1
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+One-time migration that adds the trip labels (mode, pattern, route, trip, start) to trajectory series created
+before TrajectoryBatch set them, so estimate queries can find them with TS.MGET FILTER pattern=<pid>.
+Series that already have a pattern label are left alone.
+"""
+import argparse
+
+import redis
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from realtime.rtmodel import *
+from realtime.trajectories import TrajectoryBatch
+from backend.util import Config
+
+
+def pattern_routes(engine):
+    with Session(engine) as session:
+        routes = dict(session.execute(select(Pattern.id, Pattern.rt)).tuples())
+        routes.update(session.execute(select(TrainPatternDetail.pattern_id, TrainPatternDetail.route_id)).tuples())
+    return routes
+
+
+def label_batch(r, keys, routes, dry_run):
+    p = r.pipeline(transaction=False)
+    for key in keys:
+        p.ts().info(key)
+    infos = p.execute(raise_on_error=False)
+    labelled = 0
+    for key, info in zip(keys, infos):
+        if isinstance(info, Exception):
+            print(f'Skipping {key}: {info}')
+            continue
+        if info.labels.get('pattern'):
+            continue
+        # busposition:<pid>:<origtatripno> or trainposition:<pid>:<run>-<trip id>
+        prefix, pid, trip = key.decode('utf-8').split(':', 2)
+        mode = 'train' if prefix == 'trainposition' else 'bus'
+        labels = TrajectoryBatch.trip_labels(mode, pid, routes.get(int(pid)), trip, info.first_timestamp)
+        labels = {k: str(v) for k, v in labels.items() if v is not None}
+        if dry_run:
+            print(f'{key}: {labels}')
+        else:
+            p.ts().alter(key, labels=labels)
+        labelled += 1
+    if not dry_run:
+        p.execute()
+    return labelled
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Add trip labels to existing trajectory series.')
+    parser.add_argument('--prod', action='store_true',
+                        help='Migrate prod instead of dev.')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Print the labels without writing them.')
+    args = parser.parse_args()
+    config = Config('prod' if args.prod else 'dev')
+    routes = pattern_routes(db_init(config))
+    r = redis.Redis(host=config.get_server('redis-vehicle-history'))
+    visited = 0
+    labelled = 0
+    for keytype in ['bus', 'train']:
+        batch = []
+        for key in r.scan_iter(f'{keytype}position:*', count=500):
+            batch.append(key)
+            if len(batch) >= 500:
+                visited += len(batch)
+                labelled += label_batch(r, batch, routes, args.dry_run)
+                batch = []
+        visited += len(batch)
+        labelled += label_batch(r, batch, routes, args.dry_run)
+    print(f'Visited {visited} series, labelled {labelled}')
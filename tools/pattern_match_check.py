@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Checks that the in-memory PatternMatcher picks the same train pattern as the PostGIS query it replaced in
+TrainUpdater.finalize_trip. The first position of each synthetic trip in train_position is used as the run
+start; exits non-zero if any pick differs.
+"""
+import argparse
+import sys
+from pathlib import Path
+
+from geoalchemy2.shape import to_shape
+from sqlalchemy import select, func
+from sqlalchemy.orm import Session
+
+from realtime.rtmodel import *
+from backend.util import Config
+from schedules.schedule_analyzer import ScheduleAnalyzer, PatternMatcher
+
+
+def sql_match(session, rt, dest_station, start_geom):
+    stmt = (session.query(TrainPatternDetail, func.ST_Distance(
+                Stop.geom.ST_Transform(26916), func.ST_Transform(start_geom, 26916)
+                ).label('stop_dist'))
+            .join(Stop, TrainPatternDetail.first_stop_id == Stop.id)
+            .where(TrainPatternDetail.route_id == rt)
+            .where(TrainPatternDetail.last_stop_id == dest_station)
+            .where(TrainPatternDetail.pattern_id.not_in(PatternMatcher.EXCLUDED_PATTERNS))
+            )
+    match = None
+    for pr, d in stmt.all():
+        if d < 4000:
+            if match is not None and d >= match[1]:
+                continue
+            match = (pr.pattern_id, d)
+    if match:
+        return match
+    return None, None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare PatternMatcher picks with the PostGIS pattern query.')
+    parser.add_argument('--prod', action='store_true',
+                        help='Check against prod instead of dev.')
+    parser.add_argument('--limit', type=int, default=500,
+                        help='Maximum number of trips to check.')
+    args = parser.parse_args()
+    config = Config('prod' if args.prod else 'dev')
+    engine = db_init(config)
+    sa = ScheduleAnalyzer(Path('/app/cta_gtfs_20250206.zip'), engine=engine)
+    sa.setup_shapes()
+    print(f'Indexed {len(sa.pattern_matcher)} patterns')
+    checked = 0
+    mismatches = 0
+    with Session(engine) as session:
+        stmt = (select(TrainPosition)
+                .distinct(TrainPosition.synthetic_trip_id)
+                .where(TrainPosition.synthetic_trip_id.is_not(None))
+                .order_by(TrainPosition.synthetic_trip_id, TrainPosition.timestamp)
+                .limit(args.limit))
+        for start in session.scalars(stmt):
+            checked += 1
+            expected, expected_dist = sql_match(session, start.rt, start.dest_station, start.geom)
+            actual, candidates = sa.pattern_matcher.match_run(start.rt, start.dest_station, to_shape(start.geom))
+            if expected != actual:
+                mismatches += 1
+                print(f'Mismatch for run {start.run} trip {start.synthetic_trip_id} rt {start.rt} '
+                      f'dest {start.dest_station}: sql {expected} ({expected_dist}) matcher {actual} '
+                      f'candidates {[(c.pattern_id, round(d)) for c, d in candidates]}')
+    print(f'Checked {checked} trips, {mismatches} mismatches')
+    sys.exit(1 if mismatches else 0)
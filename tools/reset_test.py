@@ -11,15 +11,15 @@ from backend.util import Config
 
 def redis_delete(keytype):
     deleted = 0
-    #del_keys = r.keys('trainposition:*')
-    del_keys = r.keys(f'{keytype}position:*')
-    print(f'Found {len(del_keys)} redis {keytype} keys to delete')
-    pipe = r.pipeline()
-    for key in del_keys:
-        deleted += 1
-        pipe.delete(key)
-    pipe.execute()
-    print(f'Redis deleted {deleted}')
+    batch = []
+    for key in r.scan_iter(f'{keytype}position:*', count=500):
+        batch.append(key)
+        if len(batch) >= 500:
+            deleted += r.unlink(*batch)
+            batch = []
+    if batch:
+        deleted += r.unlink(*batch)
+    print(f'Redis deleted {deleted} {keytype} keys')
 
 
 if __name__ == "__main__":
@@ -54,7 +54,6 @@ if __name__ == "__main__":
         session.commit()
     print(f'Cleared db')
     r = redis.Redis(host=config.get_server('redis-vehicle-history'))
-    #for key in r.scan_iter('trainposition:*'):
     if args.bus:
         redis_delete('bus')
     if args.train:
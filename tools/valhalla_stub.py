@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Minimal stand-in for the Valhalla routing service, for running the query server locally. Answers the
+pedestrian route and sources_to_targets calls the query server makes with straight-line distance times a
+detour factor at walking speed, in Valhalla's response format. Point the valhalla server in connections.json
+at it.
+"""
+import argparse
+import json
+import math
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+EARTH_RADIUS_MILES = 3958.8
+DETOUR = 1.3
+WALKING_MPH = 3.1
+
+
+def walk(source, target):
+    """
+    :return: (seconds, miles) from source to target locations
+    """
+    lat1, lon1, lat2, lon2 = map(math.radians, (source['lat'], source['lon'], target['lat'], target['lon']))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    miles = 2 * EARTH_RADIUS_MILES * math.asin(math.sqrt(a)) * DETOUR
+    return round(miles / WALKING_MPH * 3600), round(miles, 3)
+
+
+class Handler(BaseHTTPRequestHandler):
+    def reply(self, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def route(self, request):
+        seconds, miles = walk(*request['locations'][:2])
+        rv = {'trip': {'summary': {'time': seconds, 'length': miles}}}
+        if 'id' in request:
+            rv['id'] = request['id']
+        return rv
+
+    def matrix(self, request):
+        rows = []
+        for from_index, source in enumerate(request['sources']):
+            row = []
+            for to_index, target in enumerate(request['targets']):
+                seconds, miles = walk(source, target)
+                row.append({'from_index': from_index, 'to_index': to_index, 'time': seconds, 'distance': miles})
+            rows.append(row)
+        return {'sources_to_targets': rows, 'units': 'miles'}
+
+    def handle_request(self, path, request):
+        if path == '/route':
+            self.reply(self.route(request))
+        elif path == '/sources_to_targets':
+            self.reply(self.matrix(request))
+        else:
+            self.send_error(404)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.handle_request(url.path, json.loads(parse_qs(url.query)['json'][0]))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.handle_request(urlparse(self.path).path, json.loads(self.rfile.read(length)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Local stand-in for Valhalla walking routes.')
+    parser.add_argument('--port', type=int, default=8002,
+                        help='Port to listen on.')
+    args = parser.parse_args()
+    server = ThreadingHTTPServer(('', args.port), Handler)
+    print(f'Serving on port {args.port}')
+    server.serve_forever()